@@ -1,8 +1,18 @@
+import logging
+import os
+import shutil
 import yaml
 from abc import ABC, abstractmethod
 from os.path import join, exists, dirname, abspath
+from tempfile import gettempdir
 
-from ..utils import Config
+from ..utils import Config, MemmapCache, get_hash, make_dir
+
+log = logging.getLogger(__name__)
+
+# Version of the scans stored in the scan cache, increase it when the data
+# returned by the datasets changes so that old entries are not used.
+SCAN_CACHE_VERSION = 1
 
 
 class BaseDataset(ABC):
@@ -99,6 +109,68 @@ class BaseDatasetSplit(ABC):
         self.cfg = dataset.cfg
         self.split = split
         self.dataset = dataset
+        self.scan_cache = None
+
+    def get_cached_data(self, idx, load_data):
+        """Returns the data for the given index from the scan cache.
+
+        The cache is enabled with `scan_cache_mb` in the dataset config, the
+        byte budget of the recently used scans. Scans are stored as memory
+        mapped files in `scan_cache_dir` (by default in shared memory), so
+        the pages are shared by all data loader workers. The budget applies
+        to the files of all processes sharing the directory, the least
+        recently used scans are removed when it is exceeded, and it is
+        clamped to the free space of the directory. Entries are keyed by the
+        name of the datum, the modification time and size of its file and
+        SCAN_CACHE_VERSION, so edited files are loaded again. Scans that can
+        not be written to the cache are returned without storing them.
+
+        Args:
+            idx: The index of the datum.
+            load_data: Function loading the data for an index, called for
+                scans that are not cached yet.
+
+        Returns:
+            The data for the given index.
+        """
+        max_memory = int(self.cfg.get('scan_cache_mb', 0) * 1024 * 1024)
+        if max_memory <= 0 or self.scan_cache is False:
+            return load_data(idx)
+
+        if self.scan_cache is None:
+            cache_dir = self.cfg.get('scan_cache_dir', None)
+            if cache_dir is None:
+                shm_dir = '/dev/shm' if exists('/dev/shm') else gettempdir()
+                cache_dir = join(shm_dir, 'open3d_ml_scans')
+            cache_key = get_hash('{}_{}'.format(self.cfg.name,
+                                                self.cfg.dataset_path))
+            try:
+                make_dir(cache_dir)
+                # E.g. /dev/shm is 64 MB in docker by default.
+                max_disk = min(max_memory, shutil.disk_usage(cache_dir).free)
+                self.scan_cache = MemmapCache(load_data,
+                                              cache_dir=cache_dir,
+                                              cache_key=cache_key,
+                                              max_memory=max_memory,
+                                              max_disk=max_disk)
+            except OSError as e:
+                log.warning("Disabling the scan cache: {}".format(e))
+                self.scan_cache = False
+                return load_data(idx)
+
+        return self.scan_cache(self.get_scan_id(idx), idx)
+
+    def get_scan_id(self, idx):
+        """Returns the id of a datum in the scan cache, which changes when
+        the file of the datum or SCAN_CACHE_VERSION changes."""
+        attr = self.get_attr(idx)
+        key = [SCAN_CACHE_VERSION, attr.get('path', None)]
+        try:
+            stat = os.stat(attr['path'])
+            key += [stat.st_mtime_ns, stat.st_size]
+        except (KeyError, TypeError, OSError):
+            pass
+        return '{}_{}'.format(attr['name'], get_hash(str(key)))
 
     @abstractmethod
     def __len__(self):
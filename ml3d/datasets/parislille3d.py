@@ -10,8 +10,9 @@ from sklearn.neighbors import KDTree
 from tqdm import tqdm
 import logging
 
-from .base_dataset import BaseDataset
-from ..utils import make_dir, DATASET
+from .base_dataset import BaseDataset, BaseDatasetSplit
+from ..utils import make_dir, list_dir, DATASET
+from ..utils.ply import read_ply_memmap, get_ply_fields
 
 logging.basicConfig(
     level=logging.INFO,
@@ -65,17 +66,30 @@ class ParisLille3D(BaseDataset):
         self.label_to_idx = {l: i for i, l in enumerate(self.label_values)}
         self.ignored_labels = np.array([0])
 
-        train_path = cfg.dataset_path + "/training_10_classes/"
-        self.train_files = glob.glob(train_path + "/*.ply")
+        # Listed when a split is first requested.
+        self.train_files = None
+        self.val_files = None
+        self.test_files = None
+
+    def list_files(self):
+        """List the ply files of the training, validation and test split."""
+        cfg = self.cfg
+
+        def list_ply(path):
+            if not exists(path):
+                return []
+            return [
+                join(path, f)
+                for f in list_dir(path, cfg.cache_dir)
+                if f.endswith('.ply')
+            ]
+
+        train_files = list_ply(join(cfg.dataset_path, "training_10_classes"))
         self.val_files = [
-            f for f in self.train_files if Path(f).name in cfg.val_files
+            f for f in train_files if Path(f).name in cfg.val_files
         ]
-        self.train_files = [
-            f for f in self.train_files if f not in self.val_files
-        ]
-
-        test_path = cfg.dataset_path + "/test_10_classes/"
-        self.test_files = glob.glob(test_path + '*.ply')
+        self.train_files = [f for f in train_files if f not in self.val_files]
+        self.test_files = list_ply(join(cfg.dataset_path, "test_10_classes"))
 
     @staticmethod
     def get_label_to_names():
@@ -97,6 +111,9 @@ class ParisLille3D(BaseDataset):
         return ParisLille3DSplit(self, split=split)
 
     def get_split_list(self, split):
+        if self.train_files is None:
+            self.list_files()
+
         if split in ['test', 'testing']:
             files = self.test_files
         elif split in ['train', 'training']:
@@ -135,29 +152,27 @@ class ParisLille3D(BaseDataset):
         log.info("Saved {} in {}.".format(name, store_path))
 
 
-class ParisLille3DSplit():
+class ParisLille3DSplit(BaseDatasetSplit):
 
     def __init__(self, dataset, split='training'):
-        self.cfg = dataset.cfg
+        super().__init__(dataset, split=split)
         path_list = dataset.get_split_list(split)
         log.info("Found {} pointclouds for {}".format(len(path_list), split))
 
         self.path_list = path_list
-        self.split = split
-        self.dataset = dataset
 
     def __len__(self):
         return len(self.path_list)
 
     def get_data(self, idx):
+        return self.get_cached_data(idx, self.read_data)
+
+    def read_data(self, idx):
         pc_path = self.path_list[idx]
         log.debug("get_data called {}".format(pc_path))
-        data = PlyData.read(pc_path)['vertex']
+        data = read_ply_memmap(pc_path)
 
-        points = np.zeros((data['x'].shape[0], 3), dtype=np.float32)
-        points[:, 0] = data['x']
-        points[:, 1] = data['y']
-        points[:, 2] = data['z']
+        points = get_ply_fields(data, ['x', 'y', 'z'])
 
         if (self.split != 'test'):
             labels = np.array(data['class'], dtype=np.int32).reshape((-1,))
@@ -5,14 +5,17 @@ from pathlib import Path
 from os.path import join, exists, dirname, abspath
 from tqdm import tqdm
 import random
+import shutil
+from multiprocessing import Pool
 from plyfile import PlyData, PlyElement
 from sklearn.neighbors import KDTree
 from tqdm import tqdm
 import logging
 
 from .utils import DataProcessing
-from .base_dataset import BaseDataset
-from ..utils import make_dir, DATASET
+from .base_dataset import BaseDataset, BaseDatasetSplit
+from ..utils import make_dir, list_dir, DATASET
+from ..utils.ply import read_ply_memmap, get_ply_fields
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,6 +23,9 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+# Dataset paths whose rooms without ply files and annotations were reported.
+_reported_missing_rooms = set()
+
 
 class S3DIS(BaseDataset):
     """
@@ -71,14 +77,42 @@ class S3DIS(BaseDataset):
 
         self.pc_path = join(self.cfg.dataset_path, 'original_ply')
 
-        if not exists(self.pc_path):
-            print("creating dataset")
-            self.create_ply_files(self.cfg.dataset_path, self.label_to_names)
-
-        # TODO : if num of ply files < 272, then create.
+        # Listed when a split is first requested.
+        self._all_files = None
+
+    @property
+    def all_files(self):
+        """The ply files of all rooms, created from the raw data if needed."""
+        if self._all_files is None:
+            dataset_path = self.cfg.dataset_path
+            ply_files = set(self.list_ply_files())
+            missing = [
+                p for p in self.get_annotation_paths(dataset_path)
+                if join(self.pc_path, self.get_room_name(p)) not in ply_files
+            ]
 
-        self.all_files = glob.glob(
-            str(Path(self.cfg.dataset_path) / 'original_ply' / '*.ply'))
+            # Only rooms with raw annotations can be converted.
+            if any(exists(str(p)) for p in missing):
+                log.info("Creating ply files of {} rooms".format(len(missing)))
+                self.create_ply_files(dataset_path, self.label_to_names)
+                ply_files = set(self.list_ply_files())
+            elif (len(missing) > 0 and
+                  dataset_path not in _reported_missing_rooms):
+                _reported_missing_rooms.add(dataset_path)
+                log.warning("{} rooms have neither a ply file nor annotations, "
+                            "e.g. {}".format(len(missing), missing[0]))
+
+            self._all_files = sorted(ply_files)
+        return self._all_files
+
+    def list_ply_files(self):
+        if not exists(self.pc_path):
+            return []
+        return [
+            join(self.pc_path, f)
+            for f in list_dir(self.pc_path, self.cfg.cache_dir)
+            if f.endswith('.ply')
+        ]
 
     @staticmethod
     def get_label_to_names():
@@ -283,73 +317,124 @@ class S3DIS(BaseDataset):
         return lines
 
     @staticmethod
-    def create_ply_files(dataset_path, class_names):
-        os.makedirs(join(dataset_path, 'original_ply'), exist_ok=True)
+    def get_annotation_paths(dataset_path):
         anno_file = Path(abspath(
             __file__)).parent / '_resources' / 's3dis_annotation_paths.txt'
-        print(anno_file)
-        anno_file = str(anno_file)
-        anno_paths = [line.rstrip() for line in open(anno_file)]
-        anno_paths = [Path(dataset_path) / p for p in anno_paths]
+        anno_paths = [line.rstrip() for line in open(str(anno_file))]
+        return [Path(dataset_path) / p for p in anno_paths if p]
 
-        class_names = [val for key, val in class_names.items()]
-        label_to_idx = {l: i for i, l in enumerate(class_names)}
-
-        out_format = '.ply'  # TODO : Use from config.
-
-        for anno_path in tqdm(anno_paths):
-            elems = str(anno_path).split('/')
-            save_path = elems[-3] + '_' + elems[-2] + out_format
-            save_path = Path(dataset_path) / 'original_ply' / save_path
-
-            data_list = []
-            for file in glob.glob(str(anno_path / '*.txt')):
-                class_name = Path(file).name.split('_')[0]
-                if class_name not in class_names:
-                    class_name = 'clutter'
+    @staticmethod
+    def get_room_name(anno_path):
+        """Name of the ply file of the room of an annotation path."""
+        elems = str(anno_path).split('/')
+        return elems[-3] + '_' + elems[-2] + '.ply'
 
-                pc = pd.read_csv(file, header=None,
-                                 delim_whitespace=True).values
-                labels = np.ones((pc.shape[0], 1)) * label_to_idx[class_name]
-                data_list.append(np.concatenate([pc, labels], 1))
+    @staticmethod
+    def create_ply_files(dataset_path, class_names, num_workers=None):
+        """
+        Convert the per object annotations of every room into one ply file.
+        Rooms are converted in parallel and rooms that already have a ply
+        file are skipped, so an interrupted conversion can be resumed.
 
-            pc_label = np.concatenate(data_list, 0)
+        Args:
+            dataset_path: path to the dataset.
+            class_names: dict of label to class name.
+            num_workers: number of processes, by default the number of cpus.
+        """
+        out_path = join(dataset_path, 'original_ply')
+        tmp_path = join(out_path, '.tmp')
+        os.makedirs(tmp_path, exist_ok=True)
+        anno_paths = S3DIS.get_annotation_paths(dataset_path)
 
-            xyz = pc_label[:, :3].astype(np.float32)
-            colors = pc_label[:, 3:6].astype(np.uint8)
-            labels = pc_label[:, 6].astype(np.uint8)
+        class_names = [val for key, val in class_names.items()]
+        label_to_idx = {l: i for i, l in enumerate(class_names)}
 
-            S3DIS.write_ply(str(save_path), (xyz, colors, labels),
-                            ['x', 'y', 'z', 'red', 'green', 'blue', 'class'])
+        jobs = []
+        missing = []
+        for anno_path in anno_paths:
+            save_name = S3DIS.get_room_name(anno_path)
+            if exists(join(out_path, save_name)):
+                continue
+            if not exists(str(anno_path)):
+                missing.append(str(anno_path))
+                continue
+            jobs.append((str(anno_path), join(out_path, save_name),
+                         join(tmp_path, save_name), label_to_idx))
+
+        if len(missing) > 0:
+            log.warning("Skipping {} rooms without annotations, e.g. {}".format(
+                len(missing), missing[0]))
+
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = max(1, min(num_workers, len(jobs)))
+
+        if num_workers == 1:
+            for job in tqdm(jobs):
+                S3DIS.create_room_ply(job)
+        else:
+            with Pool(num_workers) as pool:
+                for _ in tqdm(pool.imap_unordered(S3DIS.create_room_ply, jobs),
+                              total=len(jobs)):
+                    pass
 
+        shutil.rmtree(tmp_path, ignore_errors=True)
 
-class S3DISSplit():
+    @staticmethod
+    def create_room_ply(job):
+        """Convert the annotations of a single room, see create_ply_files."""
+        anno_path, save_path, tmp_path, label_to_idx = job
+
+        xyz_list, colors_list, labels_list = [], [], []
+        for file in sorted(glob.glob(join(anno_path, '*.txt'))):
+            class_name = Path(file).name.split('_')[0]
+            if class_name not in label_to_idx:
+                class_name = 'clutter'
+
+            pc = pd.read_csv(file,
+                             header=None,
+                             delim_whitespace=True,
+                             dtype=np.float32,
+                             engine='c').values
+            xyz_list.append(pc[:, :3])
+            colors_list.append(pc[:, 3:6].astype(np.uint8))
+            labels_list.append(
+                np.full((pc.shape[0],),
+                        label_to_idx[class_name],
+                        dtype=np.uint8))
+
+        xyz = np.concatenate(xyz_list, 0)
+        colors = np.concatenate(colors_list, 0)
+        labels = np.concatenate(labels_list, 0)
+
+        # Write next to the output and rename, so that a partially written
+        # room is never mistaken for a converted one.
+        S3DIS.write_ply(tmp_path, (xyz, colors, labels),
+                        ['x', 'y', 'z', 'red', 'green', 'blue', 'class'])
+        os.replace(tmp_path, save_path)
+
+
+class S3DISSplit(BaseDatasetSplit):
 
     def __init__(self, dataset, split='training'):
-        self.cfg = dataset.cfg
+        super().__init__(dataset, split=split)
         path_list = dataset.get_split_list(split)
         log.info("Found {} pointclouds for {}".format(len(path_list), split))
 
         self.path_list = path_list
-        self.split = split
-        self.dataset = dataset
 
     def __len__(self):
         return len(self.path_list)
 
     def get_data(self, idx):
-        pc_path = self.path_list[idx]
-        data = PlyData.read(pc_path)['vertex']
+        return self.get_cached_data(idx, self.read_data)
 
-        points = np.zeros((data['x'].shape[0], 3), dtype=np.float32)
-        points[:, 0] = data['x']
-        points[:, 1] = data['y']
-        points[:, 2] = data['z']
+    def read_data(self, idx):
+        pc_path = self.path_list[idx]
+        data = read_ply_memmap(pc_path)
 
-        feat = np.zeros(points.shape, dtype=np.float32)
-        feat[:, 0] = data['red']
-        feat[:, 1] = data['green']
-        feat[:, 2] = data['blue']
+        points = get_ply_fields(data, ['x', 'y', 'z'])
+        feat = get_ply_fields(data, ['red', 'green', 'blue'])
 
         labels = np.array(data['class'], dtype=np.int32).reshape((-1,))
 
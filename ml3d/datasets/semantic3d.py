@@ -5,6 +5,7 @@ from pathlib import Path
 from os.path import join, exists, dirname, abspath
 from tqdm import tqdm
 import random
+import shutil
 from plyfile import PlyData, PlyElement
 from sklearn.neighbors import KDTree
 from tqdm import tqdm
@@ -12,7 +13,7 @@ import logging
 
 from .utils import DataProcessing as DP
 from .base_dataset import BaseDataset
-from ..utils import make_dir, DATASET
+from ..utils import make_dir, list_dir, DATASET
 
 logging.basicConfig(
     level=logging.INFO,
@@ -42,11 +43,18 @@ class Semantic3D(BaseDataset):
                      'sg27_station2_intensity_rgb'
                  ],
                  test_result_folder='./test',
+                 binary_path=None,
+                 convert_to_binary=False,
                  **kwargs):
         """
         Initialize
         Args:
             dataset_path: path to the dataset
+            binary_path: directory of the binary copies of the scans, by
+                default `binary` inside of dataset_path. Scans with a binary
+                copy are memory mapped instead of parsing the text files.
+            convert_to_binary: convert scans without a binary copy the first
+                time they are read.
             kwargs:
         Returns:
             class: The corresponding class.
@@ -60,6 +68,8 @@ class Semantic3D(BaseDataset):
                          ignored_label_inds=ignored_label_inds,
                          val_files=val_files,
                          test_result_folder=test_result_folder,
+                         binary_path=binary_path,
+                         convert_to_binary=convert_to_binary,
                          **kwargs)
 
         cfg = self.cfg
@@ -70,11 +80,38 @@ class Semantic3D(BaseDataset):
         self.label_to_idx = {l: i for i, l in enumerate(self.label_values)}
         self.ignored_labels = np.array([0])
 
-        self.all_files = glob.glob(str(Path(self.cfg.dataset_path) / '*.txt'))
+        if cfg.binary_path is None:
+            self.binary_path = join(cfg.dataset_path, 'binary')
+        else:
+            self.binary_path = cfg.binary_path
+
+        # Listed when a split is first requested.
+        self.all_files = None
+
+    def list_files(self):
+        """List the scans of the training, validation and test split."""
+        cfg = self.cfg
+
+        self.all_files = [
+            str(Path(cfg.dataset_path) / f)
+            for f in list_dir(cfg.dataset_path, cfg.cache_dir)
+            if f.endswith('.txt')
+        ]
+
+        # Scans that only exist as binary copies, e.g. written by
+        # scripts/preprocess_semantic3d.py.
+        if exists(self.binary_path):
+            for name in list_dir(self.binary_path, cfg.cache_dir):
+                pc_path = str(Path(self.cfg.dataset_path) / (name + '.txt'))
+                if (not name.endswith('.tmp') and
+                        pc_path not in self.all_files):
+                    self.all_files.append(pc_path)
 
         self.train_files = [
             f for f in self.all_files if exists(
                 str(Path(f).parent / Path(f).name.replace('.txt', '.labels')))
+            or exists(join(self.binary_path,
+                           Path(f).stem, 'label.npy'))
         ]
         self.test_files = [
             f for f in self.all_files if f not in self.train_files
@@ -111,7 +148,73 @@ class Semantic3D(BaseDataset):
     def get_split(self, split):
         return Semantic3DSplit(self, split=split)
 
+    @staticmethod
+    def convert_to_binary(pc_path, out_dir):
+        """
+        Convert a scan and its labels to a binary columnar layout. Every
+        column is stored as a `.npy` file in out_dir: `point` (float32 xyz),
+        `intensity` (float32), `rgb` (uint8) and `label` (uint8, only if the
+        scan has labels).
+        """
+        pc = pd.read_csv(pc_path,
+                         header=None,
+                         delim_whitespace=True,
+                         dtype=np.float32).values
+
+        labels = None
+        label_path = pc_path.replace(".txt", ".labels")
+        if exists(label_path):
+            labels = pd.read_csv(label_path,
+                                 header=None,
+                                 delim_whitespace=True,
+                                 dtype=np.int32).values.reshape((-1,))
+
+        Semantic3D.write_binary(out_dir, pc[:, 0:3], pc[:, 3], pc[:, 4:7],
+                                labels)
+
+    @staticmethod
+    def write_binary(out_dir, points, intensity, rgb, labels=None):
+        """Write the columns of a scan in the layout of convert_to_binary."""
+        columns = {
+            'point': points.astype(np.float32),
+            'intensity': intensity.astype(np.float32),
+            'rgb': rgb.astype(np.uint8)
+        }
+        if labels is not None:
+            columns['label'] = labels.astype(np.uint8)
+
+        # Write into a temporary directory and rename it, so that readers
+        # never see a partial conversion.
+        tmp_dir = '{}.{}.tmp'.format(out_dir, os.getpid())
+        make_dir(tmp_dir)
+        for key, value in columns.items():
+            np.save(join(tmp_dir, key + '.npy'), value)
+
+        # The output of a previous conversion is replaced. It is moved aside
+        # first, because a directory can not be renamed onto a non-empty one.
+        old_dir = None
+        if exists(out_dir):
+            log.info("Replacing the binary copy {}".format(out_dir))
+            old_dir = '{}.{}.old.tmp'.format(out_dir, os.getpid())
+            os.rename(out_dir, old_dir)
+        os.rename(tmp_dir, out_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir)
+
+    @staticmethod
+    def read_binary(binary_dir):
+        """Memory map the columns written by convert_to_binary."""
+        columns = {}
+        for key in ['point', 'intensity', 'rgb', 'label']:
+            path = join(binary_dir, key + '.npy')
+            if exists(path):
+                columns[key] = np.load(path, mmap_mode='c')
+        return columns
+
     def get_split_list(self, split):
+        if self.all_files is None:
+            self.list_files()
+
         if split in ['test', 'testing']:
             files = self.test_files
         elif split in ['train', 'training']:
@@ -167,6 +270,26 @@ class Semantic3DSplit():
         pc_path = self.path_list[idx]
         log.debug("get_data called {}".format(pc_path))
 
+        binary_dir = join(self.dataset.binary_path, Path(pc_path).stem)
+        if not exists(binary_dir) and self.cfg.convert_to_binary:
+            make_dir(self.dataset.binary_path)
+            Semantic3D.convert_to_binary(pc_path, binary_dir)
+
+        if exists(binary_dir):
+            columns = Semantic3D.read_binary(binary_dir)
+            points = columns['point']
+            if self.split != 'test' and 'label' in columns:
+                labels = columns['label'].astype(np.int32)
+            else:
+                labels = np.zeros((points.shape[0],), dtype=np.int32)
+
+            return {
+                'point': points,
+                'feat': columns['rgb'].astype(np.float32),
+                'intensity': columns['intensity'],
+                'label': labels
+            }
+
         pc = pd.read_csv(pc_path,
                          header=None,
                          delim_whitespace=True,
@@ -3,13 +3,15 @@ import os, argparse, pickle, sys
 from os.path import exists, join, isfile, dirname, abspath, split
 import torch
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import get_worker_info
 
 from sklearn.neighbors import KDTree
 import yaml
 
 from .base_dataset import BaseDataset
 from .utils import DataProcessing
-from ..utils import make_dir, DATASET
+from ..utils import make_dir, list_dir, DATASET
 
 logging.basicConfig(
     level=logging.INFO,
@@ -48,11 +50,20 @@ class SemanticKITTI(BaseDataset):
                      '10', '11', '12', '13', '14', '15', '16', '17', '18', '19',
                      '20', '21'
                  ],
+                 use_memmap=False,
+                 check_labels=False,
+                 readahead=4,
                  **kwargs):
         """
         Initialize
         Args:
             dataset_path (str): path to the dataset
+            use_memmap (bool): map the scans with np.memmap instead of
+                reading them.
+            check_labels (bool): check that the label files only contain
+                semantic and instance ids.
+            readahead (int): number of following scans loaded in the
+                background while a split is accessed sequentially.
             kwargs:
         Returns:
             class: The corresponding class.
@@ -68,6 +79,9 @@ class SemanticKITTI(BaseDataset):
                          training_split=training_split,
                          validation_split=validation_split,
                          all_split=all_split,
+                         use_memmap=use_memmap,
+                         check_labels=check_labels,
+                         readahead=readahead,
                          **kwargs)
 
         cfg = self.cfg
@@ -199,7 +213,7 @@ class SemanticKITTI(BaseDataset):
             pc_path = join(dataset_path, 'dataset', 'sequences', seq_id,
                            'velodyne')
             file_list.append(
-                [join(pc_path, f) for f in np.sort(os.listdir(pc_path))])
+                [join(pc_path, f) for f in list_dir(pc_path, cfg.cache_dir)])
 
         file_list = np.concatenate(file_list, axis=0)
 
@@ -222,12 +236,55 @@ class SemanticKITTISplit():
         self.split = split
         self.dataset = dataset
 
+        self._readahead_pid = None
+        self._executor = None
+        self._futures = {}
+        self._last_idx = -2
+
     def __len__(self):
         return len(self.path_list)
 
+    def __getstate__(self):
+        # The readahead thread is recreated in the process using the split.
+        state = self.__dict__.copy()
+        state.update(_readahead_pid=None, _executor=None, _futures={})
+        return state
+
     def get_data(self, idx):
+        # Data loader workers get their own runs of indices, reading past the
+        # end of a batch would only load scans of other workers.
+        if self.cfg.get('readahead', 0) <= 0 or get_worker_info() is not None:
+            return self.read_data(idx)
+
+        if self._readahead_pid != os.getpid():
+            # Threads do not survive a fork, e.g. into a data loader worker.
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._readahead_pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._futures = {}
+
+        future = self._futures.pop(idx, None)
+        if idx == self._last_idx + 1:
+            # Sequential access, load the next scans in the background.
+            end = min(idx + 1 + self.cfg.readahead, len(self.path_list))
+            for i in range(idx + 1, end):
+                if i not in self._futures:
+                    self._futures[i] = self._executor.submit(self.read_data, i)
+        else:
+            for f in self._futures.values():
+                f.cancel()
+            self._futures = {}
+        self._last_idx = idx
+
+        if future is None:
+            return self.read_data(idx)
+        return future.result()
+
+    def read_data(self, idx):
         pc_path = self.path_list[idx]
-        points = DataProcessing.load_pc_kitti(pc_path)
+        use_memmap = self.cfg.get('use_memmap', False)
+        points = DataProcessing.load_pc_kitti(pc_path, use_memmap=use_memmap)
 
         dir, file = split(pc_path)
         label_path = join(dir, '../labels', file[:-4] + '.label')
@@ -237,8 +294,10 @@ class SemanticKITTISplit():
                 raise FileNotFoundError(f' Label file {label_path} not found')
 
         else:
-            labels = DataProcessing.load_label_kitti(
-                label_path, self.remap_lut_val).astype(np.int32)
+            check = self.cfg.get('check_labels', False)
+            labels = DataProcessing.load_label_kitti(label_path,
+                                                     self.remap_lut_val,
+                                                     check=check)
 
         data = {
             'point': points[:, 0:3],
@@ -10,8 +10,9 @@ from sklearn.neighbors import KDTree
 from tqdm import tqdm
 import logging
 
-from .base_dataset import BaseDataset
+from .base_dataset import BaseDataset, BaseDatasetSplit
 from ..utils import make_dir, DATASET
+from ..utils.ply import read_ply_memmap, get_ply_fields
 
 logging.basicConfig(
     level=logging.INFO,
@@ -64,6 +65,11 @@ class Toronto3D(BaseDataset):
 
         cfg = self.cfg
 
+        if cfg.get('cache_in_memory', False):
+            log.warning("cache_in_memory is deprecated and has no effect, the "
+                        "PLY files are memory mapped. Set scan_cache_mb to "
+                        "cache the converted scans.")
+
         self.label_to_names = self.get_label_to_names()
 
         self.dataset_path = cfg.dataset_path
@@ -141,48 +147,34 @@ class Toronto3D(BaseDataset):
         log.info("Saved {} in {}.".format(name, store_path))
 
 
-class Toronto3DSplit():
+class Toronto3DSplit(BaseDatasetSplit):
 
     def __init__(self, dataset, split='training'):
-        self.cfg = dataset.cfg
+        super().__init__(dataset, split=split)
         path_list = dataset.get_split_list(split)
         log.info("Found {} pointclouds for {}".format(len(path_list), split))
 
         self.path_list = path_list
-        self.split = split
-        self.dataset = dataset
 
         self.UTM_OFFSET = [627285, 4841948, 0]
 
-        self.cache_in_memory = self.cfg.get('cache_in_memory', False)
-        if self.cache_in_memory:
-            self.data_list = [None] * len(self.path_list)
-
     def __len__(self):
         return len(self.path_list)
 
     def get_data(self, idx):
+        return self.get_cached_data(idx, self.read_data)
+
+    def read_data(self, idx):
         pc_path = self.path_list[idx]
         log.debug("get_data called {}".format(pc_path))
 
-        if self.cache_in_memory:
-            if self.data_list[idx] is not None:
-                data = self.data_list[idx]
-            else:
-                data = PlyData.read(pc_path)['vertex']
-                self.data_list[idx] = data
-        else:
-            data = PlyData.read(pc_path)['vertex']
+        data = read_ply_memmap(pc_path)
 
-        points = np.vstack(
-            (data['x'], data['y'], data['z'])).astype(np.float64).T
-        points = points - self.UTM_OFFSET
+        points = get_ply_fields(data, ['x', 'y', 'z'], dtype=np.float64)
+        points -= self.UTM_OFFSET
         points = np.float32(points)
 
-        feat = np.zeros(points.shape, dtype=np.float32)
-        feat[:, 0] = data['red']
-        feat[:, 1] = data['green']
-        feat[:, 2] = data['blue']
+        feat = get_ply_fields(data, ['red', 'green', 'blue'])
 
         labels = np.array(data['scalar_Label'], dtype=np.int32)
 
@@ -63,20 +63,28 @@ class DataProcessing:
         return cloud_labels
 
     @staticmethod
-    def load_pc_kitti(pc_path):
-        scan = np.fromfile(pc_path, dtype=np.float32)
+    def load_pc_kitti(pc_path, use_memmap=False):
+        """
+        Load a SemanticKITTI scan. With use_memmap the file is mapped
+        copy-on-write instead of read, pages are loaded on first access.
+        """
+        if use_memmap:
+            scan = np.memmap(pc_path, dtype=np.float32, mode='c')
+        else:
+            scan = np.fromfile(pc_path, dtype=np.float32)
         scan = scan.reshape((-1, 4))
         # points = scan[:, 0:3]  # get xyz
         points = scan
         return points
 
     @staticmethod
-    def load_label_kitti(label_path, remap_lut):
+    def load_label_kitti(label_path, remap_lut, check=False):
         label = np.fromfile(label_path, dtype=np.uint32)
         label = label.reshape((-1))
         sem_label = label & 0xFFFF  # semantic label in lower half
-        inst_label = label >> 16  # instance id in upper half
-        assert ((sem_label + (inst_label << 16) == label).all())
+        if check:
+            inst_label = label >> 16  # instance id in upper half
+            assert ((sem_label + (inst_label << 16) == label).all())
         sem_label = remap_lut[sem_label]
         return sem_label.astype(np.int32)
 
@@ -95,6 +103,49 @@ class DataProcessing:
 
         return neighbor_idx.astype(np.int32)
 
+    @staticmethod
+    def knn_hierarchy(points, k, sub_sampling_ratio):
+        """
+        Neighbor indices for all levels of a point cloud that is subsampled by
+        keeping a prefix of the points at every level, as done by RandLANet.
+        The upsampling indices are read from the knn graph of the level, only
+        points without a neighbor in the subsampled cloud are searched again.
+        :param points: points of the first level, N*3
+        :param k: Number of neighbours in knn search
+        :param sub_sampling_ratio: subsampling ratio of every level
+        :return: points, neighbors, pools and up_samples, one array per level
+        """
+        input_points = []
+        input_neighbors = []
+        input_pools = []
+        input_up_samples = []
+
+        pc = points
+        for ratio in sub_sampling_ratio:
+            neighbour_idx = DataProcessing.knn_search(pc, pc, k)
+
+            num_sub = pc.shape[0] // ratio
+            sub_points = pc[:num_sub, :]
+            pool_i = neighbour_idx[:num_sub, :]
+
+            # Neighbors are sorted by distance and the subsampled cloud is a
+            # subset of pc, so the first neighbor inside of it is the nearest.
+            in_sub = neighbour_idx < num_sub
+            first = np.argmax(in_sub, axis=1)
+            up_i = neighbour_idx[np.arange(pc.shape[0]), first]
+            missing = ~in_sub[np.arange(pc.shape[0]), first]
+            if np.any(missing):
+                up_i[missing] = DataProcessing.knn_search(
+                    sub_points, pc[missing], 1)[:, 0]
+
+            input_points.append(pc)
+            input_neighbors.append(neighbour_idx)
+            input_pools.append(pool_i)
+            input_up_samples.append(up_i.reshape(-1, 1))
+            pc = sub_points
+
+        return input_points, input_neighbors, input_pools, input_up_samples
+
     @staticmethod
     def data_aug(xyz, color, labels, idx, num_out):
         num_in = len(xyz)
@@ -149,6 +200,27 @@ class DataProcessing:
         IoU += mask * mIoU
         return IoU
 
+    @staticmethod
+    def get_label_lut(num_classes, ignored_label_inds):
+        """
+        Lookup table mapping dataset labels to the range of the logits
+        :param num_classes: number of classes predicted by the model
+        :param ignored_label_inds: labels that are not predicted
+        :return: int64 array indexed by label, ignored labels map to -1
+        """
+        # Reduce label values in the range of logit shape
+        reducing_list = np.arange(0, num_classes, dtype=np.int64)
+        inserted_value = np.zeros([1], dtype=np.int64)
+
+        for ign_label in ignored_label_inds:
+            reducing_list = np.concatenate([
+                reducing_list[:ign_label], inserted_value,
+                reducing_list[ign_label:]
+            ], 0)
+
+        reducing_list[list(ignored_label_inds)] = -1
+        return reducing_list
+
     @staticmethod
     def get_class_weights(num_per_class):
         # pre-calculate the number of points in each category
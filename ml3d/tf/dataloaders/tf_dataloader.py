@@ -6,7 +6,7 @@ import random
 
 import tensorflow as tf
 import numpy as np
-from ...utils import Cache, get_hash
+from ...utils import Cache, MemmapCache, get_cache_key
 
 from ...datasets.utils import DataProcessing
 from sklearn.neighbors import KDTree
@@ -51,23 +51,30 @@ class TFDataloader():
 
             assert cache_dir is not None, 'cache directory is not given'
 
-            self.cache_convert = Cache(self.preprocess,
-                                       cache_dir=cache_dir,
-                                       cache_key=get_hash(
-                                           repr(self.preprocess)[:-15]))
+            cache_cls = MemmapCache if dataset.cfg.get(
+                'cache_format', 'npy') == 'memmap' else Cache
+            self.cache_convert = cache_cls(
+                self.preprocess,
+                cache_dir=cache_dir,
+                cache_key=get_cache_key(self.preprocess, dataset.cfg,
+                                        cache_cls.ext),
+                max_memory=int(
+                    dataset.cfg.get('cache_memory_mb', 0) * 1024 * 1024),
+                verify=dataset.cfg.get('cache_verify', False))
 
             uncached = [
                 idx for idx in range(len(dataset)) if dataset.get_attr(idx)
                 ['name'] not in self.cache_convert.cached_ids
             ]
             if len(uncached) > 0:
-                print("cache key : {}".format(repr(self.preprocess)[:-15]))
-                for idx in tqdm(range(len(dataset)), desc='preprocess'):
+                print("cache key : {}".format(self.cache_convert.cache_key))
+                for idx in tqdm(uncached, desc='preprocess'):
                     attr = dataset.get_attr(idx)
                     data = dataset.get_data(idx)
                     name = attr['name']
 
                     self.cache_convert(name, data, attr)
+                self.cache_convert.save_manifest()
 
         else:
             self.cache_convert = None
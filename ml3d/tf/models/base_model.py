@@ -48,6 +48,17 @@ class BaseModel(ABC, tf.keras.Model):
 
         return
 
+    def get_preprocess_cfg(self):
+        """Returns the config values the output of preprocess depends on.
+
+        They are used to derive the key of the preprocessing cache. By default
+        the whole model config is used.
+
+        Returns:
+            A dict of config values.
+        """
+        return dict(self.cfg)
+
     @abstractmethod
     def preprocess(self, data, attr):
         """Data preprocessing function.
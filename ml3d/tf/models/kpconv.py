@@ -820,6 +820,8 @@ class KPFCNN(BaseModel):
 
             input_points = points[input_inds].copy() - pick_point
             feat = data['feat']
+            if feat is not None:
+                feat = feat[input_inds]
 
             t_normalize = self.cfg.get('t_normalize', None)
             input_points, feat = trans_normalize(input_points, feat,
@@ -828,7 +830,7 @@ class KPFCNN(BaseModel):
             if feat is None:
                 coords = input_points
             else:
-                coords = np.hstack((input_points, feat[input_inds]))
+                coords = np.hstack((input_points, feat))
 
             coords[:, 2] += pick_point[:, 2]
 
@@ -862,6 +864,9 @@ class KPFCNN(BaseModel):
             is_test=True)
         return input_list, np.array(point_inds[0]), np.array(stacks_lengths[0])
 
+    def get_preprocess_cfg(self):
+        return {'first_subsampling_dl': self.cfg.first_subsampling_dl}
+
     def preprocess(self, data, attr):
         cfg = self.cfg
 
@@ -971,6 +976,8 @@ class KPFCNN(BaseModel):
                 # Collect points and colors
                 input_points = points[input_inds].copy() - pick_point
                 feat = data['feat']
+                if feat is not None:
+                    feat = feat[input_inds]
 
                 t_normalize = self.cfg.get('t_normalize', None)
                 input_points, feat = trans_normalize(input_points, feat,
@@ -979,7 +986,7 @@ class KPFCNN(BaseModel):
                 if feat is None:
                     coords = input_points.copy()
                 else:
-                    coords = np.hstack((input_points, feat[input_inds]))
+                    coords = np.hstack((input_points, feat))
 
                 coords[:, 2] += pick_point[:, 2]
 
@@ -373,9 +373,10 @@ class RandLANet(BaseModel):
             for i in range(n_iters):
                 data, attr = dataset.read_data(i % dataset.num_pc)
 
-                pc = data['point'].copy()
-                label = data['label'].copy()
-                feat = data['feat'].copy() if data['feat'] is not None else None
+                # trans_crop_pc gathers copies, the full cloud is not copied here.
+                pc = data['point']
+                label = data['label']
+                feat = data['feat']
                 tree = data['search_tree']
 
                 pick_idx = np.random.choice(len(pc), 1)
@@ -414,9 +415,10 @@ class RandLANet(BaseModel):
         cfg = self.cfg
         inputs = dict()
 
-        pc = data['point'].copy()
-        label = data['label'].copy()
-        feat = data['feat'].copy() if data['feat'] is not None else None
+        # trans_crop_pc gathers copies, the full cloud is not copied here.
+        pc = data['point']
+        label = data['label']
+        feat = data['feat']
         tree = data['search_tree']
 
         pick_idx = min_posbility_idx
@@ -446,27 +448,16 @@ class RandLANet(BaseModel):
             1], "Wrong feature dimension, please update dim_input(3 + feature_dimension) in config"
 
         features = feat
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_up_samples = []
-
-        for i in range(cfg.num_layers):
-            neighbour_idx = DataProcessing.knn_search(pc, pc, cfg.k_n)
-
-            sub_points = pc[:pc.shape[0] // cfg.sub_sampling_ratio[i], :]
-            pool_i = neighbour_idx[:pc.shape[0] // cfg.sub_sampling_ratio[i], :]
-            up_i = DataProcessing.knn_search(sub_points, pc, 1)
-            input_points.append(pc)
-            input_neighbors.append(neighbour_idx.astype(np.int64))
-            input_pools.append(pool_i.astype(np.int64))
-            input_up_samples.append(up_i.astype(np.int64))
-            pc = sub_points
+        input_points, input_neighbors, input_pools, input_up_samples = \
+            DataProcessing.knn_hierarchy(
+                pc, cfg.k_n, cfg.sub_sampling_ratio[:cfg.num_layers])
 
         inputs['xyz'] = input_points
-        inputs['neigh_idx'] = input_neighbors
-        inputs['sub_idx'] = input_pools
-        inputs['interp_idx'] = input_up_samples
+        inputs['neigh_idx'] = [arr.astype(np.int64) for arr in input_neighbors]
+        inputs['sub_idx'] = [arr.astype(np.int64) for arr in input_pools]
+        inputs['interp_idx'] = [
+            arr.astype(np.int64) for arr in input_up_samples
+        ]
         inputs['features'] = features
 
         inputs['labels'] = label.astype(np.int64)
@@ -479,20 +470,26 @@ class RandLANet(BaseModel):
         pc = pc
         feat = feat
 
+        def knn_hierarchy(pc):
+            _, neighbors, _, up_samples = DataProcessing.knn_hierarchy(
+                pc, cfg.k_n, cfg.sub_sampling_ratio[:cfg.num_layers])
+            return neighbors + up_samples
+
+        knn_outputs = tf.numpy_function(knn_hierarchy, [pc],
+                                        [tf.int32] * (2 * cfg.num_layers))
+
         input_points = []
         input_neighbors = []
         input_pools = []
         input_up_samples = []
 
         for i in range(cfg.num_layers):
-            neighbour_idx = tf.numpy_function(DataProcessing.knn_search,
-                                              [pc, pc, cfg.k_n], tf.int32)
+            neighbour_idx = knn_outputs[i]
 
             sub_points = pc[:tf.shape(pc)[0] // cfg.sub_sampling_ratio[i], :]
             pool_i = neighbour_idx[:tf.shape(pc)[0] //
                                    cfg.sub_sampling_ratio[i], :]
-            up_i = tf.numpy_function(DataProcessing.knn_search,
-                                     [sub_points, pc, 1], tf.int32)
+            up_i = knn_outputs[cfg.num_layers + i]
             input_points.append(pc)
             input_neighbors.append(neighbour_idx)
             input_pools.append(pool_i)
@@ -552,6 +549,9 @@ class RandLANet(BaseModel):
         else:
             return False
 
+    def get_preprocess_cfg(self):
+        return {'grid_size': self.cfg.grid_size}
+
     def preprocess(self, data, attr):
         cfg = self.cfg
 
@@ -29,6 +29,7 @@ from os import makedirs
 from os.path import join, exists
 
 from .....utils.ply import read_ply, write_ply
+from .....utils.kernel_dispositions import get_kernel_disposition
 
 # ------------------------------------------------------------------------------------------
 #
@@ -180,20 +181,20 @@ def spherical_Lloyd(radius,
         differences = np.expand_dims(X, 1) - kernel_points
         sq_distances = np.sum(np.square(differences), axis=2)
 
-        # Compute cell centers
+        # Compute cell centers, cells without points keep their kernel point
         cell_inds = np.argmin(sq_distances, axis=1)
-        centers = []
-        for c in range(num_cells):
-            bool_c = (cell_inds == c)
-            num_c = np.sum(bool_c.astype(np.int32))
-            if num_c > 0:
-                centers.append(np.sum(X[bool_c, :], axis=0) / num_c)
-            else:
-                warning = True
-                centers.append(kernel_points[c])
+        num_c = np.bincount(cell_inds, minlength=num_cells)
+        sum_c = np.stack([
+            np.bincount(cell_inds, weights=X[:, d], minlength=num_cells)
+            for d in range(dimension)
+        ], 1)
+        empty_c = num_c == 0
+        if np.any(empty_c):
+            warning = True
+        centers = np.where(empty_c[:, None], kernel_points,
+                           sum_c / np.maximum(num_c, 1)[:, None])
 
         # Update kernel points with low pass filter to smooth mote carlo
-        centers = np.vstack(centers)
         moves = (1 - momentum) * (centers - kernel_points)
         kernel_points += moves
 
@@ -347,11 +348,11 @@ def kernel_point_optimization_debug(radius,
         # *****************
 
         # Derivative of the sum of potentials of all points
-        A = np.expand_dims(kernel_points, axis=2)
-        B = np.expand_dims(kernel_points, axis=1)
-        interd2 = np.sum(np.power(A - B, 2), axis=-1)
-        inter_grads = (A - B) / (np.power(np.expand_dims(interd2, -1), 3 / 2) +
-                                 1e-6)
+        differences = (np.expand_dims(kernel_points, axis=2) -
+                       np.expand_dims(kernel_points, axis=1))
+        interd2 = np.sum(np.square(differences), axis=-1)
+        inter_grads = differences / np.expand_dims(
+            interd2 * np.sqrt(interd2) + 1e-6, -1)
         inter_grads = np.sum(inter_grads, axis=1)
 
         # Derivative of the radius potential
@@ -367,7 +368,7 @@ def kernel_point_optimization_debug(radius,
         # **************
 
         # Compute norm of gradients
-        gradients_norms = np.sqrt(np.sum(np.power(gradients, 2), axis=-1))
+        gradients_norms = np.sqrt(np.sum(np.square(gradients), axis=-1))
         saved_gradient_norms[iter, :] = np.max(gradients_norms, axis=1)
 
         # Stop if all moving points are gradients fixed (low gradients diff)
@@ -430,51 +431,36 @@ def kernel_point_optimization_debug(radius,
 
 def load_kernels(radius, num_kpoints, dimension, fixed, lloyd=False):
 
-    # Kernel directory
-    kernel_dir = 'kernels/dispositions'
-    if not exists(kernel_dir):
-        makedirs(kernel_dir)
-
     # To many points switch to Lloyds
     if num_kpoints > 30:
         lloyd = True
 
-    # Kernel_file
-    kernel_file = join(
-        kernel_dir, 'k_{:03d}_{:s}_{:d}D.ply'.format(num_kpoints, fixed,
-                                                     dimension))
-
-    # Check if already done
-    if not exists(kernel_file):
+    def create_kernel_points():
         if lloyd:
             # Create kernels
-            kernel_points = spherical_Lloyd(1.0,
-                                            num_kpoints,
-                                            dimension=dimension,
-                                            fixed=fixed,
-                                            verbose=0)
-
-        else:
-            # Create kernels
-            kernel_points, grad_norms = kernel_point_optimization_debug(
-                1.0,
-                num_kpoints,
-                num_kernels=100,
-                dimension=dimension,
-                fixed=fixed,
-                verbose=0)
-
-            # Find best candidate
-            best_k = np.argmin(grad_norms[-1, :])
-
-            # Save points
-            kernel_points = kernel_points[best_k, :, :]
-
-        write_ply(kernel_file, kernel_points, ['x', 'y', 'z'])
-
-    else:
-        data = read_ply(kernel_file)
-        kernel_points = np.vstack((data['x'], data['y'], data['z'])).T
+            return spherical_Lloyd(1.0,
+                                   num_kpoints,
+                                   dimension=dimension,
+                                   fixed=fixed,
+                                   verbose=0)
+
+        # Create kernels
+        kernel_points, grad_norms = kernel_point_optimization_debug(
+            1.0,
+            num_kpoints,
+            num_kernels=100,
+            dimension=dimension,
+            fixed=fixed,
+            verbose=0)
+
+        # Find best candidate
+        best_k = np.argmin(grad_norms[-1, :])
+
+        # Save points
+        return kernel_points[best_k, :, :]
+
+    kernel_points = get_kernel_disposition(num_kpoints, fixed, dimension,
+                                           create_kernel_points)
 
     # Random roations for the kernel
     # N.B. 4D random rotations not supported yet
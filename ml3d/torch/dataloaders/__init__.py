@@ -2,6 +2,9 @@
 
 from .torch_dataloader import TorchDataloader
 from .default_batcher import DefaultBatcher
-from .concat_batcher import ConcatBatcher
+from .concat_batcher import ConcatBatcher, PointBudgetBatchSampler
 
-__all__ = ['TorchDataloader', 'DefaultBatcher', 'ConcatBatcher']
+__all__ = [
+    'TorchDataloader', 'DefaultBatcher', 'ConcatBatcher',
+    'PointBudgetBatchSampler'
+]
@@ -1,4 +1,5 @@
 # Common libs
+import collections
 import time
 import numpy as np
 import pickle
@@ -26,7 +27,6 @@ class CustomBatch:
             class: The corresponding class.
         """
 
-        self.neighborhood_limits = []
         p_list = []
         f_list = []
         l_list = []
@@ -39,18 +39,31 @@ class CustomBatch:
         val_labels_list = []
         batch_n = 0
 
+        # Number of points of every sample kept in the batch
+        self.sample_lengths = []
+
         self.cfg = batches[0]['data']['cfg']
         batch_limit = int(self.cfg.batch_limit)
 
+        # Batches of the PointBudgetBatchSampler are sized on estimates, they
+        # may exceed the limit by a headroom before samples are dropped.
+        if self.cfg.get('point_budget_sampler', False):
+            batch_limit = int(batch_limit *
+                              self.cfg.get('batch_limit_headroom', 1.2))
+
+        # Calibrated by KPFCNN.calibrate_neighborhood_limits
+        self.neighborhood_limits = self.cfg.get('neighborhood_limits', [])
+
         for batch in batches:
             # Stack batch
             data = batch['data']
 
-            for p in data['p_list']:
-                batch_n += p.shape[0]
-            if batch_n > batch_limit:
+            sample_n = sum(p.shape[0] for p in data['p_list'])
+            batch_n += sample_n
+            if batch_n > batch_limit and len(p_list) > 0:
                 break
 
+            self.sample_lengths.append(sample_n)
             p_list += data['p_list']
             f_list += data['f_list']
             l_list += data['l_list']
@@ -327,22 +340,43 @@ class CustomBatch:
 
         return self
 
-    def to(self, device):
+    def to(self, device, non_blocking=False):
+        """
+        Move the batch to a device. With non_blocking the copies from pinned
+        memory are asynchronous with respect to the host.
+        """
 
-        self.points = [in_tensor.to(device) for in_tensor in self.points]
-        self.neighbors = [in_tensor.to(device) for in_tensor in self.neighbors]
-        self.pools = [in_tensor.to(device) for in_tensor in self.pools]
-        self.upsamples = [in_tensor.to(device) for in_tensor in self.upsamples]
-        self.lengths = [in_tensor.to(device) for in_tensor in self.lengths]
-        self.features = self.features.to(device)
-        self.labels = self.labels.to(device)
-        self.scales = self.scales.to(device)
-        self.rots = self.rots.to(device)
-        self.frame_inds = self.frame_inds.to(device)
-        self.frame_centers = self.frame_centers.to(device)
+        def to(in_tensor):
+            return in_tensor.to(device, non_blocking=non_blocking)
+
+        self.points = [to(in_tensor) for in_tensor in self.points]
+        self.neighbors = [to(in_tensor) for in_tensor in self.neighbors]
+        self.pools = [to(in_tensor) for in_tensor in self.pools]
+        self.upsamples = [to(in_tensor) for in_tensor in self.upsamples]
+        self.lengths = [to(in_tensor) for in_tensor in self.lengths]
+        self.features = to(self.features)
+        self.labels = to(self.labels)
+        self.scales = to(self.scales)
+        self.rots = to(self.rots)
+        self.frame_inds = to(self.frame_inds)
+        self.frame_centers = to(self.frame_centers)
 
         return self
 
+    def record_stream(self, stream):
+        """
+        Mark the tensors as used by a CUDA stream, so their memory is not
+        reused before the work queued on that stream is done.
+        """
+        tensors = self.points + self.neighbors + self.pools + self.upsamples
+        tensors += self.lengths
+        tensors += [
+            self.features, self.labels, self.scales, self.rots, self.frame_inds,
+            self.frame_centers
+        ]
+        for in_tensor in tensors:
+            in_tensor.record_stream(stream)
+
     def unstack_points(self, layer=None):
         """Unstack the points"""
         return self.unstack_elements('points', layer)
@@ -406,6 +440,89 @@ class CustomBatch:
         return all_p_list
 
 
+class PointBudgetBatchSampler(Sampler):
+    """
+    Batch sampler assembling batches by a budget of points instead of a fixed
+    number of samples. Samples are added to a batch as long as their estimated
+    number of points fits in `batch_limit`, so that the CustomBatch does not
+    drop transformed samples.
+
+    Transformed samples have no fixed size, the estimate of every sample is
+    the running mean of its real sizes, which the training loop reports with
+    `update` for every batch it receives.
+    """
+
+    def __init__(self, data_source, batch_limit, num_points, shuffle=True):
+        """
+        Initialize
+
+        Args:
+            data_source: The dataset to sample from, e.g. a TorchDataloader.
+            batch_limit: Maximum number of points of a batch.
+            num_points: Estimated number of points of the samples, a number
+                or an array with an estimate for every index.
+            shuffle: Shuffle the samples at every epoch.
+
+        Returns:
+            class: The corresponding class.
+        """
+        self.data_source = data_source
+        self.batch_limit = batch_limit
+        self.num_points = np.empty(len(data_source), dtype=np.float64)
+        self.num_points[:] = num_points
+        # The initial estimate counts as one observation
+        self.num_updates = np.ones(len(data_source), dtype=np.int64)
+        self.shuffle = shuffle
+
+        # Batches yielded but not reported by update yet, in order
+        self.pending = collections.deque()
+
+    def __iter__(self):
+        self.pending.clear()
+        if self.shuffle:
+            order = np.random.permutation(len(self.data_source))
+        else:
+            order = np.arange(len(self.data_source))
+
+        batch = []
+        batch_n = 0
+        for idx in order:
+            n = self.num_points[idx]
+            # A batch has at least one sample, even above the limit
+            if len(batch) > 0 and batch_n + n > self.batch_limit:
+                self.pending.append(batch)
+                yield batch
+                batch = []
+                batch_n = 0
+            batch.append(int(idx))
+            batch_n += n
+        if len(batch) > 0:
+            self.pending.append(batch)
+            yield batch
+
+    def update(self, sample_lengths):
+        """
+        Report the real number of points of the samples of the oldest batch
+        not reported yet. DataLoaders keep the order of the batches, so this
+        is the batch the training loop just received.
+
+        Args:
+            sample_lengths: Number of points of the samples of the batch, in
+                order. Samples dropped by the batcher are missing at the end.
+        """
+        if len(self.pending) == 0:
+            return
+        batch = self.pending.popleft()
+        for idx, n in zip(batch, sample_lengths):
+            self.num_updates[idx] += 1
+            self.num_points[idx] += (
+                n - self.num_points[idx]) / self.num_updates[idx]
+
+    def __len__(self):
+        # Estimate, the exact number depends on the order of the samples.
+        return int(np.ceil(np.sum(self.num_points) / self.batch_limit))
+
+
 class ConcatBatcher(object):
     """ConcatBatcher for KPConv"""
 
@@ -424,7 +541,9 @@ class ConcatBatcher(object):
 
     def collate_fn(self, batches):
         """
-        collate_fn called by original PyTorch dataloader
+        collate_fn called by original PyTorch dataloader. The batch stays on
+        the CPU so that it can be built in the loader workers, it is moved to
+        the device with `CustomBatch.to`.
 
         Args:
             batches: a batch of data
@@ -433,5 +552,4 @@ class ConcatBatcher(object):
             class: the batched result
         """
         batching_result = CustomBatch(batches)
-        batching_result.to(self.device)
         return {'data': batching_result, 'attr': []}
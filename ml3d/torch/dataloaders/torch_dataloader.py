@@ -1,11 +1,39 @@
 from abc import abstractmethod
 from tqdm import tqdm
+import time
+import logging
 import torch
 from torch.multiprocessing import Pool
 from torch.utils.data import Dataset
 from collections import namedtuple
 
-from ...utils import Cache, get_hash
+from ...utils import Cache, MemmapCache, get_cache_key
+
+log = logging.getLogger(__name__)
+
+# State shared with the preprocessing workers, set by _init_preprocess_worker.
+_worker_dataset = None
+_worker_cache_convert = None
+
+
+def _init_preprocess_worker(dataset, cache_convert):
+    global _worker_dataset, _worker_cache_convert
+    _worker_dataset = dataset
+    _worker_cache_convert = cache_convert
+
+
+def _preprocess_worker(indices):
+    """
+    Preprocess and cache a shard of the dataset inside a worker. Returns the
+    manifest entries of the shard, the manifest is only saved by the parent.
+    """
+    entries = {}
+    for idx in indices:
+        attr = _worker_dataset.get_attr(idx)
+        data = _worker_dataset.get_data(idx)
+        _worker_cache_convert(attr['name'], data, attr)
+        entries[attr['name']] = _worker_cache_convert.manifest[attr['name']]
+    return entries
 
 
 class TorchDataloader(Dataset):
@@ -19,6 +47,7 @@ class TorchDataloader(Dataset):
                  transform=None,
                  use_cache=True,
                  steps_per_epoch=None,
+                 preprocess_workers=None,
                  **kwargs):
         """
         Initialize
@@ -27,9 +56,15 @@ class TorchDataloader(Dataset):
             dataset: ml3d dataset class.
             dataset: model's preprocess method.
             devce: model's transform mthod.
-            use_cache: whether to use cached preprocessed data.
+            use_cache: whether to use cached preprocessed data. Up to
+                `cache_memory_mb` (dataset config) of decoded entries are
+                also kept in memory. With `cache_verify` (dataset config)
+                the cached entries are checked against their checksums.
             steps_per_epch: steps per epoch. The step number will be the 
                 number of samples in the data if steps_per_epoch=None
+            preprocess_workers: number of processes used to build the cache.
+                Falls back to `preprocess_workers` in the dataset config,
+                0 preprocesses in the main process.
             kwargs:
         Returns:
             class: The corresponding class.
@@ -42,29 +77,73 @@ class TorchDataloader(Dataset):
             cache_dir = getattr(dataset.cfg, 'cache_dir')
             assert cache_dir is not None, 'cache directory is not given'
 
-            self.cache_convert = Cache(preprocess,
-                                       cache_dir=cache_dir,
-                                       cache_key=get_hash(repr(preprocess)))
+            cache_cls = MemmapCache if dataset.cfg.get(
+                'cache_format', 'npy') == 'memmap' else Cache
+            self.cache_convert = cache_cls(
+                preprocess,
+                cache_dir=cache_dir,
+                cache_key=get_cache_key(preprocess, dataset.cfg, cache_cls.ext),
+                max_memory=int(
+                    dataset.cfg.get('cache_memory_mb', 0) * 1024 * 1024),
+                verify=dataset.cfg.get('cache_verify', False))
 
             uncached = [
                 idx for idx in range(len(dataset)) if dataset.get_attr(idx)
                 ['name'] not in self.cache_convert.cached_ids
             ]
             if len(uncached) > 0:
-                for idx in tqdm(range(len(dataset)), desc='preprocess'):
-                    attr = dataset.get_attr(idx)
-                    name = attr['name']
-                    if name in self.cache_convert.cached_ids:
-                        continue
-                    data = dataset.get_data(idx)
-                    # cache the data
-                    self.cache_convert(name, data, attr)
+                if preprocess_workers is None:
+                    preprocess_workers = dataset.cfg.get(
+                        'preprocess_workers', 0)
+                self.build_cache(uncached, preprocess_workers)
 
         else:
             self.cache_convert = None
 
         self.transform = transform
 
+    def build_cache(self, indices, num_workers=0):
+        """
+        Preprocess the given samples and store them in the cache.
+
+        Args:
+            indices: indices of the samples to preprocess.
+            num_workers: number of worker processes. The indices are split
+                into shards which are processed in parallel, 0 runs
+                everything in the main process.
+        """
+        dataset = self.dataset
+        start = time.time()
+
+        if num_workers > 0:
+            chunksize = max(1, min(16, len(indices) // (4 * num_workers)))
+            shards = [
+                indices[i:i + chunksize]
+                for i in range(0, len(indices), chunksize)
+            ]
+            with Pool(num_workers,
+                      initializer=_init_preprocess_worker,
+                      initargs=(dataset, self.cache_convert)) as pool:
+                with tqdm(total=len(indices), desc='preprocess') as pbar:
+                    for entries in pool.imap_unordered(_preprocess_worker,
+                                                       shards):
+                        self.cache_convert.add_entries(entries)
+                        pbar.update(len(entries))
+        else:
+            for idx in tqdm(indices, desc='preprocess'):
+                attr = dataset.get_attr(idx)
+                data = dataset.get_data(idx)
+                # cache the data
+                self.cache_convert(attr['name'], data, attr)
+
+        self.cache_convert.save_manifest()
+
+        elapsed = time.time() - start
+        log.info("Preprocessed {} samples in {:.1f}s ({:.2f} samples/s, "
+                 "{} workers)".format(len(indices), elapsed,
+                                      len(indices) / max(elapsed, 1e-6),
+                                      num_workers))
+
     def __getitem__(self, index):
         """Returns the item at index idx. """
         dataset = self.dataset
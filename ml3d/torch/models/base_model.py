@@ -54,6 +54,17 @@ class BaseModel(ABC, torch.nn.Module):
         """
         return
 
+    def get_preprocess_cfg(self):
+        """Returns the config values the output of preprocess depends on.
+
+        They are used to derive the key of the preprocessing cache. By default
+        the whole model config is used.
+
+        Returns:
+            A dict of config values.
+        """
+        return dict(self.cfg)
+
     @abstractmethod
     def preprocess(self, cfg_pipeline):
         """Data preprocessing function.
@@ -80,11 +91,14 @@ class BaseModel(ABC, torch.nn.Module):
         return
 
     @abstractmethod
-    def inference_begin(self, data):
+    def inference_begin(self, data, preprocessed=None):
         """Function called right before running inference.
 
         Args:
             data: A data from the dataset.
+            preprocessed: The output of preprocess for data with the test
+                split, if it was computed in advance (e.g. by the loading
+                stage of run_test).
         """
         return
 
@@ -2,6 +2,7 @@ import time
 import math
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import open3d.core as o3c
 
 from tqdm import tqdm
@@ -15,7 +16,9 @@ from open3d.ml.contrib import radius_search
 # use relative import for being compatible with Open3d main repo
 from .base_model import BaseModel
 from ..modules.losses import filter_valid_label
+from ..utils import torch_version
 from ...utils.ply import write_ply, read_ply
+from ...utils.kernel_dispositions import get_kernel_disposition
 from ...utils import MODEL
 
 from ...datasets.utils import (DataProcessing, trans_normalize, trans_augment,
@@ -77,48 +80,65 @@ class KPFCNN(BaseModel):
             num_layers=5,
             l_relu=0.1,
             reduce_fc=False,
+            kpconv_chunk_size=0,
+            kpconv_checkpoint=False,
+            neighborhood_limits=[],
+            neighborhood_calib_batches=100,
+            neighborhood_calib_percentile=90,
+            batch_calib_samples=0,
+            point_budget_sampler=False,
+            batch_limit_headroom=1.2,
             **kwargs):
 
-        super().__init__(name=name,
-                         lbl_values=lbl_values,
-                         num_classes=num_classes,
-                         ignored_label_inds=ignored_label_inds,
-                         ckpt_path=ckpt_path,
-                         batcher=batcher,
-                         architecture=architecture,
-                         in_radius=in_radius,
-                         max_in_points=max_in_points,
-                         batch_num=batch_num,
-                         batch_limit=batch_limit,
-                         val_batch_num=val_batch_num,
-                         num_kernel_points=num_kernel_points,
-                         first_subsampling_dl=first_subsampling_dl,
-                         conv_radius=conv_radius,
-                         deform_radius=deform_radius,
-                         KP_extent=KP_extent,
-                         KP_influence=KP_influence,
-                         aggregation_mode=aggregation_mode,
-                         first_features_dim=first_features_dim,
-                         in_features_dim=in_features_dim,
-                         modulated=modulated,
-                         use_batch_norm=use_batch_norm,
-                         batch_norm_momentum=batch_norm_momentum,
-                         deform_fitting_mode=deform_fitting_mode,
-                         deform_fitting_power=deform_fitting_power,
-                         repulse_extent=repulse_extent,
-                         augment_scale_anisotropic=augment_scale_anisotropic,
-                         augment_symmetries=augment_symmetries,
-                         augment_rotation=augment_rotation,
-                         augment_scale_min=augment_scale_min,
-                         augment_scale_max=augment_scale_max,
-                         augment_noise=augment_noise,
-                         augment_color=augment_color,
-                         in_points_dim=in_points_dim,
-                         fixed_kernel_points=fixed_kernel_points,
-                         num_layers=num_layers,
-                         l_relu=l_relu,
-                         reduce_fc=reduce_fc,
-                         **kwargs)
+        super().__init__(
+            name=name,
+            lbl_values=lbl_values,
+            num_classes=num_classes,
+            ignored_label_inds=ignored_label_inds,
+            ckpt_path=ckpt_path,
+            batcher=batcher,
+            architecture=architecture,
+            in_radius=in_radius,
+            max_in_points=max_in_points,
+            batch_num=batch_num,
+            batch_limit=batch_limit,
+            val_batch_num=val_batch_num,
+            num_kernel_points=num_kernel_points,
+            first_subsampling_dl=first_subsampling_dl,
+            conv_radius=conv_radius,
+            deform_radius=deform_radius,
+            KP_extent=KP_extent,
+            KP_influence=KP_influence,
+            aggregation_mode=aggregation_mode,
+            first_features_dim=first_features_dim,
+            in_features_dim=in_features_dim,
+            modulated=modulated,
+            use_batch_norm=use_batch_norm,
+            batch_norm_momentum=batch_norm_momentum,
+            deform_fitting_mode=deform_fitting_mode,
+            deform_fitting_power=deform_fitting_power,
+            repulse_extent=repulse_extent,
+            augment_scale_anisotropic=augment_scale_anisotropic,
+            augment_symmetries=augment_symmetries,
+            augment_rotation=augment_rotation,
+            augment_scale_min=augment_scale_min,
+            augment_scale_max=augment_scale_max,
+            augment_noise=augment_noise,
+            augment_color=augment_color,
+            in_points_dim=in_points_dim,
+            fixed_kernel_points=fixed_kernel_points,
+            num_layers=num_layers,
+            l_relu=l_relu,
+            reduce_fc=reduce_fc,
+            kpconv_chunk_size=kpconv_chunk_size,
+            kpconv_checkpoint=kpconv_checkpoint,
+            neighborhood_limits=neighborhood_limits,
+            neighborhood_calib_batches=neighborhood_calib_batches,
+            neighborhood_calib_percentile=neighborhood_calib_percentile,
+            batch_calib_samples=batch_calib_samples,
+            point_budget_sampler=point_budget_sampler,
+            batch_limit_headroom=batch_limit_headroom,
+            **kwargs)
 
         cfg = self.cfg
 
@@ -142,7 +162,7 @@ class KPFCNN(BaseModel):
         self.encoder_skip_dims = []
         self.encoder_skips = []
 
-        self.neighborhood_limits = []
+        self.neighborhood_limits = list(cfg.neighborhood_limits)
         # Loop over consecutive blocks
         for block_i, block in enumerate(cfg.architecture):
 
@@ -342,6 +362,9 @@ class KPFCNN(BaseModel):
 
         return loss, labels, scores
 
+    def get_preprocess_cfg(self):
+        return {'first_subsampling_dl': self.cfg.first_subsampling_dl}
+
     def preprocess(self, data, attr):
         cfg = self.cfg
 
@@ -433,6 +456,11 @@ class KPFCNN(BaseModel):
         min_in_points = self.cfg.get('min_in_points', 3)
         min_in_points = min(min_in_points, self.cfg.max_in_points)
 
+        # With the PointBudgetBatchSampler the batches are filled by the
+        # sampler, so a sample is a single sphere.
+        if self.cfg.get('point_budget_sampler', False):
+            min_in_points = 1
+
         while curr_num_points < min_in_points:
 
             new_points = points.copy()
@@ -460,15 +488,15 @@ class KPFCNN(BaseModel):
                 o_labels = sem_labels.astype(np.int32)
 
             curr_new_points = curr_new_points - p0
+            curr_feat = feat[rand_order, :] if feat is not None else None
             t_normalize = self.cfg.get('t_normalize', None)
             curr_new_points, curr_feat = trans_normalize(
-                curr_new_points, feat, t_normalize)
+                curr_new_points, curr_feat, t_normalize)
 
             if curr_feat is None:
                 curr_new_coords = curr_new_points.copy()
             else:
-                curr_new_coords = np.hstack(
-                    (curr_new_points, curr_feat[rand_order, :]))
+                curr_new_coords = np.hstack((curr_new_points, curr_feat))
 
             curr_new_coords[:, 2] += p0[2]
 
@@ -481,7 +509,7 @@ class KPFCNN(BaseModel):
             # Safe check
             if n < 2:
                 if attr['split'] in ['test']:
-                    self.possibility[wanted_ind] += 0.001
+                    self.update_possibility(wanted_ind, 0.001)
                 continue
 
             # Randomly drop some points (augmentation process and safety for GPU memory consumption)
@@ -508,7 +536,7 @@ class KPFCNN(BaseModel):
                                axis=1)
                 delta = np.square(1 - dists / (np.max(dists) + 0.001))
 
-                self.possibility[reproj_mask] += delta
+                self.update_possibility(reproj_mask, delta)
 
             else:
                 proj_inds = np.zeros((0,))
@@ -534,17 +562,21 @@ class KPFCNN(BaseModel):
 
         return data
 
-    def inference_begin(self, data):
+    def inference_begin(self, data, preprocessed=None):
         self.test_smooth = 0.98
         attr = {'split': 'test'}
         self.inference_ori_data = data
-        self.inference_data = self.preprocess(data, attr)
+        if preprocessed is None:
+            preprocessed = self.preprocess(data, attr)
+        self.inference_data = preprocessed
         self.inference_proj_inds = self.inference_data['proj_inds']
         num_points = self.inference_data['search_tree'].data.shape[0]
 
         self.possibility = np.random.rand(num_points) * 1e-3
-        self.test_probs = np.zeros(shape=[num_points, self.cfg.num_classes],
-                                   dtype=np.float16)
+        self.num_converged = 0
+        self.test_probs = torch.zeros((num_points, self.cfg.num_classes),
+                                      dtype=torch.float16,
+                                      device=self.device)
         self.pbar = tqdm(total=self.possibility.shape[0])
         self.pbar_update = 0
         from ..dataloaders import ConcatBatcher
@@ -555,44 +587,55 @@ class KPFCNN(BaseModel):
         data = self.transform(self.inference_data, attr, is_test=True)
         inputs = {'data': data, 'attr': attr}
         inputs = self.batcher.collate_fn([inputs])
+        inputs['data'].to(self.device)
         self.inference_input = inputs
 
         return inputs
 
+    def update_possibility(self, inds, delta):
+        """
+        Add delta to the possibility of the points inds (without duplicates)
+        and count the points whose possibility passes 0.5, so that inference
+        does not rescan the possibility of all the points at every step.
+        """
+        possibility = self.possibility[inds]
+        self.num_converged += np.count_nonzero((possibility <= 0.5) &
+                                               (possibility + delta > 0.5))
+        self.possibility[inds] = possibility + delta
+
     def inference_end(self, inputs, results):
-        m_softmax = torch.nn.Softmax(dim=-1)
-        stk_probs = m_softmax(results)
-        stk_probs = results.cpu().data.numpy()
+        stk_probs = torch.nn.functional.softmax(results.float(), dim=-1)
 
+        # Points of the spheres of the batch, in the order of the results
         batch = inputs['data']
-
-        # Get probs and labels
-        lengths = batch.lengths[0].cpu().numpy()
-
-        f_inds = batch.frame_inds.cpu().numpy()
-        r_inds_list = batch.reproj_inds
-        r_mask_list = batch.reproj_masks
-        labels_list = batch.val_labels
-
-        i0 = 0
-        for b_i, length in enumerate(lengths):
-            # Get prediction
-            probs = stk_probs[i0:i0 + length]
-            proj_inds = r_inds_list[b_i]
-            proj_mask = r_mask_list[b_i]
-            self.test_probs[proj_mask] = self.test_smooth * self.test_probs[
-                proj_mask] + (1 - self.test_smooth) * probs
-            i0 += length
-
-        self.pbar.update(self.possibility[self.possibility > 0.5].shape[0] -
-                         self.pbar_update)
-        self.pbar_update = self.possibility[self.possibility > 0.5].shape[0]
-        if np.min(self.possibility) > 0.5:
+        inds = torch.from_numpy(
+            np.concatenate(batch.reproj_masks).astype(np.int64)).to(
+                stk_probs.device)
+
+        # Spheres of a batch may overlap. A point predicted c times gets the
+        # mean of its predictions with the weight of c smoothing steps.
+        inds, inverse, counts = torch.unique(inds,
+                                             return_inverse=True,
+                                             return_counts=True)
+        probs = torch.zeros((inds.shape[0], stk_probs.shape[1]),
+                            dtype=stk_probs.dtype,
+                            device=stk_probs.device)
+        probs.index_add_(0, inverse, stk_probs)
+        counts = counts.unsqueeze(1).to(stk_probs.dtype)
+        smooth = self.test_smooth**counts
+        self.test_probs[inds] = (smooth * self.test_probs[inds].float() +
+                                 (1 - smooth) * probs / counts).to(
+                                     self.test_probs.dtype)
+
+        self.pbar.update(self.num_converged - self.pbar_update)
+        self.pbar_update = self.num_converged
+        if self.num_converged == self.possibility.shape[0]:
             self.pbar.close()
-            pred_labels = np.argmax(self.test_probs, 1)
+            test_probs = self.test_probs.cpu().numpy()
+            pred_labels = np.argmax(test_probs, 1)
 
             pred_labels = pred_labels[self.inference_proj_inds]
-            test_probs = self.test_probs[self.inference_proj_inds]
+            test_probs = test_probs[self.inference_proj_inds]
             inference_result = {
                 'predict_labels': pred_labels,
                 'predict_scores': test_probs
@@ -605,17 +648,87 @@ class KPFCNN(BaseModel):
         else:
             return False
 
-    def big_neighborhood_filter(self, neighbors, layer):
+    def set_neighborhood_limits(self, limits):
         """
-        Filter neighborhoods with max number of neighbors. Limit is set to keep XX% of the neighborhoods untouched.
-        Limit is computed at initialization
+        Set the maximum number of neighbors of every layer. The limits are
+        stored in the config, so the batches built from transformed data
+        crop their neighbor matrices too. An empty list disables cropping.
         """
+        self.neighborhood_limits = [int(l) for l in limits]
+        self.cfg['neighborhood_limits'] = self.neighborhood_limits
 
-        # crop neighbors matrix
-        if len(self.neighborhood_limits) > 0:
-            return neighbors[:, :self.neighborhood_limits[layer]]
-        else:
-            return neighbors
+    def calibrate_neighborhood_limits(self, batches, percentile=None):
+        """
+        Choose the neighborhood limits from the neighbor counts of batches.
+        The limit of a layer keeps `percentile` percent of its neighborhoods
+        untouched, so the neighbor matrices are no longer padded to the
+        densest neighborhood.
+
+        Args:
+            batches: Iterable of ConcatBatcher batches built without
+                neighborhood limits.
+            percentile: Percentage of untouched neighborhoods, by default
+                `neighborhood_calib_percentile` of the config.
+
+        Returns:
+            The neighborhood limits of every layer.
+        """
+        if percentile is None:
+            percentile = self.cfg.get('neighborhood_calib_percentile', 90)
+
+        # Histograms of the neighbor counts of every layer
+        hists = []
+        for inputs in batches:
+            for layer, neighb_mat in enumerate(inputs['data'].neighbors):
+                neighb_mat = neighb_mat.cpu().numpy()
+
+                # Shadow neighbors have the index of the number of points
+                counts = np.sum(neighb_mat < neighb_mat.shape[0], axis=1)
+                hist = np.bincount(counts)
+                if layer == len(hists):
+                    hists.append(hist)
+                    continue
+                if hist.shape[0] > hists[layer].shape[0]:
+                    hist[:hists[layer].shape[0]] += hists[layer]
+                    hists[layer] = hist
+                else:
+                    hists[layer][:hist.shape[0]] += hist
+
+        limits = []
+        for hist in hists:
+            cumsum = np.cumsum(hist)
+            if cumsum.shape[0] == 0 or cumsum[-1] == 0:
+                limits.append(1)
+                continue
+            limit = np.searchsorted(cumsum, percentile / 100 * cumsum[-1])
+            limits.append(max(int(limit), 1))
+
+        self.set_neighborhood_limits(limits)
+        return self.neighborhood_limits
+
+    def calibrate_batch_limit(self, samples, batch_num=None):
+        """
+        Choose `batch_limit` so that batches hold `batch_num` samples on
+        average, as in the calibration of the original KPConv.
+
+        Args:
+            samples: Iterable of transformed samples.
+            batch_num: Target number of samples per batch, by default
+                `batch_num` of the config.
+
+        Returns:
+            The number of points of every sample.
+        """
+        if batch_num is None:
+            batch_num = self.cfg.batch_num
+
+        num_points = [
+            sum(p.shape[0] for p in data['p_list']) for data in samples
+        ]
+        if len(num_points) > 0:
+            self.cfg['batch_limit'] = int(
+                np.ceil(batch_num * np.mean(num_points)))
+        return num_points
 
     def augmentation_transform(self,
                                points,
@@ -864,7 +977,9 @@ class KPConv(nn.Module):
                  KP_influence='linear',
                  aggregation_mode='sum',
                  deformable=False,
-                 modulated=False):
+                 modulated=False,
+                 chunk_size=0,
+                 checkpoint=False):
         """
         Initialize parameters for KPConvDeformable.
         :param kernel_size: Number of kernel points.
@@ -878,6 +993,8 @@ class KPConv(nn.Module):
         :param aggregation_mode: choose to sum influences, or only keep the closest ('closest', 'sum').
         :param deformable: choose deformable or not
         :param modulated: choose if kernel weights are modulated in addition to deformed
+        :param chunk_size: number of query points convolved at once, 0 convolves all points at once.
+        :param checkpoint: recompute the intermediates of every chunk in backward instead of storing them.
         """
         super(KPConv, self).__init__()
 
@@ -893,6 +1010,8 @@ class KPConv(nn.Module):
         self.aggregation_mode = aggregation_mode
         self.deformable = deformable
         self.modulated = modulated
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
 
         # Running variable containing deformed KP distance to input points. (used in regularization loss)
         self.min_d2 = None
@@ -918,7 +1037,9 @@ class KPConv(nn.Module):
                                       radius,
                                       fixed_kernel_points=fixed_kernel_points,
                                       KP_influence=KP_influence,
-                                      aggregation_mode=aggregation_mode)
+                                      aggregation_mode=aggregation_mode,
+                                      chunk_size=chunk_size,
+                                      checkpoint=checkpoint)
             self.offset_bias = Parameter(torch.zeros(self.offset_dim,
                                                      dtype=torch.float32),
                                          requires_grad=True)
@@ -1002,18 +1123,85 @@ class KPConv(nn.Module):
         # Add a fake point in the last row for shadow neighbors
         s_pts = torch.cat((s_pts, torch.zeros_like(s_pts[:1, :]) + 1e6), 0)
 
+        # Add a zero feature for shadow neighbors
+        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
+
+        # Apply offsets to kernel points [n_points, n_kpoints, dim]
+        if self.deformable:
+            self.deformed_KP = offsets + self.kernel_points
+
+        # Evaluate the convolution on blocks of query points, so that the
+        # [n_points, n_neighbors, n_kpoints, dim] intermediates only exist
+        # for one block at a time.
+        n_points = q_pts.shape[0]
+        chunk_size = self.chunk_size if self.chunk_size > 0 else max(
+            n_points, 1)
+        # The reentrant checkpoint of torch < 1.11 gives no parameter
+        # gradients when none of its inputs requires grad.
+        reentrant = torch_version() < (1, 11)
+        recompute = (self.checkpoint and chunk_size < n_points and
+                     torch.is_grad_enabled() and
+                     (x.requires_grad or not reentrant))
+        checkpoint_kwargs = {} if reentrant else {'use_reentrant': False}
+
+        outputs = []
+        min_d2 = []
+        for i0 in range(0, max(n_points, 1), chunk_size):
+            i1 = i0 + chunk_size
+            if self.deformable:
+                K_points = self.deformed_KP[i0:i1]
+                chunk_modulations = (modulations[i0:i1]
+                                     if modulations is not None else None)
+            else:
+                K_points = self.kernel_points
+                chunk_modulations = None
+            args = (q_pts[i0:i1], s_pts, neighb_inds[i0:i1], x, K_points,
+                    chunk_modulations)
+
+            # Recompute the intermediates in backward instead of keeping
+            # them for every block.
+            if recompute:
+                output = torch.utils.checkpoint.checkpoint(
+                    self.convolve, *args, **checkpoint_kwargs)
+            else:
+                output = self.convolve(*args)
+
+            if self.deformable:
+                output, chunk_min_d2 = output
+                min_d2.append(chunk_min_d2)
+            outputs.append(output)
+
+        if self.deformable:
+            self.min_d2 = torch.cat(min_d2, 0)
+
+        # Convolution sum [n_points, out_fdim]
+        return torch.cat(outputs, 0) if len(outputs) > 1 else outputs[0]
+
+    def convolve(self, q_pts, s_pts, neighb_inds, x, K_points, modulations):
+        """
+        Evaluate the convolution for a block of query points.
+        :param q_pts: query points of the block [n_points, dim]
+        :param s_pts: support points with the shadow point [n_supports + 1, dim]
+        :param neighb_inds: neighbor indices of the block [n_points, n_neighbors]
+        :param x: support features with the shadow feature [n_supports + 1, in_fdim]
+        :param K_points: kernel points [n_kpoints, dim], or the deformed kernel
+            points of the block [n_points, n_kpoints, dim]
+        :param modulations: modulations of the block or None
+        :return: the output features [n_points, out_fdim], and for deformable
+            convolutions the squared distances of the kernel points to their
+            closest neighbor [n_points, n_kpoints].
+        """
+
         # Get neighbor points [n_points, n_neighbors, dim]
         neighbors = s_pts[neighb_inds, :]
 
         # Center every neighborhood
         neighbors = neighbors - q_pts.unsqueeze(1)
 
-        # Apply offsets to kernel points [n_points, n_kpoints, dim]
         if self.deformable:
-            self.deformed_KP = offsets + self.kernel_points
-            deformed_K_points = self.deformed_KP.unsqueeze(1)
+            deformed_K_points = K_points.unsqueeze(1)
         else:
-            deformed_K_points = self.kernel_points
+            deformed_K_points = K_points
 
         # Get all difference matrices [n_points, n_neighbors, n_kpoints, dim]
         neighbors.unsqueeze_(2)
@@ -1021,12 +1209,13 @@ class KPConv(nn.Module):
 
         # Get the square distances [n_points, n_neighbors, n_kpoints]
         sq_distances = torch.sum(differences**2, dim=3)
+        del differences
 
         # Optimization by ignoring points outside a deformed KP range
         if self.deformable:
 
             # Save distances for loss
-            self.min_d2, _ = torch.min(sq_distances, dim=1)
+            min_d2, _ = torch.min(sq_distances, dim=1)
 
             # Boolean of the neighbors in range of a kernel point [n_points, n_neighbors]
             in_range = torch.any(sq_distances < self.KP_extent**2,
@@ -1091,9 +1280,6 @@ class KPConv(nn.Module):
             raise ValueError(
                 "Unknown convolution mode. Should be 'closest' or 'sum'")
 
-        # Add a zero feature for shadow neighbors
-        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
-
         # Get the features of each neighborhood [n_points, n_neighbors, in_fdim]
         neighb_x = gather(x, new_neighb_inds)
 
@@ -1111,7 +1297,11 @@ class KPConv(nn.Module):
         kernel_outputs = torch.matmul(weighted_features, self.weights)
 
         # Convolution sum [n_points, out_fdim]
-        return torch.sum(kernel_outputs, dim=0)
+        output = torch.sum(kernel_outputs, dim=0)
+
+        if self.deformable:
+            return output, min_d2
+        return output
 
     def __repr__(self):
         return 'KPConv(radius: {:.2f}, in_feat: {:d}, out_feat: {:d})'.format(
@@ -1279,7 +1469,9 @@ class SimpleBlock(nn.Module):
                              KP_influence=config.KP_influence,
                              aggregation_mode=config.aggregation_mode,
                              deformable='deform' in block_name,
-                             modulated=config.modulated)
+                             modulated=config.modulated,
+                             chunk_size=config.get('kpconv_chunk_size', 0),
+                             checkpoint=config.get('kpconv_checkpoint', False))
 
         # Other opperations
         self.batch_norm = BatchNormBlock(out_dim // 2, self.use_bn,
@@ -1349,7 +1541,9 @@ class ResnetBottleneckBlock(nn.Module):
                              KP_influence=config.KP_influence,
                              aggregation_mode=config.aggregation_mode,
                              deformable='deform' in block_name,
-                             modulated=config.modulated)
+                             modulated=config.modulated,
+                             chunk_size=config.get('kpconv_chunk_size', 0),
+                             checkpoint=config.get('kpconv_checkpoint', False))
         self.batch_norm_conv = BatchNormBlock(out_dim // 4, self.use_bn,
                                               self.bn_momentum)
 
@@ -1603,20 +1797,20 @@ def spherical_Lloyd(radius,
         differences = np.expand_dims(X, 1) - kernel_points
         sq_distances = np.sum(np.square(differences), axis=2)
 
-        # Compute cell centers
+        # Compute cell centers, cells without points keep their kernel point
         cell_inds = np.argmin(sq_distances, axis=1)
-        centers = []
-        for c in range(num_cells):
-            bool_c = (cell_inds == c)
-            num_c = np.sum(bool_c.astype(np.int32))
-            if num_c > 0:
-                centers.append(np.sum(X[bool_c, :], axis=0) / num_c)
-            else:
-                warning = True
-                centers.append(kernel_points[c])
+        num_c = np.bincount(cell_inds, minlength=num_cells)
+        sum_c = np.stack([
+            np.bincount(cell_inds, weights=X[:, d], minlength=num_cells)
+            for d in range(dimension)
+        ], 1)
+        empty_c = num_c == 0
+        if np.any(empty_c):
+            warning = True
+        centers = np.where(empty_c[:, None], kernel_points,
+                           sum_c / np.maximum(num_c, 1)[:, None])
 
         # Update kernel points with low pass filter to smooth mote carlo
-        centers = np.vstack(centers)
         moves = (1 - momentum) * (centers - kernel_points)
         kernel_points += moves
 
@@ -1770,11 +1964,11 @@ def kernel_point_optimization_debug(radius,
         # *****************
 
         # Derivative of the sum of potentials of all points
-        A = np.expand_dims(kernel_points, axis=2)
-        B = np.expand_dims(kernel_points, axis=1)
-        interd2 = np.sum(np.power(A - B, 2), axis=-1)
-        inter_grads = (A - B) / (np.power(np.expand_dims(interd2, -1), 3 / 2) +
-                                 1e-6)
+        differences = (np.expand_dims(kernel_points, axis=2) -
+                       np.expand_dims(kernel_points, axis=1))
+        interd2 = np.sum(np.square(differences), axis=-1)
+        inter_grads = differences / np.expand_dims(
+            interd2 * np.sqrt(interd2) + 1e-6, -1)
         inter_grads = np.sum(inter_grads, axis=1)
 
         # Derivative of the radius potential
@@ -1790,7 +1984,7 @@ def kernel_point_optimization_debug(radius,
         # **************
 
         # Compute norm of gradients
-        gradients_norms = np.sqrt(np.sum(np.power(gradients, 2), axis=-1))
+        gradients_norms = np.sqrt(np.sum(np.square(gradients), axis=-1))
         saved_gradient_norms[iter, :] = np.max(gradients_norms, axis=1)
 
         # Stop if all moving points are gradients fixed (low gradients diff)
@@ -1853,51 +2047,36 @@ def kernel_point_optimization_debug(radius,
 
 def load_kernels(radius, num_kpoints, dimension, fixed, lloyd=False):
 
-    # Kernel directory
-    kernel_dir = 'kernels/dispositions'
-    if not exists(kernel_dir):
-        makedirs(kernel_dir)
-
     # To many points switch to Lloyds
     if num_kpoints > 30:
         lloyd = True
 
-    # Kernel_file
-    kernel_file = join(
-        kernel_dir, 'k_{:03d}_{:s}_{:d}D.ply'.format(num_kpoints, fixed,
-                                                     dimension))
-
-    # Check if already done
-    if not exists(kernel_file):
+    def create_kernel_points():
         if lloyd:
             # Create kernels
-            kernel_points = spherical_Lloyd(1.0,
-                                            num_kpoints,
-                                            dimension=dimension,
-                                            fixed=fixed,
-                                            verbose=0)
-
-        else:
-            # Create kernels
-            kernel_points, grad_norms = kernel_point_optimization_debug(
-                1.0,
-                num_kpoints,
-                num_kernels=100,
-                dimension=dimension,
-                fixed=fixed,
-                verbose=0)
-
-            # Find best candidate
-            best_k = np.argmin(grad_norms[-1, :])
-
-            # Save points
-            kernel_points = kernel_points[best_k, :, :]
-
-        write_ply(kernel_file, kernel_points, ['x', 'y', 'z'])
-
-    else:
-        data = read_ply(kernel_file)
-        kernel_points = np.vstack((data['x'], data['y'], data['z'])).T
+            return spherical_Lloyd(1.0,
+                                   num_kpoints,
+                                   dimension=dimension,
+                                   fixed=fixed,
+                                   verbose=0)
+
+        # Create kernels
+        kernel_points, grad_norms = kernel_point_optimization_debug(
+            1.0,
+            num_kpoints,
+            num_kernels=100,
+            dimension=dimension,
+            fixed=fixed,
+            verbose=0)
+
+        # Find best candidate
+        best_k = np.argmin(grad_norms[-1, :])
+
+        # Save points
+        return kernel_points[best_k, :, :]
+
+    kernel_points = get_kernel_disposition(num_kpoints, fixed, dimension,
+                                           create_kernel_points)
 
     # Random roations for the kernel
     # N.B. 4D random rotations not supported yet
@@ -2015,85 +2194,47 @@ def batch_grid_subsampling(points,
         # Apply rotations
         #################
 
-        i0 = 0
-        points = points.copy()
-        for bi, length in enumerate(batches_len):
-            # Apply the rotation
-            points[i0:i0 + length, :] = np.sum(
-                np.expand_dims(points[i0:i0 + length, :], 2) * R[bi], axis=1)
-            i0 += length
+        points = rotate_batch(points, batches_len, R)
 
     #######################
     # Sunsample and realign
     #######################
 
-    if (features is None) and (labels is None):
-        s_points, s_len = subsample_batch(points,
-                                          batches_len,
-                                          sampleDl=sampleDl,
-                                          max_p=max_p,
-                                          verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len
-
-    elif (labels is None):
-        s_points, s_len, s_features = subsample_batch(points,
-                                                      batches_len,
-                                                      features=features,
-                                                      sampleDl=sampleDl,
-                                                      max_p=max_p,
-                                                      verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len, s_features
-
-    elif (features is None):
-        s_points, s_len, s_labels = subsample_batch(points,
-                                                    batches_len,
-                                                    classes=labels,
-                                                    sampleDl=sampleDl,
-                                                    max_p=max_p,
-                                                    verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len, s_labels
+    kwargs = {}
+    if features is not None:
+        kwargs['features'] = features
+    if labels is not None:
+        kwargs['classes'] = labels
 
-    else:
-        s_points, s_len, s_features, s_labels = subsample_batch(
-            points,
-            batches_len,
-            features=features,
-            classes=labels,
-            sampleDl=sampleDl,
-            max_p=max_p,
-            verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len, s_features, s_labels
+    outputs = subsample_batch(points,
+                              batches_len,
+                              sampleDl=sampleDl,
+                              max_p=max_p,
+                              verbose=verbose,
+                              **kwargs)
+
+    if random_grid_orient:
+        s_points, s_len = outputs[:2]
+        s_points = rotate_batch(s_points, s_len, R.transpose(0, 2, 1))
+        outputs = (s_points, s_len) + tuple(outputs[2:])
+
+    return outputs
+
+
+def rotate_batch(points, batches_len, R):
+    """
+    Rotate every element of a batch of stacked points with its own matrix
+    :param points: (N, 3) matrix of stacked points
+    :param batches_len: number of points of each batch element
+    :param R: (B, 3, 3) rotation matrices, points are multiplied from the left
+    :return: (N, 3) rotated points
+    """
+    rotated = np.empty_like(points)
+    i0 = 0
+    for bi, length in enumerate(batches_len):
+        np.matmul(points[i0:i0 + length], R[bi], out=rotated[i0:i0 + length])
+        i0 += length
+    return rotated
 
 
 def p2p_fitting_regularizer(net):
@@ -133,9 +133,10 @@ class RandLANet(BaseModel):
         cfg = self.cfg
         inputs = dict()
 
-        pc = data['point'].copy()
-        label = data['label'].copy()
-        feat = data['feat'].copy() if data['feat'] is not None else None
+        # trans_crop_pc gathers copies, the full cloud is not copied here.
+        pc = data['point']
+        label = data['label']
+        feat = data['feat']
         tree = data['search_tree']
 
         if min_posbility_idx is None:  # training
@@ -173,37 +174,28 @@ class RandLANet(BaseModel):
             1], "Wrong feature dimension, please update dim_input(3 + feature_dimension) in config"
 
         features = feat
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_up_samples = []
-
-        for i in range(cfg.num_layers):
-            neighbour_idx = DataProcessing.knn_search(pc, pc, cfg.k_n)
-
-            sub_points = pc[:pc.shape[0] // cfg.sub_sampling_ratio[i], :]
-            pool_i = neighbour_idx[:pc.shape[0] // cfg.sub_sampling_ratio[i], :]
-            up_i = DataProcessing.knn_search(sub_points, pc, 1)
-            input_points.append(pc)
-            input_neighbors.append(neighbour_idx.astype(np.int64))
-            input_pools.append(pool_i.astype(np.int64))
-            input_up_samples.append(up_i.astype(np.int64))
-            pc = sub_points
+        input_points, input_neighbors, input_pools, input_up_samples = \
+            DataProcessing.knn_hierarchy(
+                pc, cfg.k_n, cfg.sub_sampling_ratio[:cfg.num_layers])
 
         inputs['xyz'] = input_points
-        inputs['neigh_idx'] = input_neighbors
-        inputs['sub_idx'] = input_pools
-        inputs['interp_idx'] = input_up_samples
+        inputs['neigh_idx'] = [arr.astype(np.int64) for arr in input_neighbors]
+        inputs['sub_idx'] = [arr.astype(np.int64) for arr in input_pools]
+        inputs['interp_idx'] = [
+            arr.astype(np.int64) for arr in input_up_samples
+        ]
         inputs['features'] = features
 
         inputs['labels'] = label.astype(np.int64)
         return inputs
 
-    def inference_begin(self, data):
+    def inference_begin(self, data, preprocessed=None):
         self.test_smooth = 0.95
         attr = {'split': 'test'}
         self.inference_ori_data = data
-        self.inference_data = self.preprocess(data, attr)
+        if preprocessed is None:
+            preprocessed = self.preprocess(data, attr)
+        self.inference_data = preprocessed
         self.inference_proj_inds = self.inference_data['proj_inds']
         num_points = self.inference_data['search_tree'].data.shape[0]
         self.possibility = np.random.rand(num_points) * 1e-3
@@ -212,11 +204,18 @@ class RandLANet(BaseModel):
         self.batcher = DefaultBatcher()
 
     def inference_preprocess(self):
-        min_posbility_idx = np.argmin(self.possibility)
+        # Crops are picked one after the other, every transform raises the
+        # possibility around its crop, so the next seed lies elsewhere.
+        batch_size = getattr(self, 'inference_batch_size', 1)
         attr = {'split': 'test'}
-        data = self.transform(self.inference_data, attr, min_posbility_idx)
-        inputs = {'data': data, 'attr': attr}
-        inputs = self.batcher.collate_fn([inputs])
+        batch = []
+        for _ in range(max(1, batch_size)):
+            if len(batch) > 0 and np.min(self.possibility) > 0.5:
+                break
+            min_posbility_idx = np.argmin(self.possibility)
+            data = self.transform(self.inference_data, attr, min_posbility_idx)
+            batch.append({'data': data, 'attr': attr})
+        inputs = self.batcher.collate_fn(batch)
         self.inference_input = inputs
 
         return inputs
@@ -227,13 +226,14 @@ class RandLANet(BaseModel):
         m_softmax = torch.nn.Softmax(dim=-1)
         results = m_softmax(results)
         results = results.cpu().data.numpy()
-        probs = np.reshape(results, [-1, self.cfg.num_classes])
 
-        pred_l = np.argmax(probs, 1)
+        inds = inputs['data']['point_inds'].numpy()
+        probs = np.reshape(results, inds.shape + (self.cfg.num_classes,))
 
-        inds = inputs['data']['point_inds']
-        self.test_probs[inds] = self.test_smooth * self.test_probs[inds] + (
-            1 - self.test_smooth) * probs
+        # Crops of a batch may overlap, update them one after the other.
+        for crop_inds, crop_probs in zip(inds, probs):
+            self.test_probs[crop_inds] = self.test_smooth * self.test_probs[
+                crop_inds] + (1 - self.test_smooth) * crop_probs
         print(np.min(self.possibility))
 
         if np.min(self.possibility) > 0.5:
@@ -253,6 +253,9 @@ class RandLANet(BaseModel):
         else:
             return False
 
+    def get_preprocess_cfg(self):
+        return {'grid_size': self.cfg.grid_size}
+
     def preprocess(self, data, attr):
         cfg = self.cfg
 
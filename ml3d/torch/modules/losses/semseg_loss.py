@@ -3,33 +3,30 @@ import torch.nn as nn
 import numpy as np
 from ....datasets.utils import DataProcessing
 
+# Label lookup tables on the device, keyed by classes, ignored labels and device.
+_label_luts = {}
 
-def filter_valid_label(scores, labels, num_classes, ignored_label_inds, device):
-    """Loss functions for semantic segmentation"""
-    valid_scores = scores.reshape(-1, num_classes)
-    valid_labels = labels.reshape(-1).to(device)
-
-    ignored_bool = torch.zeros_like(valid_labels, dtype=torch.bool)
-    for ign_label in ignored_label_inds:
-        ignored_bool = torch.logical_or(ignored_bool,
-                                        torch.eq(valid_labels, ign_label))
 
-    valid_idx = torch.where(torch.logical_not(ignored_bool))[0].to(device)
+def get_label_lut(num_classes, ignored_label_inds, device):
+    """Device resident lookup table of DataProcessing.get_label_lut"""
+    key = (num_classes, tuple(ignored_label_inds), str(device))
+    if key not in _label_luts:
+        lut = DataProcessing.get_label_lut(num_classes, ignored_label_inds)
+        _label_luts[key] = torch.from_numpy(lut).to(device)
+    return _label_luts[key]
 
-    valid_scores = torch.gather(valid_scores, 0,
-                                valid_idx.unsqueeze(-1).expand(-1, num_classes))
-    valid_labels = torch.gather(valid_labels, 0, valid_idx)
 
-    # Reduce label values in the range of logit shape
-    reducing_list = torch.arange(0, num_classes, dtype=torch.int64)
-    inserted_value = torch.zeros([1], dtype=torch.int64)
+def filter_valid_label(scores, labels, num_classes, ignored_label_inds, device):
+    """Loss functions for semantic segmentation"""
+    valid_scores = scores.reshape(-1, num_classes)
+    lut = get_label_lut(num_classes, ignored_label_inds, device)
 
-    for ign_label in ignored_label_inds:
+    # Remove the ignored labels and reduce the others in the range of logits
+    valid_labels = lut[labels.reshape(-1).to(device, torch.int64)]
+    valid_mask = valid_labels >= 0
 
-        reducing_list = torch.cat([
-            reducing_list[:ign_label], inserted_value, reducing_list[ign_label:]
-        ], 0)
-    valid_labels = torch.gather(reducing_list.to(device), 0, valid_labels)
+    valid_scores = valid_scores[valid_mask]
+    valid_labels = valid_labels[valid_mask]
 
     valid_labels = valid_labels.unsqueeze(0)
     valid_scores = valid_scores.unsqueeze(0).transpose(-2, -1)
@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from ....datasets.utils import DataProcessing
 
 
 class SemSegMetric(object):
@@ -12,10 +13,43 @@ class SemSegMetric(object):
         self.model = model
         self.dataset = dataset
         self.device = device
+        self.confusion_matrix = None
+        self.label_lut = None
 
-    def acc(self, scores, labels):
+    def reset(self):
+        """Reset the accumulated confusion matrix"""
+        self.confusion_matrix = None
+
+    def update(self, scores, labels):
         r"""
-            Compute the per-class accuracies and the overall accuracy 
+            Accumulate the confusion matrix of a batch. The matrix stays on
+            the device of the scores, so no synchronization is needed.
+
+            Parameters
+            ----------
+            scores: torch.FloatTensor, shape (B?, C, N)
+                raw scores for each class
+            labels: torch.LongTensor, shape (B?, N)
+                ground truth labels
+        """
+        confusion_matrix = self.get_confusion_matrix(scores, labels)
+        if self.confusion_matrix is None:
+            self.confusion_matrix = confusion_matrix
+        else:
+            self.confusion_matrix += confusion_matrix
+
+    def accumulated_acc(self):
+        """Per-class accuracies and overall accuracy of the accumulated data"""
+        return self.acc_from_confusion(self.confusion_matrix.cpu().numpy())
+
+    def accumulated_iou(self):
+        """Per-class IoU and mean IoU of the accumulated data"""
+        return self.iou_from_confusion(self.confusion_matrix.cpu().numpy())
+
+    @staticmethod
+    def get_confusion_matrix(scores, labels):
+        r"""
+            Compute the confusion matrix with a single bincount
 
             Parameters
             ----------
@@ -26,33 +60,43 @@ class SemSegMetric(object):
 
             Returns
             -------
-            list of floats of length num_classes+1 
-            (last item is overall accuracy)
+            torch.LongTensor, shape (C, C), rows are ground truth labels
         """
         num_classes = scores.size(-2)
         predictions = torch.max(scores, dim=-2).indices
 
-        accuracies = []
-        accuracy_mask = predictions == labels
-
-        n_total = 0
-        n_correct = 0
+        inds = labels.reshape(-1) * num_classes + predictions.reshape(-1)
+        return torch.bincount(inds, minlength=num_classes**2).reshape(
+            num_classes, num_classes)
 
-        for label in range(num_classes):
-            label_mask = labels == label
-            per_class_accuracy = (accuracy_mask & label_mask).float().sum()
-            n_correct += per_class_accuracy
-            per_class_accuracy /= label_mask.float().sum()
-            n_total += label_mask.float().sum()
-            accuracies.append(per_class_accuracy.cpu().item())
-
-        # overall accuracy
+    @staticmethod
+    def acc_from_confusion(confusion_matrix):
+        """
+        Per-class accuracies of a confusion matrix, the last item is their
+        mean.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            accuracies = np.diag(confusion_matrix) / confusion_matrix.sum(1)
+        accuracies = accuracies.tolist()
         accuracies.append(np.nanmean(accuracies))
         return accuracies
 
-    def iou(self, scores, labels):
+    @staticmethod
+    def iou_from_confusion(confusion_matrix):
+        """
+        Per-class IoU of a confusion matrix, the last item is the mean IoU.
+        """
+        tp = np.diag(confusion_matrix)
+        union = confusion_matrix.sum(0) + confusion_matrix.sum(1) - tp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = tp / union
+        ious = ious.tolist()
+        ious.append(np.nanmean(ious))
+        return ious
+
+    def acc(self, scores, labels):
         r"""
-            Compute the per-class IoU and the mean IoU 
+            Compute the per-class accuracies and the overall accuracy 
 
             Parameters
             ----------
@@ -63,94 +107,52 @@ class SemSegMetric(object):
 
             Returns
             -------
-            list of floats of length num_classes+1 (last item is mIoU)
+            list of floats of length num_classes+1 
+            (last item is overall accuracy)
         """
-        num_classes = scores.size(-2)
-        predictions = torch.max(scores, dim=-2).indices
+        confusion_matrix = self.get_confusion_matrix(scores, labels)
+        return self.acc_from_confusion(confusion_matrix.cpu().numpy())
 
-        ious = []
-
-        n_total = 0
-        n_correct = 0
+    def iou(self, scores, labels):
+        r"""
+            Compute the per-class IoU and the mean IoU 
 
-        for label in range(num_classes):
-            pred_mask = predictions == label
-            labels_mask = labels == label
-            iou = (pred_mask & labels_mask).float().sum()
-            n_correct += iou
-            iou = iou / (pred_mask | labels_mask).float().sum()
-            n_total += (pred_mask | labels_mask).float().sum()
-            ious.append(iou.cpu().item())
+            Parameters
+            ----------
+            scores: torch.FloatTensor, shape (B?, C, N)
+                raw scores for each class
+            labels: torch.LongTensor, shape (B?, N)
+                ground truth labels
 
-        ious.append(np.nanmean(ious))
-        return ious
+            Returns
+            -------
+            list of floats of length num_classes+1 (last item is mIoU)
+        """
+        confusion_matrix = self.get_confusion_matrix(scores, labels)
+        return self.iou_from_confusion(confusion_matrix.cpu().numpy())
 
     def filter_valid_label_np(self, pred, gt):
         """filter out invalid points"""
+        if self.label_lut is None:
+            self.label_lut = DataProcessing.get_label_lut(
+                self.dataset.num_classes, self.dataset.cfg.ignored_label_inds)
 
-        ignored_label_inds = self.dataset.cfg.ignored_label_inds
-
-        ignored_bool = np.zeros_like(gt, dtype=np.bool)
-        for ign_label in ignored_label_inds:
-            ignored_bool = np.logical_or(ignored_bool, np.equal(gt, ign_label))
-
-        valid_idx = np.where(np.logical_not(ignored_bool))[0]
-
-        valid_pred = pred[valid_idx]
-        valid_gt = gt[valid_idx]
+        valid_gt = self.label_lut[gt]
+        valid_mask = valid_gt >= 0
 
-        # Reduce label values in the range of logit shape
-        reducing_list = np.arange(0, self.dataset.num_classes, dtype=np.int64)
-        inserted_value = np.zeros([1], dtype=np.int64)
+        return pred[valid_mask], valid_gt[valid_mask]
 
-        for ign_label in ignored_label_inds:
-            reducing_list = np.concatenate([
-                reducing_list[:ign_label], inserted_value,
-                reducing_list[ign_label:]
-            ], 0)
-
-        valid_gt = reducing_list[valid_gt]
-
-        return valid_pred, valid_gt
-
-    def iou_np_label(self, pred, gt):
+    def confusion_matrix_np_label(self, pred, gt):
+        """Confusion matrix of predicted labels, rows are ground truth labels"""
         valid_pred, valid_gt = self.filter_valid_label_np(pred, gt)
         num_classes = self.dataset.num_classes
 
-        ious = []
-
-        n_total = 0
-        n_correct = 0
+        inds = valid_gt.astype(np.int64) * num_classes + valid_pred
+        return np.bincount(inds, minlength=num_classes**2).reshape(
+            num_classes, num_classes)
 
-        for label in range(num_classes):
-            pred_mask = valid_pred == label
-            labels_mask = valid_gt == label
-            iou = (pred_mask & labels_mask).sum()
-            n_correct += iou
-            iou = iou / (pred_mask | labels_mask).sum()
-            n_total += (pred_mask | labels_mask).sum()
-            ious.append(iou)
-
-        ious.append(np.nanmean(ious))
-        return ious
+    def iou_np_label(self, pred, gt):
+        return self.iou_from_confusion(self.confusion_matrix_np_label(pred, gt))
 
     def acc_np_label(self, pred, gt):
-        valid_pred, valid_gt = self.filter_valid_label_np(pred, gt)
-        num_classes = self.dataset.num_classes
-
-        accuracies = []
-        accuracy_mask = valid_pred == valid_gt
-
-        n_total = 0
-        n_correct = 0
-
-        for label in range(num_classes):
-            label_mask = valid_gt == label
-            per_class_accuracy = (accuracy_mask & label_mask).sum()
-            n_correct += per_class_accuracy
-            per_class_accuracy /= label_mask.sum()
-            n_total += label_mask.sum()
-            accuracies.append(per_class_accuracy)
-
-        accuracies.append(np.nanmean(accuracies))
-        return accuracies
+        return self.acc_from_confusion(self.confusion_matrix_np_label(pred, gt))
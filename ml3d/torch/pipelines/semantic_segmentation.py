@@ -1,8 +1,12 @@
 import torch, pickle
 import torch.nn as nn
 import numpy as np
+import itertools
 import logging
+import queue
 import sys
+import threading
+import time
 import warnings
 
 from datetime import datetime
@@ -14,8 +18,9 @@ from pathlib import Path
 from os.path import exists, join, isfile, dirname, abspath
 
 from .base_pipeline import BasePipeline
-from ..dataloaders import TorchDataloader, DefaultBatcher, ConcatBatcher
-from ..utils import latest_torch_ckpt
+from ..dataloaders import (TorchDataloader, DefaultBatcher, ConcatBatcher,
+                           PointBudgetBatchSampler)
+from ..utils import latest_torch_ckpt, torch_version
 from ..modules.losses import SemSegLoss
 from ..modules.metrics import SemSegMetric
 from ...utils import make_dir, LogRecord, Config, PIPELINE, get_runid, code2md
@@ -29,6 +34,66 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 
+def _worker_init_fn(worker_id):
+    # Give every loader worker its own numpy seed, forked workers would
+    # otherwise draw the same random crops and augmentations.
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+def _put(q, item, stop):
+    # Put an item into a bounded queue unless the pipeline was stopped.
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    # Get an item from a queue, returns None once the pipeline was stopped.
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _batch_to_device(inputs, device, non_blocking=False):
+    # Batches of the ConcatBatcher are built on the CPU, other batchers
+    # leave the transfer to the model.
+    if hasattr(inputs['data'], 'to'):
+        inputs['data'].to(device, non_blocking=non_blocking)
+    return inputs
+
+
+def device_prefetcher(loader, device):
+    """
+    Iterate over a DataLoader and move the batches to the device. On CUDA the
+    next batch is copied on a side stream while the current one is processed.
+    """
+    if device.type != 'cuda':
+        for inputs in loader:
+            yield _batch_to_device(inputs, device)
+        return
+
+    stream = torch.cuda.Stream(device)
+    current = None
+    for inputs in loader:
+        with torch.cuda.stream(stream):
+            inputs = _batch_to_device(inputs, device, non_blocking=True)
+        if current is not None:
+            yield current
+        torch.cuda.current_stream(device).wait_stream(stream)
+        if hasattr(inputs['data'], 'record_stream'):
+            inputs['data'].record_stream(torch.cuda.current_stream(device))
+        current = inputs
+    if current is not None:
+        yield current
+
+
 class SemanticSegmentation(BasePipeline):
     """
     Pipeline for semantic segmentation. 
@@ -74,16 +139,28 @@ class SemanticSegmentation(BasePipeline):
                          train_sum_dir=train_sum_dir,
                          **kwargs)
 
-    def run_inference(self, data):
+    def run_inference(self, data, preprocessed=None):
+        """
+        Run inference on a datum.
+
+        Args:
+            data: A datum from the dataset.
+            preprocessed: The output of model.preprocess for data with the
+                test split, if it was computed in advance.
+
+        Returns:
+            The inference result of the model.
+        """
         cfg = self.cfg
         model = self.model
         device = self.device
 
         model.to(device)
         model.device = device
+        model.inference_batch_size = cfg.get('test_batch_size', 1)
         model.eval()
 
-        model.inference_begin(data)
+        model.inference_begin(data, preprocessed)
 
         with torch.no_grad():
             while True:
@@ -112,12 +189,6 @@ class SemanticSegmentation(BasePipeline):
 
         batcher = self.get_batcher(device, split='test')
 
-        test_split = TorchDataloader(dataset=dataset.get_split('test'),
-                                     preprocess=model.preprocess,
-                                     transform=model.transform,
-                                     use_cache=dataset.cfg.use_cache,
-                                     shuffle=False)
-
         self.load_ckpt(model.cfg.ckpt_path)
 
         datset_split = self.dataset.get_split('test')
@@ -127,24 +198,94 @@ class SemanticSegmentation(BasePipeline):
         self.test_accs = []
         self.test_ious = []
 
-        with torch.no_grad():
-            for idx in tqdm(range(len(test_split)), desc='test'):
-                attr = datset_split.get_attr(idx)
-                if (cfg.get('test_continue', True) and dataset.is_tested(attr)):
-                    continue
-                data = datset_split.get_data(idx)
-                results = self.run_inference(data)
-
-                predict_label = results['predict_labels']
-                if cfg.get('test_compute_metric', True):
-                    acc = metric.acc_np_label(predict_label, data['label'])
-                    iou = metric.iou_np_label(predict_label, data['label'])
-                    self.test_accs.append(acc)
-                    self.test_ious.append(iou)
-
-                dataset.save_test_result(results, attr)
-
-        if cfg.get('test_compute_metric', True):
+        indices = [
+            idx for idx in range(len(datset_split))
+            if not (cfg.get('test_continue', True) and
+                    dataset.is_tested(datset_split.get_attr(idx)))
+        ]
+
+        # Loading and preprocessing, inference and saving run in three
+        # stages connected by bounded queues, so that disk access and the
+        # preprocessing of the next scans overlap with inference.
+        queue_size = cfg.get('test_queue_size', 2)
+        load_queue = queue.Queue(maxsize=queue_size)
+        save_queue = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        errors = []
+        timing = {'load': 0.0, 'preprocess': 0.0, 'inference': 0.0, 'save': 0.0}
+
+        def load():
+            try:
+                for idx in indices:
+                    start = time.time()
+                    attr = datset_split.get_attr(idx)
+                    data = datset_split.get_data(idx)
+                    timing['load'] += time.time() - start
+                    start = time.time()
+                    preprocessed = model.preprocess(data, {'split': 'test'})
+                    timing['preprocess'] += time.time() - start
+                    if not _put(load_queue, (attr, data, preprocessed), stop):
+                        return
+                _put(load_queue, None, stop)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        def save():
+            try:
+                while True:
+                    item = _get(save_queue, stop)
+                    if item is None:
+                        return
+                    attr, data, results = item
+                    start = time.time()
+                    predict_label = results['predict_labels']
+                    if cfg.get('test_compute_metric', True):
+                        acc = metric.acc_np_label(predict_label, data['label'])
+                        iou = metric.iou_np_label(predict_label, data['label'])
+                        self.test_accs.append(acc)
+                        self.test_ious.append(iou)
+
+                    dataset.save_test_result(results, attr)
+                    timing['save'] += time.time() - start
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        loader = threading.Thread(target=load, daemon=True)
+        saver = threading.Thread(target=save, daemon=True)
+        loader.start()
+        saver.start()
+
+        try:
+            with torch.no_grad():
+                for _ in tqdm(range(len(indices)), desc='test'):
+                    item = _get(load_queue, stop)
+                    if item is None:
+                        break
+                    attr, data, preprocessed = item
+                    start = time.time()
+                    results = self.run_inference(data, preprocessed)
+                    timing['inference'] += time.time() - start
+                    if not _put(save_queue, (attr, data, results), stop):
+                        break
+            _put(save_queue, None, stop)
+            saver.join()
+        finally:
+            stop.set()
+            loader.join()
+            saver.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        log.info("test time: load {:.1f}s, preprocess {:.1f}s, inference "
+                 "{:.1f}s, save {:.1f}s".format(timing['load'],
+                                                timing['preprocess'],
+                                                timing['inference'],
+                                                timing['save']))
+
+        if cfg.get('test_compute_metric', True) and len(self.test_accs) > 0:
             log.info("test acc: {}".format(
                 np.nanmean(np.array(self.test_accs)[:, -1])))
             log.info("test iou: {}".format(
@@ -171,6 +312,11 @@ class SemanticSegmentation(BasePipeline):
 
         batcher = self.get_batcher(device)
 
+        self.optimizer, self.scheduler = model.get_optimizer(cfg)
+
+        is_resume = model.cfg.get('is_resume', True)
+        self.load_ckpt(model.cfg.ckpt_path, is_resume=is_resume)
+
         train_split = TorchDataloader(dataset=dataset.get_split('training'),
                                       preprocess=model.preprocess,
                                       transform=model.transform,
@@ -178,10 +324,13 @@ class SemanticSegmentation(BasePipeline):
                                       steps_per_epoch=dataset.cfg.get(
                                           'steps_per_epoch_train', None))
 
+        num_points = self.calibrate_batch_limit(train_split)
+
         train_loader = DataLoader(train_split,
-                                  batch_size=cfg.batch_size,
-                                  shuffle=True,
-                                  collate_fn=batcher.collate_fn)
+                                  collate_fn=batcher.collate_fn,
+                                  **self.get_sampler_kwargs(
+                                      train_split, cfg.batch_size, num_points),
+                                  **self.get_loader_kwargs())
 
         valid_split = TorchDataloader(dataset=dataset.get_split('validation'),
                                       preprocess=model.preprocess,
@@ -191,14 +340,12 @@ class SemanticSegmentation(BasePipeline):
                                           'steps_per_epoch_valid', None))
 
         valid_loader = DataLoader(valid_split,
-                                  batch_size=cfg.val_batch_size,
-                                  shuffle=True,
-                                  collate_fn=batcher.collate_fn)
-
-        self.optimizer, self.scheduler = model.get_optimizer(cfg)
+                                  collate_fn=batcher.collate_fn,
+                                  **self.get_sampler_kwargs(
+                                      valid_split, cfg.val_batch_size),
+                                  **self.get_loader_kwargs())
 
-        is_resume = model.cfg.get('is_resume', True)
-        self.load_ckpt(model.cfg.ckpt_path, is_resume=is_resume)
+        self.calibrate_neighborhood_limits(train_split)
 
         dataset_name = dataset.name if dataset is not None else ''
         tensorboard_dir = join(
@@ -221,13 +368,26 @@ class SemanticSegmentation(BasePipeline):
             self.losses = []
             self.accs = []
             self.ious = []
+            metric.reset()
+            data_time = 0.0
+            compute_time = 0.0
+
+            end = time.time()
+            for step, inputs in enumerate(
+                    tqdm(device_prefetcher(train_loader, device),
+                         desc='training',
+                         total=len(train_loader))):
+                start = time.time()
+                data_time += start - end
+                self.update_sampler(train_loader, inputs)
 
-            for step, inputs in enumerate(tqdm(train_loader, desc='training')):
                 results = model(inputs['data'])
                 loss, gt_labels, predict_scores = model.get_loss(
                     Loss, results, inputs, device)
 
                 if predict_scores.size()[-1] == 0:
+                    end = time.time()
+                    compute_time += end - start
                     continue
 
                 self.optimizer.zero_grad()
@@ -237,23 +397,35 @@ class SemanticSegmentation(BasePipeline):
                                                     model.cfg.grad_clip_norm)
                 self.optimizer.step()
 
-                acc = metric.acc(predict_scores, gt_labels)
-                iou = metric.iou(predict_scores, gt_labels)
+                metric.update(predict_scores, gt_labels)
 
                 self.losses.append(loss.cpu().item())
-                self.accs.append(acc)
-                self.ious.append(iou)
+
+                end = time.time()
+                compute_time += end - start
+
+            if metric.confusion_matrix is not None:
+                self.accs.append(metric.accumulated_acc())
+                self.ious.append(metric.accumulated_iou())
 
             self.scheduler.step()
+            log.info(f"data wait: {data_time:.1f}s, "
+                     f"compute: {compute_time:.1f}s")
+            writer.add_scalar("Time/data", data_time, epoch)
+            writer.add_scalar("Time/compute", compute_time, epoch)
 
             # --------------------- validation
             model.eval()
             self.valid_losses = []
             self.valid_accs = []
             self.valid_ious = []
+            metric.reset()
             with torch.no_grad():
                 for step, inputs in enumerate(
-                        tqdm(valid_loader, desc='validation')):
+                        tqdm(device_prefetcher(valid_loader, device),
+                             desc='validation',
+                             total=len(valid_loader))):
+                    self.update_sampler(valid_loader, inputs)
 
                     results = model(inputs['data'])
                     loss, gt_labels, predict_scores = model.get_loss(
@@ -261,20 +433,132 @@ class SemanticSegmentation(BasePipeline):
 
                     if predict_scores.size()[-1] == 0:
                         continue
-                    acc = metric.acc(predict_scores, gt_labels)
-                    iou = metric.iou(predict_scores, gt_labels)
+                    metric.update(predict_scores, gt_labels)
 
                     self.valid_losses.append(loss.cpu().item())
-                    self.valid_accs.append(acc)
-                    self.valid_ious.append(iou)
 
                     step = step + 1
 
+            if metric.confusion_matrix is not None:
+                self.valid_accs.append(metric.accumulated_acc())
+                self.valid_ious.append(metric.accumulated_iou())
+
             self.save_logs(writer, epoch)
 
             if epoch % cfg.save_ckpt_freq == 0:
                 self.save_ckpt(epoch)
 
+    def get_loader_kwargs(self):
+        """
+        Returns the DataLoader arguments configured in the pipeline config:
+        `num_workers`, `pin_memory`, `prefetch_factor` (batches loaded in
+        advance by every worker) and `persistent_workers` (keep the workers
+        alive between epochs). The last two are only passed when they are
+        set, and need torch >= 1.7.
+        """
+        cfg = self.cfg
+        num_workers = cfg.get('num_workers', 0)
+        kwargs = {
+            'num_workers': num_workers,
+            'pin_memory': cfg.get('pin_memory', False)
+        }
+        if num_workers > 0:
+            kwargs['worker_init_fn'] = _worker_init_fn
+            for key in ['prefetch_factor', 'persistent_workers']:
+                if cfg.get(key, None) is None:
+                    continue
+                if torch_version() < (1, 7):
+                    log.warning(
+                        "Ignoring {}, it requires torch >= 1.7".format(key))
+                    continue
+                kwargs[key] = cfg.get(key)
+        return kwargs
+
+    def calibrate_batch_limit(self, split):
+        """
+        Calibrate the batch limit of models building batches by number of
+        points (e.g. KPFCNN) on `batch_calib_samples` samples of a split.
+        The calibrated limit replaces one restored from a checkpoint, so that
+        the sampler and the batches use the same limit.
+
+        Returns:
+            The estimated number of points of every sample of the split, the
+            measured count for the calibration samples and their mean for the
+            others. None if the model is not calibrated.
+        """
+        model = self.model
+        num_samples = model.cfg.get('batch_calib_samples', 0)
+        if not hasattr(model, 'calibrate_batch_limit') or num_samples <= 0:
+            return None
+
+        start = time.time()
+        indices = np.random.permutation(len(split))[:num_samples]
+        counts = model.calibrate_batch_limit(split[i]['data'] for i in indices)
+        log.info("Calibrated batch limit {} on {} samples of {:.0f} points "
+                 "in {:.1f}s".format(model.cfg.batch_limit, len(counts),
+                                     np.mean(counts),
+                                     time.time() - start))
+
+        num_points = np.full(len(split), np.mean(counts))
+        num_points[indices] = counts
+        return num_points
+
+    def get_sampler_kwargs(self, split, batch_size, num_points=None):
+        """
+        Returns the DataLoader arguments choosing the samples of the batches.
+        Models with `point_budget_sampler` set fill the batches up to their
+        `batch_limit` with a PointBudgetBatchSampler, using the estimated
+        `num_points` of every sample, or `batch_limit / batch_num` if unknown.
+        Other models get batches of `batch_size` samples.
+        """
+        model_cfg = self.model.cfg
+        if not model_cfg.get('point_budget_sampler', False):
+            return {'batch_size': batch_size, 'shuffle': True}
+
+        if num_points is None:
+            num_points = model_cfg.batch_limit / model_cfg.batch_num
+        sampler = PointBudgetBatchSampler(split, model_cfg.batch_limit,
+                                          num_points)
+        return {'batch_sampler': sampler}
+
+    def update_sampler(self, loader, inputs):
+        """
+        Report the real number of points of the samples of a batch to the
+        PointBudgetBatchSampler of its loader, if it has one.
+        """
+        sampler = loader.batch_sampler
+        if isinstance(sampler, PointBudgetBatchSampler):
+            sampler.update(inputs['data'].sample_lengths)
+
+    def calibrate_neighborhood_limits(self, split):
+        """
+        Calibrate the neighborhood limits of models cropping their neighbor
+        matrices (e.g. KPFCNN) on `neighborhood_calib_batches` batches of a
+        split. Limits given in the config or restored from a checkpoint are
+        kept.
+        """
+        model = self.model
+        num_batches = model.cfg.get('neighborhood_calib_batches', 0)
+        if (not hasattr(model, 'calibrate_neighborhood_limits') or
+                len(model.neighborhood_limits) > 0 or num_batches <= 0):
+            return
+
+        # Workers of this loader see the uncropped config and end with it.
+        loader_kwargs = self.get_loader_kwargs()
+        loader_kwargs.pop('persistent_workers', None)
+        loader = DataLoader(split,
+                            batch_size=self.cfg.batch_size,
+                            shuffle=True,
+                            collate_fn=self.get_batcher(self.device).collate_fn,
+                            **loader_kwargs)
+
+        start = time.time()
+        limits = model.calibrate_neighborhood_limits(
+            itertools.islice(loader, num_batches))
+        log.info("Calibrated neighborhood limits {} in {:.1f}s".format(
+            limits,
+            time.time() - start))
+
     def get_batcher(self, device, split='training'):
 
         batcher_name = getattr(self.model.cfg, 'batcher')
@@ -342,6 +626,12 @@ class SemanticSegmentation(BasePipeline):
         log.info(f'Loading checkpoint {ckpt_path}')
         ckpt = torch.load(ckpt_path)
         self.model.load_state_dict(ckpt['model_state_dict'])
+        if ('neighborhood_limits' in ckpt and
+                hasattr(self.model, 'set_neighborhood_limits')):
+            self.model.set_neighborhood_limits(ckpt['neighborhood_limits'])
+        if ('batch_limit' in ckpt and
+                hasattr(self.model, 'calibrate_batch_limit')):
+            self.model.cfg['batch_limit'] = ckpt['batch_limit']
         if 'optimizer_state_dict' in ckpt and hasattr(self, 'optimizer'):
             log.info(f'Loading checkpoint optimizer_state_dict')
             self.optimizer.load_state_dict(ckpt['optimizer_state_dict'])
@@ -352,12 +642,15 @@ class SemanticSegmentation(BasePipeline):
     def save_ckpt(self, epoch):
         path_ckpt = join(self.cfg.logs_dir, 'checkpoint')
         make_dir(path_ckpt)
-        torch.save(
-            dict(epoch=epoch,
-                 model_state_dict=self.model.state_dict(),
-                 optimizer_state_dict=self.optimizer.state_dict(),
-                 scheduler_state_dict=self.scheduler.state_dict()),
-            join(path_ckpt, f'ckpt_{epoch:05d}.pth'))
+        ckpt = dict(epoch=epoch,
+                    model_state_dict=self.model.state_dict(),
+                    optimizer_state_dict=self.optimizer.state_dict(),
+                    scheduler_state_dict=self.scheduler.state_dict())
+        if hasattr(self.model, 'neighborhood_limits'):
+            ckpt['neighborhood_limits'] = self.model.neighborhood_limits
+        if hasattr(self.model, 'calibrate_batch_limit'):
+            ckpt['batch_limit'] = self.model.cfg.batch_limit
+        torch.save(ckpt, join(path_ckpt, f'ckpt_{epoch:05d}.pth'))
         log.info(f'Epoch {epoch:3d}: save ckpt to {path_ckpt:s}')
 
     def save_config(self, writer):
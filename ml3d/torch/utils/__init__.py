@@ -1,5 +1,5 @@
 """Utils for torch networks."""
 
-from .torch_utils import latest_torch_ckpt
+from .torch_utils import latest_torch_ckpt, torch_version
 
-__all__ = ['latest_torch_ckpt']
\ No newline at end of file
+__all__ = ['latest_torch_ckpt', 'torch_version']
\ No newline at end of file
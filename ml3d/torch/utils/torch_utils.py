@@ -19,3 +19,9 @@ def latest_torch_ckpt(train_ckpt_dir):
 
     ckpt_name = ckpt_list[-1]
     return os.path.join(train_ckpt_dir, ckpt_name)
+
+
+def torch_version():
+    """Returns the (major, minor) version of the installed torch."""
+    import torch
+    return tuple(int(x) for x in re.findall(r'\d+', torch.__version__)[:2])
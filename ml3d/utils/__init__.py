@@ -4,9 +4,11 @@ from .config import Config
 from .log import LogRecord, get_runid, code2md
 from .builder import (MODEL, PIPELINE, DATASET, get_module,
                       convert_framework_name)
-from .dataset_helper import get_hash, make_dir, Cache
+from .dataset_helper import (get_hash, get_cache_key, make_dir, list_dir, Cache,
+                             MemmapCache)
 
 __all__ = [
     'Config', 'make_dir', 'LogRecord', 'MODEL', 'PIPELINE', 'DATASET',
-    'get_module', 'convert_framework_name', 'get_hash', 'make_dir', 'Cache'
+    'get_module', 'convert_framework_name', 'get_hash', 'get_cache_key',
+    'make_dir', 'list_dir', 'Cache', 'MemmapCache'
 ]
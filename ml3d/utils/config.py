@@ -240,3 +240,6 @@ class Config(object):
 
     def __getitem__(self, name):
         return self._cfg_dict.__getitem__(name)
+
+    def __setitem__(self, name, value):
+        self._cfg_dict.__setitem__(name, value)
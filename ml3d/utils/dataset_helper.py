@@ -1,11 +1,20 @@
 import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
 from pathlib import Path
 from typing import Callable
 import numpy as np
+from sklearn.neighbors import KDTree
 
 from os import makedirs, listdir
 from os.path import exists, join, isfile, dirname, abspath, splitext
 
+log = logging.getLogger(__name__)
+
 
 def make_dir(folder_name):
     """Create a directory. If already exists, do nothing"""
@@ -19,12 +28,162 @@ def get_hash(x: str):
     return h.hexdigest()
 
 
+def get_cache_key(preprocess, dataset_cfg, cache_format=''):
+    """
+    Generate a deterministic key for the cache of a preprocess function.
+
+    The key only depends on the model class, the config values returned by
+    `get_preprocess_cfg` of the model, the dataset and the cache format, so
+    the same cache is reused across runs and by the tf and torch pipelines.
+
+    Args:
+        preprocess: preprocess method of a model.
+        dataset_cfg: config of the dataset.
+        cache_format: format of the cache entries.
+    Returns:
+        str: The cache key.
+    """
+    model = getattr(preprocess, '__self__', None)
+    if model is not None and hasattr(model, 'get_preprocess_cfg'):
+        name = type(model).__name__
+        model_cfg = model.get_preprocess_cfg()
+    else:
+        name = getattr(preprocess, '__qualname__', type(preprocess).__name__)
+        model_cfg = {}
+
+    desc = {
+        'model': name,
+        'preprocess': model_cfg,
+        'dataset': dataset_cfg.get('name', None),
+        'dataset_path': dataset_cfg.get('dataset_path', None),
+        'format': cache_format
+    }
+    return get_hash(json.dumps(desc, sort_keys=True, default=str))
+
+
+def list_dir(path, cache_dir=None):
+    """
+    Sorted entries of a directory. With a cache_dir the listing is memoized on
+    disk and only refreshed when the modification time of the directory
+    changes, which avoids listing large directories on every run.
+
+    Args:
+        path: directory to list.
+        cache_dir: directory to store the memoized listing.
+    Returns:
+        list: The sorted names of the entries in path.
+    """
+    if cache_dir is None:
+        return sorted(listdir(path))
+
+    mtime = os.stat(path).st_mtime_ns
+    memo_path = join(cache_dir, 'file_lists', get_hash(abspath(path)) + '.json')
+    if exists(memo_path):
+        try:
+            with open(memo_path, 'r') as f:
+                memo = json.load(f)
+            if memo['path'] == abspath(path) and memo['mtime'] == mtime:
+                return memo['files']
+        except (ValueError, KeyError):
+            pass
+
+    files = sorted(listdir(path))
+
+    # A directory changed in the same tick of the file system clock keeps its
+    # modification time, recent listings are not memoized.
+    if time.time() - mtime / 1e9 < 2:
+        return files
+
+    make_dir(dirname(memo_path))
+    tmp_path = '{}.{}.tmp'.format(memo_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'path': abspath(path), 'mtime': mtime, 'files': files}, f)
+    os.replace(tmp_path, memo_path)
+    return files
+
+
+def get_nbytes(x):
+    """Approximate memory footprint of a preprocessed sample in bytes."""
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    elif isinstance(x, KDTree):
+        return sum(arr.nbytes for arr in x.get_arrays())
+    elif isinstance(x, dict):
+        return sum(get_nbytes(v) for v in x.values())
+    elif isinstance(x, (list, tuple)):
+        return sum(get_nbytes(v) for v in x)
+    return 0
+
+
+def get_file_size(path):
+    """Size in bytes of a file, or of all files below a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files)
+
+
+def get_checksum(path):
+    """
+    MD5 checksum of a file. The checksum of a directory combines the
+    checksums of all files below it, see `combine_checksums`.
+    """
+    if os.path.isdir(path):
+        return combine_checksums({
+            os.path.relpath(join(root, f), path): get_checksum(join(root, f))
+            for root, _, names in os.walk(path) for f in names
+        })
+
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def combine_checksums(checksums):
+    """Checksum of a directory from the checksums of its files by path."""
+    h = hashlib.md5()
+    for name in sorted(checksums):
+        h.update(name.encode())
+        h.update(checksums[name].encode())
+    return h.hexdigest()
+
+
+class HashWriter(object):
+    """File wrapper computing the MD5 checksum of the bytes written."""
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
 class Cache(object):
     """
     Cache converter for preprocessed data.
     """
 
-    def __init__(self, func: Callable, cache_dir: str, cache_key: str):
+    # File extension of a cache entry.
+    ext = '.npy'
+    # Return the stored entry instead of the computed one after writing it.
+    reload_written = False
+
+    def __init__(self,
+                 func: Callable,
+                 cache_dir: str,
+                 cache_key: str,
+                 max_memory: int = 0,
+                 verify: bool = False,
+                 max_disk: int = 0):
         """
         Initialize
 
@@ -32,13 +191,151 @@ class Cache(object):
             func: preprocess function of a model.
             cache_dir: directory to store the cache.
             cache_key: key of this cache
+            max_memory: size in bytes of the in-process LRU keeping recently
+                decoded entries. 0 disables it. Entries returned from the
+                LRU are shared, callers must not modify them in place.
+            verify: check the size and checksum of all entries against the
+                manifest. Entries that do not match are removed, so that
+                they are built again. This reads the whole cache once.
+            max_disk: size in bytes of the entries stored in the cache
+                directory. When a new entry exceeds it, the least recently
+                used entries are removed, including entries written by
+                other processes sharing the directory. 0 disables it.
         Returns:
             class: The corresponding class.
         """
         self.func = func
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.lru = OrderedDict()
+        self.lru_bytes = 0
+        self.cache_key = cache_key
         self.cache_dir = join(cache_dir, cache_key)
         make_dir(self.cache_dir)
-        self.cached_ids = [splitext(p)[0] for p in listdir(self.cache_dir)]
+        self.manifest_path = join(self.cache_dir, 'manifest.json')
+        self.manifest = self._load_manifest()
+        if verify:
+            self.remove_invalid()
+
+    @property
+    def cached_ids(self):
+        """Set-like view of the ids stored in the cache."""
+        return self.manifest.keys()
+
+    def _load_manifest(self):
+        """
+        Load the manifest describing the entries of this cache. Caches
+        written without a manifest are scanned once and then use the manifest.
+        """
+        if exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if (manifest.get('cache_key') == self.cache_key and
+                    manifest.get('format') == self.ext):
+                return manifest['entries']
+
+        entries = {}
+        for p in listdir(self.cache_dir):
+            name, ext = splitext(p)
+            if ext == self.ext:
+                entries[name] = {
+                    'size': get_file_size(join(self.cache_dir, p)),
+                    'checksum': None
+                }
+        return entries
+
+    def save_manifest(self):
+        """Persist the manifest, entries are only recorded in memory before."""
+        manifest = {
+            'cache_key': self.cache_key,
+            'format': self.ext,
+            'entries': self.manifest
+        }
+        tmp_path = '{}.{}.tmp'.format(self.manifest_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def add_entries(self, entries):
+        """Record entries that were written by another process."""
+        self.manifest.update(entries)
+
+    def verify(self, unique_id: str):
+        """
+        Check the size and checksum of a cached entry against the manifest.
+
+        Args:
+            unique_id: A unique key of this data.
+        Returns:
+            True if the entry exists and matches the manifest.
+        """
+        info = self.manifest.get(unique_id)
+        fpath = self._get_path(unique_id)
+        if info is None or not exists(fpath):
+            return False
+        if get_file_size(fpath) != info['size']:
+            return False
+        return (info['checksum'] is None or
+                get_checksum(fpath) == info['checksum'])
+
+    def remove_invalid(self):
+        """Remove the entries that do not match the manifest."""
+        invalid = [
+            unique_id for unique_id in self.manifest
+            if not self.verify(unique_id)
+        ]
+        for unique_id in invalid:
+            self.remove(unique_id)
+
+        if len(invalid) > 0:
+            log.warning("Removed {} invalid entries from the cache {}".format(
+                len(invalid), self.cache_dir))
+            self.save_manifest()
+        return invalid
+
+    def remove(self, unique_id):
+        """Remove an entry, it may already be removed by another process."""
+        self.manifest.pop(unique_id, None)
+        fpath = self._get_path(unique_id)
+        if os.path.isdir(fpath):
+            shutil.rmtree(fpath, ignore_errors=True)
+        else:
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries of the cache directory until
+        they fit in `max_disk`. The directory is scanned, so entries written
+        by other processes are counted too.
+
+        Args:
+            keep: id of an entry that is removed last, e.g. the newest one.
+        """
+        entries = []
+        for p in listdir(self.cache_dir):
+            unique_id, ext = splitext(p)
+            if ext != self.ext:
+                continue
+            fpath = join(self.cache_dir, p)
+            try:
+                mtime = os.stat(fpath).st_mtime
+                size = get_file_size(fpath)
+            except FileNotFoundError:
+                continue
+            entries.append((unique_id == keep, mtime, unique_id, size))
+
+        total = sum(entry[-1] for entry in entries)
+        for _, _, unique_id, size in sorted(entries):
+            if total <= self.max_disk:
+                break
+            self.remove(unique_id)
+            total -= size
+
+    def _get_path(self, unique_id):
+        return join(self.cache_dir, str('{}{}'.format(unique_id, self.ext)))
 
     def __call__(self, unique_id: str, *data):
         """
@@ -51,20 +348,230 @@ class Cache(object):
         Returns:
             class: Preprocessed (cache) data.
         """
-        fpath = join(self.cache_dir, str('{}.npy'.format(unique_id)))
+        if unique_id in self.lru:
+            self.lru.move_to_end(unique_id)
+            return self.lru[unique_id][0]
 
-        if not exists(fpath):
+        fpath = self._get_path(unique_id)
+
+        output = None
+        # Entries missing from the manifest may have been written by another
+        # process sharing the cache directory.
+        if unique_id in self.manifest or exists(fpath):
+            try:
+                output = self._read(fpath)
+            except FileNotFoundError:
+                # The entry was removed behind our back, rebuild it.
+                self.manifest.pop(unique_id, None)
+                if len(data) == 0:
+                    raise
+            else:
+                if unique_id not in self.manifest:
+                    self.manifest[unique_id] = {
+                        'size': get_file_size(fpath),
+                        'checksum': None
+                    }
+                if self.max_disk > 0:
+                    # The modification time orders the entries for eviction.
+                    try:
+                        os.utime(fpath)
+                    except FileNotFoundError:
+                        pass
+
+        if output is None:
             output = self.func(*data)
 
-            self._write(output, fpath)
-            self.cached_ids.append(unique_id)
-        else:
-            output = self._read(fpath)
+            try:
+                checksum = self._write(output, fpath)
+            except OSError as e:
+                # E.g. the disk is full, return the entry without storing it.
+                log.warning("Could not store {} in the cache: {}".format(
+                    unique_id, e))
+                self._remember(unique_id, output)
+                return output
+            self.manifest[unique_id] = {
+                'size': get_file_size(fpath),
+                'checksum': checksum
+            }
+            if self.reload_written:
+                try:
+                    output = self._read(fpath)
+                except FileNotFoundError:
+                    # Evicted by another process, keep the computed entry.
+                    pass
+            if self.max_disk > 0:
+                self.evict(keep=unique_id)
 
-        return self._read(fpath)
+        self._remember(unique_id, output)
+
+        return output
+
+    def _remember(self, unique_id, output):
+        """Keep an entry in the LRU, evicting the oldest ones if needed."""
+        if self.max_memory <= 0:
+            return
+
+        size = get_nbytes(output)
+        if size > self.max_memory:
+            return
+
+        self.lru[unique_id] = (output, size)
+        self.lru_bytes += size
+        while self.lru_bytes > self.max_memory:
+            _, (_, old_size) = self.lru.popitem(last=False)
+            self.lru_bytes -= old_size
 
     def _write(self, x, fpath):
-        np.save(fpath, x)
+        """Store an entry and return its checksum, computed while writing."""
+        # Write to a temporary file first and rename it, so that concurrent
+        # writers (e.g. preprocessing workers) never expose a partial entry.
+        tmp_path = '{}.{}.tmp'.format(fpath, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                writer = HashWriter(f)
+                np.save(writer, x)
+            os.replace(tmp_path, fpath)
+        except BaseException:
+            if exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return writer.hexdigest()
 
     def _read(self, fpath):
         return np.load(fpath, allow_pickle=True).item()
+
+
+class MemmapCache(Cache):
+    """
+    Cache converter storing preprocessed data without pickle.
+
+    Every entry is a directory holding one raw `.npy` file per array (e.g.
+    `point`, `feat`, `label`, `proj_inds`) and the flattened array layout of
+    the KDTree `search_tree`. Entries are opened with `np.memmap`, so data
+    loader workers share the pages through the OS page cache instead of
+    each deserializing a private copy. Arrays are mapped copy-on-write, in-place
+    modifications stay private to the process and never reach the disk.
+    """
+
+    ext = '.mmap'
+    # Memory mapped entries share their pages with other processes.
+    reload_written = True
+
+    def _write(self, x, fpath):
+        tmp_path = '{}.{}.tmp'.format(fpath, os.getpid())
+        try:
+            checksums = self._write_entry(x, tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        try:
+            os.rename(tmp_path, fpath)
+        except OSError:
+            # Another process stored the same entry in the meantime.
+            shutil.rmtree(tmp_path)
+            return None
+        return combine_checksums(checksums)
+
+    def _write_entry(self, x, tmp_path):
+        """Write the files of an entry and return their checksums."""
+        make_dir(tmp_path)
+
+        meta = {}
+        checksums = {}
+        for key, value in x.items():
+            if value is None:
+                meta[key] = {'type': 'none'}
+            elif isinstance(value, np.ndarray):
+                checksums[key + '.npy'] = self._save_array(
+                    join(tmp_path, key + '.npy'), value)
+                meta[key] = {'type': 'array'}
+            elif isinstance(value, KDTree):
+                state, tree_checksums = self._write_tree(
+                    value, join(tmp_path, key))
+                for name, checksum in tree_checksums.items():
+                    checksums[join(key, name)] = checksum
+                meta[key] = {'type': 'kdtree', 'state': state}
+            elif isinstance(value, (bool, int, float, str)):
+                meta[key] = {'type': 'value', 'value': value}
+            else:
+                raise TypeError("Can not store {} of type {} in a "
+                                "MemmapCache".format(key, type(value)))
+
+        meta = json.dumps(meta).encode()
+        with open(join(tmp_path, 'meta.json'), 'wb') as f:
+            f.write(meta)
+        checksums['meta.json'] = hashlib.md5(meta).hexdigest()
+        return checksums
+
+    def _read(self, fpath):
+        with open(join(fpath, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        output = {}
+        for key, info in meta.items():
+            if info['type'] == 'none':
+                output[key] = None
+            elif info['type'] == 'array':
+                output[key] = self._load_array(join(fpath, key + '.npy'))
+            elif info['type'] == 'kdtree':
+                output[key] = self._read_tree(info['state'], join(fpath, key))
+            else:
+                output[key] = info['value']
+
+        return output
+
+    @staticmethod
+    def _load_array(fpath):
+        return np.load(fpath, mmap_mode='c', allow_pickle=False)
+
+    @staticmethod
+    def _save_array(fpath, x):
+        """Save an array and return the checksum of the file."""
+        with open(fpath, 'wb') as f:
+            writer = HashWriter(f)
+            np.save(writer, x, allow_pickle=False)
+        return writer.hexdigest()
+
+    @staticmethod
+    def _write_tree(tree, tree_dir):
+        """
+        Store the arrays of a KDTree. Returns a description of its state and
+        the checksums of the files written.
+        """
+        make_dir(tree_dir)
+        state = []
+        checksums = {}
+        for i, item in enumerate(tree.__getstate__()):
+            if isinstance(item, np.ndarray):
+                name = '{}.npy'.format(i)
+                checksums[name] = MemmapCache._save_array(
+                    join(tree_dir, name), item)
+                state.append({'type': 'array'})
+            elif item is None or isinstance(item, (int, float)):
+                state.append({'type': 'value', 'value': item})
+            else:
+                # The distance metric object, KDTree defaults are used.
+                state.append({'type': 'default'})
+        return state, checksums
+
+    @staticmethod
+    def _read_tree(state, tree_dir):
+        """Rebuild a KDTree around the memory-mapped arrays of its layout."""
+        items = []
+        default_state = None
+        for i, info in enumerate(state):
+            if info['type'] == 'array':
+                items.append(
+                    MemmapCache._load_array(join(tree_dir, '{}.npy'.format(i))))
+            elif info['type'] == 'value':
+                items.append(info['value'])
+            else:
+                if default_state is None:
+                    dim = items[0].shape[1]
+                    default_state = KDTree(np.zeros((1, dim))).__getstate__()
+                items.append(default_state[i])
+
+        tree = KDTree.__new__(KDTree)
+        tree.__setstate__(tuple(items))
+        return tree
@@ -0,0 +1,75 @@
+"""Kernel point dispositions shared by the KPConv models."""
+
+import numpy as np
+from os import makedirs
+from os.path import join, exists, dirname, abspath
+
+from .ply import read_ply, write_ply
+
+# Version of the bundled dispositions, increase it when the store changes.
+KERNEL_STORE_VERSION = 1
+KERNEL_STORE_PATH = join(
+    dirname(abspath(__file__)), '_resources',
+    'kernel_dispositions_v{}.npz'.format(KERNEL_STORE_VERSION))
+
+# Process wide memo of the dispositions that were already loaded.
+_kernel_memo = {}
+_kernel_store = None
+
+
+def get_kernel_name(num_kpoints, fixed, dimension):
+    return 'k_{:03d}_{:s}_{:d}D'.format(num_kpoints, fixed, dimension)
+
+
+def load_kernel_store():
+    """Load the dispositions bundled with Open3D-ML."""
+    global _kernel_store
+    if _kernel_store is None:
+        _kernel_store = {}
+        if exists(KERNEL_STORE_PATH):
+            with np.load(KERNEL_STORE_PATH) as store:
+                _kernel_store = {name: store[name] for name in store.files}
+    return _kernel_store
+
+
+def get_kernel_disposition(num_kpoints,
+                           fixed,
+                           dimension,
+                           create_fn,
+                           kernel_dir='kernels/dispositions'):
+    """
+    Get the kernel points of radius 1 for a kernel configuration.
+
+    The disposition is taken from the memo of this process, a ply file in
+    kernel_dir or the bundled store, in this order. Only if none of them has
+    it, the disposition is optimized with create_fn and saved in kernel_dir.
+
+    Args:
+        num_kpoints: number of kernel points.
+        fixed: fixed kernel points ('none', 'center' or 'verticals').
+        dimension: dimension of the space.
+        create_fn: function without arguments optimizing the kernel points.
+        kernel_dir: directory of the optimized dispositions.
+    Returns:
+        Read-only array of kernel points [num_kpoints, dimension].
+    """
+    name = get_kernel_name(num_kpoints, fixed, dimension)
+    if name in _kernel_memo:
+        return _kernel_memo[name]
+
+    kernel_file = join(kernel_dir, name + '.ply')
+    store = load_kernel_store()
+    if exists(kernel_file):
+        data = read_ply(kernel_file)
+        kernel_points = np.vstack((data['x'], data['y'], data['z'])).T
+    elif name in store:
+        kernel_points = store[name]
+    else:
+        kernel_points = create_fn()
+        makedirs(kernel_dir, exist_ok=True)
+        write_ply(kernel_file, kernel_points, ['x', 'y', 'z'])
+
+    kernel_points = np.array(kernel_points, dtype=np.float64)
+    kernel_points.setflags(write=False)
+    _kernel_memo[name] = kernel_points
+    return kernel_points
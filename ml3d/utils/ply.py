@@ -23,6 +23,7 @@
 # Basic libs
 import numpy as np
 import sys
+from numpy.lib.recfunctions import structured_to_unstructured
 
 # Define PLY types
 ply_dtypes = dict([(b'int8', 'i1'), (b'char', 'i1'), (b'uint8', 'u1'),
@@ -100,6 +101,34 @@ def parse_mesh_header(plyfile, ext):
     return num_points, num_faces, vertex_properties
 
 
+def parse_elements_header(plyfile, ext):
+    # Elements in the order of the body, the properties of elements with a
+    # list property are None as their size is not known from the header.
+    line = []
+    elements = []
+
+    while b'end_header' not in line and line != b'':
+        line = plyfile.readline()
+
+        if line.startswith(b'element'):
+            line = line.split()
+            elements.append({
+                'name': line[1].decode(),
+                'count': int(line[2]),
+                'properties': []
+            })
+
+        elif line.startswith(b'property'):
+            line = line.split()
+            if line[1] == b'list':
+                elements[-1]['properties'] = None
+            elif elements[-1]['properties'] is not None:
+                elements[-1]['properties'].append(
+                    (line[2].decode(), ext + ply_dtypes[line[1]]))
+
+    return elements
+
+
 def read_ply(filename, triangular_mesh=False):
     """
     Read ".ply" files
@@ -185,6 +214,72 @@ def read_ply(filename, triangular_mesh=False):
     return data
 
 
+def read_ply_memmap(filename):
+    """
+    Memory map the vertex data of a binary ".ply" file
+
+    Parameters
+    ----------
+    filename : string
+        the name of the file to read.
+
+    Returns
+    -------
+    result : memmap
+        read-only structured array of the vertex properties, fields are only
+        read from disk when they are accessed.
+    """
+
+    with open(filename, 'rb') as plyfile:
+
+        # Check if the file start with ply
+        if b'ply' not in plyfile.readline():
+            raise ValueError('The file does not start whith the word ply')
+
+        # get binary_little/big or ascii
+        fmt = plyfile.readline().split()[1].decode()
+        if fmt == "ascii":
+            raise ValueError('The file is not binary')
+
+        # get extension for building the numpy dtypes
+        ext = valid_formats[fmt]
+
+        # Only the vertex element is kept, as in the mesh reader
+        elements = parse_elements_header(plyfile, ext)
+        offset = plyfile.tell()
+
+    # Skip the elements stored before the vertices
+    for element in elements:
+        if element['properties'] is None:
+            raise ValueError('Can not locate the vertices after the element '
+                             '{} with a list property'.format(element['name']))
+        if element['name'] == 'vertex':
+            return np.memmap(filename,
+                             dtype=element['properties'],
+                             mode='r',
+                             offset=offset,
+                             shape=(element['count'],))
+        offset += element['count'] * np.dtype(element['properties']).itemsize
+
+    raise ValueError('The file has no vertex element')
+
+
+def get_ply_fields(data, field_names, dtype=np.float32):
+    """
+    Gather fields of a structured ply array into a new contiguous (N, d) array
+
+    Parameters
+    ----------
+    data : structured array
+        data returned by read_ply or read_ply_memmap.
+    field_names : list
+        the names of the fields to gather.
+    dtype : numpy dtype
+        type of the returned array.
+    """
+    return structured_to_unstructured(data[field_names], dtype=dtype, copy=True)
+
+
 def header_properties(field_list, field_names):
 
     # List of lines to write
@@ -0,0 +1,145 @@
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+
+import torch
+
+from ml3d.torch.models.kpconv import KPConv
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measure time and peak memory of the KPConv layers of '
+        'KPFCNN with and without chunked evaluation.')
+    parser.add_argument('--num_points',
+                        help='Number of points of the first layer, usually '
+                        'batch_limit.',
+                        default=30000,
+                        type=int)
+    parser.add_argument('--num_neighbors',
+                        help='Number of neighbors of every point.',
+                        default=40,
+                        type=int)
+    parser.add_argument('--num_layers', default=5, type=int)
+    parser.add_argument('--first_features_dim', default=128, type=int)
+    parser.add_argument('--first_subsampling_dl', default=0.06, type=float)
+    parser.add_argument('--chunk_sizes',
+                        help='Chunk sizes to compare, 0 disables chunking.',
+                        default=[0, 4096, 1024],
+                        nargs='+',
+                        type=int)
+    parser.add_argument('--checkpoint',
+                        help='Recompute the chunk intermediates in backward.',
+                        action='store_true')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeat', default=3, type=int)
+
+    return parser.parse_args()
+
+
+def get_layers(args):
+    """Shapes of the resnetb KPConv of every layer of KPFCNN."""
+    layers = []
+    for layer in range(args.num_layers):
+        dl = args.first_subsampling_dl * 2**layer
+        layers.append({
+            'layer': layer,
+            'num_points': max(args.num_points // 4**layer, 1),
+            'dim': args.first_features_dim * 2**layer // 4,
+            'radius': dl * 2.5,
+            'extent': dl * 1.2
+        })
+    return layers
+
+
+def max_rss():
+    """Peak resident memory of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def run_layer(args, layer, chunk_size, result):
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    n = layer['num_points']
+
+    conv = KPConv(15,
+                  3,
+                  layer['dim'],
+                  layer['dim'],
+                  layer['extent'],
+                  layer['radius'],
+                  chunk_size=chunk_size,
+                  checkpoint=args.checkpoint).to(device)
+
+    pts = torch.rand((n, 3), device=device) * layer['radius'] * 10
+    neighb_inds = torch.randint(0,
+                                n + 1, (n, args.num_neighbors),
+                                device=device)
+    x = torch.rand((n, layer['dim']), device=device, requires_grad=True)
+
+    # Warm up, then measure the peak memory of one step.
+    conv(pts, pts, neighb_inds, x).sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated() / 2**20
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.time()
+        out = conv(pts, pts, neighb_inds, x)
+        out.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2**20 - base
+    else:
+        # Peak of the whole process, including the warm up step.
+        peak = max_rss()
+
+    result['time'] = min(times)
+    result['memory'] = peak
+    result['output'] = out.detach().cpu()
+
+
+def main(args):
+    # Every measurement runs in a fresh process, so that peak memory is not
+    # shared between the configurations.
+    ctx = multiprocessing.get_context('spawn')
+    manager = ctx.Manager()
+
+    print("{:>5} {:>8} {:>5} {:>10} {:>10} {:>12} {:>10}".format(
+        'layer', 'points', 'dim', 'chunk', 'time [s]', 'memory [MB]',
+        'max diff'))
+    for layer in get_layers(args):
+        reference = None
+        for chunk_size in args.chunk_sizes:
+            result = manager.dict()
+            p = ctx.Process(target=run_layer,
+                            args=(args, layer, chunk_size, result))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                print(
+                    "{:>5} {:>8} {:>5} {:>10} failed with exit code {}".format(
+                        layer['layer'], layer['num_points'], layer['dim'],
+                        chunk_size, p.exitcode))
+                continue
+
+            if reference is None:
+                reference = result['output']
+            diff = (result['output'] - reference).abs().max().item()
+            print(
+                "{:>5} {:>8} {:>5} {:>10} {:>10.3f} {:>12.0f} {:>10.2e}".format(
+                    layer['layer'], layer['num_points'], layer['dim'],
+                    chunk_size, result['time'], result['memory'], diff))
+
+
+if __name__ == '__main__':
+    main(parse_args())
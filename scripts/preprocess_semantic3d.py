@@ -4,11 +4,11 @@ import os, sys, glob, pickle
 from pathlib import Path
 from os.path import join, exists, dirname, abspath
 from tqdm import tqdm
-import random
-import shutil
-from tqdm import tqdm
+import time
 import argparse
+from multiprocessing import Pool
 from ml3d.datasets.utils import DataProcessing
+from ml3d.datasets.semantic3d import Semantic3D
 
 
 def parse_args():
@@ -25,6 +25,23 @@ def parse_args():
         default=2000,
         type=int)
 
+    parser.add_argument('--workers',
+                        help='Number of files processed in parallel.',
+                        default=1,
+                        type=int)
+
+    parser.add_argument('--chunk_size',
+                        help='Number of lines read from a scan at once.',
+                        default=5000000,
+                        type=int)
+
+    parser.add_argument(
+        '--format',
+        help='Output format, binary is read by the Semantic3D dataset '
+        'without parsing text.',
+        choices=['binary', 'txt'],
+        default='binary')
+
     args = parser.parse_args()
 
     dict_args = vars(args)
@@ -36,6 +53,171 @@ def parse_args():
     return args
 
 
+def read_chunks(path, chunk_size, dtype):
+    return pd.read_csv(path,
+                       header=None,
+                       delim_whitespace=True,
+                       dtype=dtype,
+                       chunksize=chunk_size)
+
+
+# Every SAMPLE_STEP-th point is kept to place the tile boundaries.
+SAMPLE_STEP = 64
+
+
+def stream_to_disk(key, tmp_path, chunk_size):
+    """
+    Stream a scan and its labels into raw binary files, so that only one chunk
+    of text is in memory at a time. Returns the number of points and a sample
+    of the horizontal coordinates of the scan.
+    """
+    num_points = 0
+    samples = []
+
+    with open(tmp_path + '.pc', 'wb') as f:
+        for chunk in read_chunks(key, chunk_size, np.float32):
+            pc = np.ascontiguousarray(chunk.values, dtype=np.float32)
+            offset = -num_points % SAMPLE_STEP
+            samples.append(pc[offset::SAMPLE_STEP, :2].copy())
+            num_points += pc.shape[0]
+            f.write(pc.tobytes())
+
+    with open(tmp_path + '.labels', 'wb') as f:
+        for chunk in read_chunks(key.replace(".txt", ".labels"), chunk_size,
+                                 np.int32):
+            f.write(chunk.values.astype(np.int32).reshape((-1,)).tobytes())
+
+    return num_points, np.concatenate(samples, 0)
+
+
+def get_tile_edges(sample, parts):
+    """
+    Split a scan into at least parts tiles holding the same number of points:
+    strips at quantiles of x, each cut at quantiles of y. Scans are densest
+    around the scanner, so the edges are taken from a sample of the points
+    instead of a uniform grid.
+
+    Returns:
+        The inner x edges [nx - 1] and the inner y edges of every strip
+        [nx, ny - 1].
+    """
+    nx = int(np.ceil(np.sqrt(parts)))
+    ny = int(np.ceil(parts / nx))
+
+    x_edges = np.quantile(sample[:, 0], np.arange(1, nx) / nx)
+    strips = np.searchsorted(x_edges, sample[:, 0], side='right')
+    y_edges = np.zeros((nx, ny - 1), dtype=np.float64)
+    for ix in range(nx):
+        y = sample[strips == ix, 1]
+        if y.shape[0] > 0:
+            y_edges[ix] = np.quantile(y, np.arange(1, ny) / ny)
+    return x_edges, y_edges
+
+
+def get_tile_inds(pc, x_edges, y_edges):
+    """Returns the tile of every point, strip by strip."""
+    strips = np.searchsorted(x_edges, pc[:, 0], side='right')
+    ny = y_edges.shape[1] + 1
+    tiles = np.empty(pc.shape[0], dtype=np.int64)
+    for ix in range(y_edges.shape[0]):
+        mask = strips == ix
+        tiles[mask] = ix * ny + np.searchsorted(
+            y_edges[ix], pc[mask, 1], side='right')
+    return tiles
+
+
+def scatter_to_tiles(tmp_path, num_points, chunk_size, x_edges, y_edges):
+    """
+    Write the points and labels of every tile into their own raw binary
+    files, in a single pass over the scan. Returns the number of tiles.
+    """
+    pc_all = np.memmap(tmp_path + '.pc',
+                       dtype=np.float32,
+                       mode='r',
+                       shape=(num_points, 7))
+    labels_all = np.memmap(tmp_path + '.labels',
+                           dtype=np.int32,
+                           mode='r',
+                           shape=(num_points,))
+
+    num_tiles = (y_edges.shape[1] + 1) * y_edges.shape[0]
+    pc_files = []
+    label_files = []
+    try:
+        for i in range(num_tiles):
+            tile_path = '{}.{}'.format(tmp_path, i)
+            pc_files.append(open(tile_path + '.pc', 'wb'))
+            label_files.append(open(tile_path + '.labels', 'wb'))
+
+        for i0 in range(0, num_points, chunk_size):
+            pc = np.array(pc_all[i0:i0 + chunk_size])
+            lbl = np.array(labels_all[i0:i0 + chunk_size])
+            tiles = get_tile_inds(pc, x_edges, y_edges)
+            order = np.argsort(tiles, kind='stable')
+            bounds = np.searchsorted(tiles[order], np.arange(num_tiles + 1))
+            for i in range(num_tiles):
+                inds = order[bounds[i]:bounds[i + 1]]
+                pc_files[i].write(pc[inds].tobytes())
+                label_files[i].write(lbl[inds].tobytes())
+    finally:
+        for f in pc_files + label_files:
+            f.close()
+    del pc_all, labels_all
+
+    return num_tiles
+
+
+def process_file(job):
+    key, out_path, parts, chunk_size, out_format = job
+    sub_grid_size = 0.01
+
+    tmp_path = join(out_path, '{}.{}.tmp'.format(Path(key).stem, os.getpid()))
+    num_points, sample = stream_to_disk(key, tmp_path, chunk_size)
+
+    x_edges, y_edges = get_tile_edges(sample, parts)
+    num_tiles = scatter_to_tiles(tmp_path, num_points, chunk_size, x_edges,
+                                 y_edges)
+    os.remove(tmp_path + '.pc')
+    os.remove(tmp_path + '.labels')
+
+    num_parts = 0
+    for i in range(num_tiles):
+        tile_path = '{}.{}'.format(tmp_path, i)
+        pc = np.fromfile(tile_path + '.pc', dtype=np.float32).reshape((-1, 7))
+        lbl = np.fromfile(tile_path + '.labels', dtype=np.int32)
+        os.remove(tile_path + '.pc')
+        os.remove(tile_path + '.labels')
+        if pc.shape[0] == 0:
+            continue
+
+        points, feat, lbl = DataProcessing.grid_subsampling(
+            pc[:, :3], features=pc[:, 3:], labels=lbl, grid_size=sub_grid_size)
+        del pc
+
+        shuf = np.arange(points.shape[0])
+        np.random.shuffle(shuf)
+        points, feat, lbl = points[shuf], feat[shuf], lbl[shuf]
+
+        if parts == 1:
+            name = Path(key).stem
+        else:
+            name = Path(key).stem + '_part_{}'.format(num_parts)
+        num_parts += 1
+
+        if out_format == 'binary':
+            Semantic3D.write_binary(join(out_path, 'binary', name), points,
+                                    feat[:, 0], np.round(feat[:, 1:4]),
+                                    lbl.reshape((-1,)))
+        else:
+            name = join(out_path, name + '.txt')
+            np.savetxt(name,
+                       np.concatenate([points, feat], 1),
+                       fmt='%.3f %.3f %.3f %i %i %i %i')
+            np.savetxt(name.replace('.txt', '.labels'), lbl, fmt='%i')
+
+    return key, num_points, num_parts
+
+
 def preprocess(args):
     # Split large pointclouds into multiple point clouds.
 
@@ -46,6 +228,7 @@ def preprocess(args):
     if out_path is None:
         out_path = Path(dataset_path) / 'processed'
         print("out_path not give, Saving output in {}".format(out_path))
+    out_path = str(out_path)
 
     all_files = glob.glob(str(Path(dataset_path) / '*.txt'))
 
@@ -58,90 +241,37 @@ def preprocess(args):
     for f in train_files:
         size = Path(f).stat().st_size / 1e6
         if size <= size_limit:
-            files[f] = 1
+            if abspath(dataset_path) != abspath(out_path):
+                files[f] = 1
             continue
         else:
             parts = int(size / size_limit) + 1
             files[f] = parts
 
     os.makedirs(out_path, exist_ok=True)
+    if args.format == 'binary':
+        os.makedirs(join(out_path, 'binary'), exist_ok=True)
 
-    sub_grid_size = 0.01
+    jobs = [(key, out_path, parts, args.chunk_size, args.format)
+            for key, parts in files.items()]
+    total_size = sum(Path(key).stat().st_size for key in files) / 1e6
 
-    for key, parts in tqdm(files.items()):
+    start = time.time()
+    total_points = 0
+    with Pool(max(1, args.workers)) as pool:
+        for key, num_points, num_tiles in tqdm(pool.imap_unordered(
+                process_file, jobs),
+                                               total=len(jobs)):
+            total_points += num_points
+            print("{}: {} points in {} parts".format(
+                Path(key).name, num_points, num_tiles))
 
-        if parts == 1:
-            if dataset_path != out_path:
-                pc = pd.read_csv(key,
-                                 header=None,
-                                 delim_whitespace=True,
-                                 dtype=np.float32).values
-
-                labels = pd.read_csv(key.replace(".txt", ".labels"),
-                                     header=None,
-                                     delim_whitespace=True,
-                                     dtype=np.int32).values
-                labels = np.array(labels, dtype=np.int32).reshape((-1,))
-
-                print(pc.shape, labels.shape)
-                points, feat, labels = DataProcessing.grid_subsampling(
-                    pc[:, :3],
-                    features=pc[:, 3:],
-                    labels=labels,
-                    grid_size=sub_grid_size)
-                pc = np.concatenate([points, feat], 1)
-                print(pc.shape, labels.shape)
-
-                name = join(out_path, Path(key).name.replace('.txt', '.txt'))
-                name_lbl = name.replace('.txt', '.labels')
-
-                np.savetxt(name, pc, fmt='%.3f %.3f %.3f %i %i %i %i')
-                np.savetxt(name_lbl, labels, fmt='%i')
-
-            continue
-        print("Splitting {} into {} parts".format(Path(key).name, parts))
-        pc = pd.read_csv(key,
-                         header=None,
-                         delim_whitespace=True,
-                         dtype=np.float32).values
-
-        labels = pd.read_csv(key.replace(".txt", ".labels"),
-                             header=None,
-                             delim_whitespace=True,
-                             dtype=np.int32).values
-        labels = np.array(labels, dtype=np.int32).reshape((-1,))
-
-        axis = 1  # Longest axis.
-
-        inds = pc[:, axis].argsort()
-        pc = pc[inds]
-        labels = labels[inds]
-        pcs = np.array_split(pc, parts)
-        lbls = np.array_split(labels, parts)
-
-        for i, pc in enumerate(pcs):
-            lbl = lbls[i]
-            print(pc.shape, lbl.shape)
-            pc, feat, lbl = DataProcessing.grid_subsampling(
-                pc[:, :3],
-                features=pc[:, 3:],
-                labels=lbl,
-                grid_size=sub_grid_size)
-            pcs[i] = np.concatenate([pc, feat], 1)
-            lbls[i] = lbl
-            print(pc.shape, lbl.shape)
-
-        for i in range(parts):
-            name = join(
-                out_path,
-                Path(key).name.replace('.txt', '_part_{}.txt'.format(i)))
-            name_lbl = name.replace('.txt', '.labels')
-
-            shuf = np.arange(pcs[i].shape[0])
-            np.random.shuffle(shuf)
-
-            np.savetxt(name, pcs[i][shuf], fmt='%.3f %.3f %.3f %i %i %i %i')
-            np.savetxt(name_lbl, lbls[i][shuf], fmt='%i')
+    elapsed = max(time.time() - start, 1e-6)
+    print("Processed {} files ({:.0f} MB, {} points) in {:.1f}s, "
+          "{:.1f} MB/s, {:.0f} points/s".format(len(jobs), total_size,
+                                                total_points, elapsed,
+                                                total_size / elapsed,
+                                                total_points / elapsed))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+import pytest
+import numpy as np
+
+
+def test_device_prefetcher_cpu():
+    torch = pytest.importorskip('torch')
+    from ml3d.torch.pipelines.semantic_segmentation import device_prefetcher
+
+    class Batch:
+
+        def __init__(self, i):
+            self.x = torch.full((4,), i)
+            self.calls = []
+
+        def to(self, device, non_blocking=False):
+            self.calls.append((device, non_blocking))
+            self.x = self.x.to(device)
+            return self
+
+        def record_stream(self, stream):
+            raise AssertionError("record_stream called without CUDA")
+
+    device = torch.device('cpu')
+    batches = [{'data': Batch(i), 'attr': []} for i in range(5)]
+    # Batches without `to` (e.g. DefaultBatcher) are passed through.
+    batches.append({'data': {'point': torch.zeros((4, 3))}, 'attr': []})
+
+    outputs = list(device_prefetcher(iter(batches), device))
+
+    assert len(outputs) == len(batches)
+    for i, (inputs, ref) in enumerate(zip(outputs, batches)):
+        assert inputs is ref
+        if i < 5:
+            assert inputs['data'].calls == [(device, False)]
+            assert inputs['data'].x.device == device
+            assert inputs['data'].x[0].item() == i
+    assert list(device_prefetcher(iter([]), device)) == []
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_point_budget_batch_sampler(shuffle):
+    pytest.importorskip('torch')
+    from ml3d.torch.dataloaders import PointBudgetBatchSampler
+
+    rng = np.random.RandomState(0)
+    num_points = rng.randint(100, 5000, 200)
+    # Samples above the budget still get a batch of their own.
+    num_points[[3, 50]] = 12000
+    batch_limit = 10000
+
+    sampler = PointBudgetBatchSampler(range(200),
+                                      batch_limit,
+                                      num_points,
+                                      shuffle=shuffle)
+    batches = list(sampler)
+
+    for batch in batches:
+        assert len(batch) > 0
+        if len(batch) > 1:
+            assert np.sum(num_points[batch]) <= batch_limit
+    indices = np.concatenate(batches)
+    assert np.array_equal(np.sort(indices), np.arange(200))
+    if not shuffle:
+        assert np.array_equal(indices, np.arange(200))
+    assert [3] in batches and [50] in batches
+
+    # A scalar estimate is used for every sample.
+    batches = list(PointBudgetBatchSampler(range(10), 1000, 300))
+    assert sorted(len(batch) for batch in batches) == [1, 3, 3, 3]
+
+
+@pytest.mark.parametrize('extra_cfg', [{}, {
+    'prefetch_factor': 4,
+    'persistent_workers': True
+}])
+def test_loader_kwargs_workers(tmp_path, extra_cfg):
+    torch = pytest.importorskip('torch')
+    from torch.utils.data import DataLoader
+    from ml3d.torch.pipelines import SemanticSegmentation
+    from ml3d.torch.utils import torch_version
+
+    pipeline = SemanticSegmentation(None,
+                                    device='cpu',
+                                    main_log_dir=str(tmp_path),
+                                    num_workers=2,
+                                    **extra_cfg)
+    kwargs = pipeline.get_loader_kwargs()
+
+    # Unset arguments are left to the DataLoader defaults, set ones are
+    # dropped on torch versions without them.
+    if torch_version() < (1, 7):
+        assert 'prefetch_factor' not in kwargs
+        assert 'persistent_workers' not in kwargs
+    else:
+        for key, value in extra_cfg.items():
+            assert kwargs[key] == value
+    for key in ['prefetch_factor', 'persistent_workers']:
+        if key not in extra_cfg:
+            assert key not in kwargs
+
+    loader = DataLoader(torch.arange(8), batch_size=2, **kwargs)
+    for _ in range(2):
+        assert sorted(torch.cat(list(loader)).tolist()) == list(range(8))
+
+
+def test_point_budget_batch_sampler_update():
+    pytest.importorskip('torch')
+    from ml3d.torch.dataloaders import PointBudgetBatchSampler
+
+    # The real sizes are unknown, every sample is estimated at 100 points.
+    real_points = np.array([100, 400, 100, 400, 100, 400, 100, 400])
+    sampler = PointBudgetBatchSampler(range(8), 1000, 100, shuffle=False)
+
+    # Batches are reported in order, as the training loop receives them.
+    # The last sample of every batch was dropped by the batcher.
+    batches = []
+    for batch in sampler:
+        batches.append(batch)
+        sampler.update(real_points[batch[:-1]])
+    assert batches == [list(range(8))]
+    assert len(sampler.pending) == 0
+    np.testing.assert_allclose(sampler.num_points,
+                               [100, 250, 100, 250, 100, 250, 100, 100])
+
+    # Estimates follow the running mean of the real sizes.
+    for _ in range(20):
+        for batch in sampler:
+            sampler.update(real_points[batch])
+    np.testing.assert_allclose(sampler.num_points, real_points, rtol=0.1)
+    for batch in sampler:
+        assert np.sum(real_points[batch]) <= 1000
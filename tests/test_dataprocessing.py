@@ -0,0 +1,27 @@
+import pytest
+import numpy as np
+
+
+@pytest.mark.parametrize('ratios', [[4, 4, 4, 4, 2], [2, 3]])
+def test_knn_hierarchy(ratios):
+    pytest.importorskip('open3d')
+    from ml3d.datasets.utils import DataProcessing
+
+    k = 16
+    rng = np.random.RandomState(0)
+    points = rng.rand(10000, 3).astype(np.float32)
+
+    outputs = DataProcessing.knn_hierarchy(points, k, ratios)
+
+    # Reference: search the neighbors and the upsampling indices of every
+    # level separately, as RandLANet did before.
+    pc = points
+    for i, ratio in enumerate(ratios):
+        neighbour_idx = DataProcessing.knn_search(pc, pc, k)
+        sub_points = pc[:pc.shape[0] // ratio, :]
+        pool_i = neighbour_idx[:pc.shape[0] // ratio, :]
+        up_i = DataProcessing.knn_search(sub_points, pc, 1)
+
+        for output, ref in zip(outputs, [pc, neighbour_idx, pool_i, up_i]):
+            np.testing.assert_array_equal(output[i], ref)
+        pc = sub_points
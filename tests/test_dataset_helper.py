@@ -0,0 +1,307 @@
+import pytest
+import os
+import numpy as np
+
+
+def get_sample(num_points=1000, seed=0):
+    from sklearn.neighbors import KDTree
+
+    rng = np.random.RandomState(seed)
+    point = rng.rand(num_points, 3).astype(np.float32)
+    return {
+        'point': point,
+        'feat': rng.rand(num_points, 3).astype(np.float32),
+        'label': rng.randint(0, 10, num_points).astype(np.int32),
+        'proj_inds': rng.randint(0, num_points, 2 * num_points),
+        'search_tree': KDTree(point, leaf_size=20),
+        'normals': None,
+        'name': 'sample'
+    }
+
+
+def test_memmap_cache_round_trip(tmp_path):
+    from sklearn.neighbors import KDTree
+    from ml3d.utils import MemmapCache
+
+    sample = get_sample()
+    cache = MemmapCache(lambda data, attr: data,
+                        cache_dir=str(tmp_path),
+                        cache_key='test')
+    cache('sample', sample, {})
+
+    # A new converter reads the entry back from the disk.
+    cache = MemmapCache(lambda data, attr: None,
+                        cache_dir=str(tmp_path),
+                        cache_key='test')
+    out = cache('sample')
+
+    for key in ['point', 'feat', 'label', 'proj_inds']:
+        assert isinstance(out[key], np.memmap)
+        np.testing.assert_array_equal(out[key], sample[key])
+    assert out['normals'] is None
+    assert out['name'] == 'sample'
+
+    # The flattened KDTree state gives the same tree.
+    tree = out['search_tree']
+    assert isinstance(tree, KDTree)
+    for a, b in zip(tree.get_arrays(), sample['search_tree'].get_arrays()):
+        np.testing.assert_array_equal(a, b)
+    queries = np.random.rand(20, 3)
+    dist, ind = tree.query(queries, k=5)
+    ref_dist, ref_ind = sample['search_tree'].query(queries, k=5)
+    np.testing.assert_array_equal(ind, ref_ind)
+    np.testing.assert_allclose(dist, ref_dist)
+    np.testing.assert_array_equal(
+        tree.query_radius(queries, r=0.1, count_only=True),
+        sample['search_tree'].query_radius(queries, r=0.1, count_only=True))
+
+    # Entries are mapped copy-on-write, changes never reach the disk.
+    out['point'][:] = 0
+    cache = MemmapCache(lambda data, attr: None,
+                        cache_dir=str(tmp_path),
+                        cache_key='test')
+    np.testing.assert_array_equal(cache('sample')['point'], sample['point'])
+
+
+def test_cache_lru_budget(tmp_path):
+    from ml3d.utils import Cache
+
+    calls = []
+
+    def preprocess(data, attr):
+        calls.append(attr['name'])
+        return data
+
+    sample_bytes = 1000 * 4
+    cache = Cache(preprocess,
+                  cache_dir=str(tmp_path),
+                  cache_key='test',
+                  max_memory=3 * sample_bytes)
+
+    outputs = {}
+    for i in range(5):
+        name = str(i)
+        outputs[name] = cache(name, {'x': np.full(1000, i, np.float32)},
+                              {'name': name})
+        assert cache.lru_bytes <= cache.max_memory
+    assert calls == [str(i) for i in range(5)]
+
+    # The oldest entries were evicted, the recent ones are kept in memory.
+    assert list(cache.lru.keys()) == ['2', '3', '4']
+    assert cache.lru_bytes == 3 * sample_bytes
+    assert cache('4') is outputs['4']
+
+    # Evicted entries are read back from the disk and become most recent.
+    out = cache('0')
+    assert out is not outputs['0']
+    np.testing.assert_array_equal(out['x'], outputs['0']['x'])
+    assert list(cache.lru.keys()) == ['3', '4', '0']
+    assert len(calls) == 5
+
+    # Entries larger than the budget are never kept.
+    cache('big', {'x': np.zeros(4000, np.float32)}, {'name': 'big'})
+    assert 'big' not in cache.lru
+    assert cache.lru_bytes <= cache.max_memory
+
+
+@pytest.mark.parametrize('cache_format', ['npy', 'memmap'])
+def test_cache_checksum(tmp_path, monkeypatch, cache_format):
+    from ml3d.utils import Cache, MemmapCache
+    from ml3d.utils import dataset_helper
+
+    cache_cls = MemmapCache if cache_format == 'memmap' else Cache
+    calls = []
+
+    def preprocess(data, attr):
+        calls.append(attr['name'])
+        return data
+
+    # Checksums are computed while writing, entries are not read back.
+    get_checksum = dataset_helper.get_checksum
+    monkeypatch.setattr(dataset_helper, 'get_checksum', None)
+    cache = cache_cls(preprocess, cache_dir=str(tmp_path), cache_key='test')
+    for name in ['a', 'b']:
+        cache(name, get_sample(), {'name': name})
+    cache.save_manifest()
+    monkeypatch.setattr(dataset_helper, 'get_checksum', get_checksum)
+
+    for name in ['a', 'b']:
+        assert cache.manifest[name]['checksum'] == get_checksum(
+            cache._get_path(name))
+        assert cache.verify(name)
+
+    # Corrupt an entry, verification on load removes it.
+    fpath = cache._get_path('a')
+    if cache_format == 'memmap':
+        fpath = os.path.join(fpath, 'point.npy')
+    with open(fpath, 'r+b') as f:
+        f.seek(-4, os.SEEK_END)
+        f.write(b'\xff\xff\xff\xff')
+
+    cache = cache_cls(preprocess,
+                      cache_dir=str(tmp_path),
+                      cache_key='test',
+                      verify=True)
+    assert set(cache.cached_ids) == {'b'}
+    assert not os.path.exists(cache._get_path('a'))
+
+    cache('a', get_sample(), {'name': 'a'})
+    assert calls == ['a', 'b', 'a']
+    assert cache.verify('a')
+
+
+def test_cache_disk_budget(tmp_path):
+    from ml3d.utils import MemmapCache
+    from ml3d.utils.dataset_helper import get_file_size
+
+    calls = []
+
+    def load_data(idx):
+        calls.append(idx)
+        return {'point': np.full((1000, 3), idx, np.float32)}
+
+    def disk_usage():
+        return get_file_size(str(tmp_path / 'test'))
+
+    # Two processes sharing the directory, the budget holds for both.
+    caches = [
+        MemmapCache(load_data,
+                    cache_dir=str(tmp_path),
+                    cache_key='test',
+                    max_disk=40000) for _ in range(2)
+    ]
+    for i in range(3):
+        caches[i % 2](str(i), i)
+    entry_size = disk_usage() / 3
+    assert entry_size > 12000
+
+    # Order the entries by last use.
+    for i in range(3):
+        os.utime(caches[0]._get_path(str(i)), (i, i))
+
+    # Reading an entry marks it as recently used.
+    np.testing.assert_array_equal(caches[0]('0')['point'], 0)
+    caches[1]('3', 3)
+    assert disk_usage() <= 40000
+    assert not os.path.exists(caches[0]._get_path('1'))
+    for i in [0, 2, 3]:
+        assert os.path.exists(caches[0]._get_path(str(i)))
+
+    # Evicted entries are built again.
+    np.testing.assert_array_equal(caches[0]('1', 1)['point'], 1)
+    assert calls == [0, 1, 2, 3, 1]
+    assert disk_usage() <= 40000
+    assert os.path.exists(caches[0]._get_path('1'))
+
+
+def test_list_dir_memo(tmp_path):
+    import json
+    from ml3d.utils import list_dir
+
+    path = tmp_path / 'scans'
+    path.mkdir()
+    cache_dir = str(tmp_path / 'cache')
+    for name in ['b', 'a']:
+        (path / name).touch()
+    os.utime(str(path), (1000, 1000))
+
+    assert list_dir(str(path), cache_dir) == ['a', 'b']
+    memo_dir = tmp_path / 'cache' / 'file_lists'
+    memo_path = str(next(memo_dir.iterdir()))
+
+    # The memo is used while the directory is unchanged.
+    with open(memo_path, 'r') as f:
+        memo = json.load(f)
+    memo['files'] = ['memo']
+    with open(memo_path, 'w') as f:
+        json.dump(memo, f)
+    assert list_dir(str(path), cache_dir) == ['memo']
+
+    # Changing the directory invalidates the memo.
+    (path / 'c').touch()
+    assert list_dir(str(path), cache_dir) == ['a', 'b', 'c']
+    (path / 'a').unlink()
+    assert list_dir(str(path), cache_dir) == ['b', 'c']
+
+    os.utime(str(path), (2000, 2000))
+    assert list_dir(str(path), cache_dir) == ['b', 'c']
+    with open(memo_path, 'r') as f:
+        assert json.load(f)['files'] == ['b', 'c']
+
+
+@pytest.mark.parametrize('cache_format', ['npy', 'memmap'])
+def test_cache_write_failure(tmp_path, monkeypatch, cache_format):
+    import errno
+    from ml3d.utils import Cache, MemmapCache
+
+    cache_cls = MemmapCache if cache_format == 'memmap' else Cache
+    calls = []
+
+    def preprocess(data, attr):
+        calls.append(attr['name'])
+        return data
+
+    def no_space(*args, **kwargs):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    cache = cache_cls(preprocess, cache_dir=str(tmp_path), cache_key='test')
+    monkeypatch.setattr(np, 'save', no_space)
+
+    # The computed entry is returned without storing it.
+    sample = get_sample()
+    out = cache('a', sample, {'name': 'a'})
+    np.testing.assert_array_equal(out['point'], sample['point'])
+    assert 'a' not in cache.cached_ids
+    assert os.listdir(cache.cache_dir) == []
+
+    monkeypatch.undo()
+    cache('a', sample, {'name': 'a'})
+    assert calls == ['a', 'a']
+    assert cache.verify('a')
+
+
+def test_scan_cache_key(tmp_path, monkeypatch):
+    pytest.importorskip('torch')
+    from collections import namedtuple
+    from ml3d.utils import Config
+    from ml3d.datasets import base_dataset
+    from ml3d.datasets.base_dataset import BaseDatasetSplit
+
+    DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+    class Dataset:
+        cfg = Config({
+            'name': 'test',
+            'dataset_path': str(tmp_path),
+            'scan_cache_mb': 16,
+            'scan_cache_dir': str(tmp_path / 'cache')
+        })
+
+    class Split(BaseDatasetSplit):
+
+        def __len__(self):
+            return 1
+
+        def get_attr(self, idx):
+            return {'name': 'scan', 'path': str(tmp_path / 'scan.npy')}
+
+        def get_data(self, idx):
+            return self.get_cached_data(idx, self.read_data)
+
+        def read_data(self, idx):
+            return {'point': np.load(self.get_attr(idx)['path'])}
+
+    np.save(str(tmp_path / 'scan.npy'), np.zeros((10, 3), np.float32))
+    np.testing.assert_array_equal(Split(Dataset()).get_data(0)['point'], 0)
+
+    # Editing the file gives a new entry.
+    np.save(str(tmp_path / 'scan.npy'), np.ones((20, 3), np.float32))
+    os.utime(str(tmp_path / 'scan.npy'), (1000, 1000))
+    np.testing.assert_array_equal(Split(Dataset()).get_data(0)['point'], 1)
+
+    # The budget is clamped to the free space of the cache directory.
+    monkeypatch.setattr(base_dataset.shutil, 'disk_usage',
+                        lambda path: DiskUsage(1 << 30, 1 << 30, 1000))
+    split = Split(Dataset())
+    np.testing.assert_array_equal(split.get_data(0)['point'], 1)
+    assert split.scan_cache.max_disk == 1000
@@ -0,0 +1,115 @@
+import pytest
+import os
+import numpy as np
+
+
+def test_s3dis_create_ply_files(tmp_path, monkeypatch):
+    pytest.importorskip('torch')
+    pytest.importorskip('open3d')
+    from ml3d.datasets.s3dis import S3DIS
+    from ml3d.utils.ply import read_ply
+
+    rng = np.random.RandomState(0)
+    label_to_names = S3DIS.get_label_to_names()
+    # Objects of every room, in the order of their file names.
+    rooms = {'Area_1/office_1': ['chair', 'wall'], 'Area_2/hallway_1': ['door']}
+
+    anno_paths = []
+    expected = {}
+    for room, classes in rooms.items():
+        anno_path = tmp_path / 'raw' / room / 'Annotations'
+        anno_path.mkdir(parents=True)
+        anno_paths.append(anno_path)
+        points = []
+        for i, class_name in enumerate(classes):
+            xyz = np.round(rng.rand(50, 3) * 10, 3)
+            colors = rng.randint(0, 256, (50, 3))
+            pc = np.hstack((xyz, colors))
+            np.savetxt(str(anno_path / '{}_{}.txt'.format(class_name, i + 1)),
+                       pc,
+                       fmt='%.3f %.3f %.3f %d %d %d')
+            points.append(pc)
+        name = S3DIS.get_room_name(anno_path)
+        expected[name] = (np.concatenate(points, 0), classes)
+    monkeypatch.setattr(S3DIS, 'get_annotation_paths',
+                        staticmethod(lambda dataset_path: anno_paths))
+
+    S3DIS.create_ply_files(str(tmp_path), label_to_names, num_workers=1)
+
+    label_to_idx = {name: label for label, name in label_to_names.items()}
+    out_path = tmp_path / 'original_ply'
+    assert sorted(os.listdir(str(out_path))) == sorted(expected)
+    for name, (pc, classes) in expected.items():
+        data = read_ply(str(out_path / name))
+        assert data['x'].dtype == np.float32
+        assert data['red'].dtype == np.uint8
+        assert data['class'].dtype == np.uint8
+        xyz = np.vstack((data['x'], data['y'], data['z'])).T
+        np.testing.assert_allclose(xyz, pc[:, :3], atol=1e-5)
+        colors = np.vstack((data['red'], data['green'], data['blue'])).T
+        np.testing.assert_array_equal(colors, pc[:, 3:])
+        np.testing.assert_array_equal(
+            data['class'], np.repeat([label_to_idx[c] for c in classes], 50))
+
+    # Converted rooms are skipped, only missing ones are converted again.
+    converted = []
+    create_room_ply = S3DIS.create_room_ply
+
+    def record(job):
+        converted.append(os.path.basename(job[1]))
+        create_room_ply(job)
+
+    monkeypatch.setattr(S3DIS, 'create_room_ply', staticmethod(record))
+    S3DIS.create_ply_files(str(tmp_path), label_to_names, num_workers=1)
+    assert converted == []
+
+    os.remove(str(out_path / 'Area_2_hallway_1.ply'))
+    S3DIS.create_ply_files(str(tmp_path), label_to_names, num_workers=1)
+    assert converted == ['Area_2_hallway_1.ply']
+    assert sorted(os.listdir(str(out_path))) == sorted(expected)
+
+
+def test_semantickitti_readahead(monkeypatch):
+    pytest.importorskip('torch')
+    pytest.importorskip('open3d')
+    from ml3d.datasets import semantickitti
+    from ml3d.utils import Config
+
+    class Dataset:
+        cfg = Config({'readahead': 2})
+        remap_lut_val = None
+
+        def get_split_list(self, split):
+            return ['{:06d}.bin'.format(i) for i in range(10)]
+
+    reads = []
+
+    class Split(semantickitti.SemanticKITTISplit):
+
+        def read_data(self, idx):
+            reads.append(idx)
+            return {'idx': idx}
+
+    # Sequential reads load the next scans in the background.
+    split = Split(Dataset())
+    for i in range(3):
+        assert split.get_data(i) == {'idx': i}
+    for future in split._futures.values():
+        future.result()
+    assert sorted(reads) == list(range(5))
+
+    # A new process replaces the executor and shuts the old one down.
+    executor = split._executor
+    split._readahead_pid = None
+    assert split.get_data(3) == {'idx': 3}
+    assert split._executor is not executor
+    assert executor._shutdown
+
+    # Data loader workers only read the scans they are asked for.
+    monkeypatch.setattr(semantickitti, 'get_worker_info', lambda: object())
+    reads.clear()
+    split = Split(Dataset())
+    for i in range(3):
+        assert split.get_data(i) == {'idx': i}
+    assert reads == [0, 1, 2]
+    assert split._executor is None
@@ -0,0 +1,56 @@
+import pytest
+import numpy as np
+
+
+def reference_filter_valid_label(scores, labels, num_classes,
+                                 ignored_label_inds, device):
+    # filter_valid_label before the label lookup table.
+    import torch
+
+    valid_scores = scores.reshape(-1, num_classes)
+    valid_labels = labels.reshape(-1).to(device)
+
+    ignored_bool = torch.zeros_like(valid_labels, dtype=torch.bool)
+    for ign_label in ignored_label_inds:
+        ignored_bool = torch.logical_or(ignored_bool,
+                                        torch.eq(valid_labels, ign_label))
+
+    valid_idx = torch.where(torch.logical_not(ignored_bool))[0].to(device)
+
+    valid_scores = torch.gather(valid_scores, 0,
+                                valid_idx.unsqueeze(-1).expand(-1, num_classes))
+    valid_labels = torch.gather(valid_labels, 0, valid_idx)
+
+    reducing_list = torch.arange(0, num_classes, dtype=torch.int64)
+    inserted_value = torch.zeros([1], dtype=torch.int64)
+    for ign_label in ignored_label_inds:
+        reducing_list = torch.cat([
+            reducing_list[:ign_label], inserted_value, reducing_list[ign_label:]
+        ], 0)
+    valid_labels = torch.gather(reducing_list.to(device), 0, valid_labels)
+
+    valid_labels = valid_labels.unsqueeze(0)
+    valid_scores = valid_scores.unsqueeze(0).transpose(-2, -1)
+
+    return valid_scores, valid_labels
+
+
+@pytest.mark.parametrize('ignored_label_inds', [[], [0], [3], [0, 4], [1, 6]])
+def test_filter_valid_label(ignored_label_inds):
+    torch = pytest.importorskip('torch')
+    from ml3d.torch.modules.losses import filter_valid_label
+
+    num_classes = 6
+    num_labels = num_classes + len(ignored_label_inds)
+    rng = np.random.RandomState(0)
+    scores = torch.from_numpy(rng.rand(2, 500, num_classes)).float()
+    labels = torch.from_numpy(rng.randint(0, num_labels, (2, 500)))
+
+    valid_scores, valid_labels = filter_valid_label(scores, labels, num_classes,
+                                                    ignored_label_inds, 'cpu')
+    ref_scores, ref_labels = reference_filter_valid_label(
+        scores, labels, num_classes, ignored_label_inds, 'cpu')
+
+    assert torch.equal(valid_scores, ref_scores)
+    assert torch.equal(valid_labels, ref_labels)
+    assert valid_labels.min() >= 0 and valid_labels.max() < num_classes
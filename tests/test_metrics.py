@@ -0,0 +1,79 @@
+import pytest
+import numpy as np
+
+
+def reference_acc(scores, labels):
+    # Per-class loop of SemSegMetric.acc before the confusion matrix.
+    import torch
+
+    num_classes = scores.size(-2)
+    predictions = torch.max(scores, dim=-2).indices
+    accuracy_mask = predictions == labels
+    accuracies = []
+    for label in range(num_classes):
+        label_mask = labels == label
+        per_class_accuracy = (accuracy_mask & label_mask).float().sum()
+        per_class_accuracy /= label_mask.float().sum()
+        accuracies.append(per_class_accuracy.cpu().item())
+    accuracies.append(np.nanmean(accuracies))
+    return accuracies
+
+
+def reference_iou(scores, labels):
+    # Per-class loop of SemSegMetric.iou before the confusion matrix.
+    import torch
+
+    num_classes = scores.size(-2)
+    predictions = torch.max(scores, dim=-2).indices
+    ious = []
+    for label in range(num_classes):
+        pred_mask = predictions == label
+        labels_mask = labels == label
+        iou = (pred_mask & labels_mask).float().sum()
+        iou = iou / (pred_mask | labels_mask).float().sum()
+        ious.append(iou.cpu().item())
+    ious.append(np.nanmean(ious))
+    return ious
+
+
+def get_batch(rng, num_points, num_classes):
+    import torch
+
+    # Class 3 is never predicted nor labeled, class 4 is only predicted.
+    labels = rng.choice([0, 1, 2, 5], num_points)
+    predictions = rng.choice([0, 1, 2, 4, 5], num_points)
+    scores = rng.rand(num_points, num_classes)
+    scores[np.arange(num_points), predictions] += 1
+    return (torch.from_numpy(scores.T[None]).float(),
+            torch.from_numpy(labels[None]))
+
+
+def test_semseg_metric():
+    torch = pytest.importorskip('torch')
+    from ml3d.torch.modules.metrics import SemSegMetric
+
+    num_classes = 6
+    rng = np.random.RandomState(0)
+    batches = [get_batch(rng, n, num_classes) for n in [100, 1, 250]]
+
+    metric = SemSegMetric(None, None, None, 'cpu')
+    for scores, labels in batches:
+        np.testing.assert_allclose(metric.acc(scores, labels),
+                                   reference_acc(scores, labels))
+        np.testing.assert_allclose(metric.iou(scores, labels),
+                                   reference_iou(scores, labels))
+        metric.update(scores, labels)
+
+    # The accumulated metrics are the ones of all the batches at once.
+    scores = torch.cat([scores for scores, _ in batches], -1)
+    labels = torch.cat([labels for _, labels in batches], -1)
+    acc = metric.accumulated_acc()
+    iou = metric.accumulated_iou()
+    np.testing.assert_allclose(acc, reference_acc(scores, labels))
+    np.testing.assert_allclose(iou, reference_iou(scores, labels))
+
+    assert np.isnan(acc[3]) and np.isnan(acc[4])
+    assert np.isnan(iou[3]) and iou[4] == 0
+
+    metric.reset()
+    assert metric.confusion_matrix is None
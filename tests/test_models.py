@@ -1,4 +1,5 @@
 import pytest
+import os
 import numpy as np
 
 
@@ -106,6 +107,295 @@ def test_kpconv_torch():
     assert out.shape[1] == 5
 
 
+def test_kpconv_neighborhood_limits(tmp_path):
+    pytest.importorskip('torch')
+    pytest.importorskip('open3d')
+    from ml3d.torch.models import KPFCNN
+    from ml3d.torch.dataloaders import ConcatBatcher
+    from ml3d.torch.pipelines import SemanticSegmentation
+
+    def get_model():
+        net = KPFCNN(lbl_values=[0, 1, 2, 3, 4, 5],
+                     num_classes=4,
+                     ignored_label_inds=[0],
+                     in_features_dim=5,
+                     neighborhood_calib_percentile=50)
+        net.device = 'cpu'
+        return net
+
+    def get_batch(net, seed):
+        rng = np.random.RandomState(seed)
+        data = {
+            'point': rng.rand(1000, 3).astype(np.float32),
+            'feat': rng.rand(1000, 3).astype(np.float32),
+            'label': rng.randint(5, size=1000).astype(np.int32)
+        }
+        attr = {'split': 'train'}
+        data = net.preprocess(data, attr)
+        inputs = {'data': net.transform(data, attr), 'attr': attr}
+        return ConcatBatcher('cpu').collate_fn([inputs])
+
+    net = get_model()
+    batches = [get_batch(net, seed) for seed in range(2)]
+    widths = [n.shape[1] for n in batches[0]['data'].neighbors]
+    limits = net.calibrate_neighborhood_limits(batches)
+
+    assert len(limits) == len(widths)
+    assert net.cfg.get('neighborhood_limits') == limits
+    assert any(l < w for l, w in zip(limits, widths))
+
+    # Batches built after the calibration are cropped to the limits.
+    neighbors = get_batch(net, 2)['data'].neighbors
+    assert len(neighbors) == len(limits)
+    for neighb_mat, limit in zip(neighbors, limits):
+        assert neighb_mat.shape[1] <= limit
+
+    # The limits are restored with the checkpoint.
+    pipeline_kwargs = dict(device='cpu',
+                           main_log_dir=str(tmp_path),
+                           deform_lr_factor=0.1,
+                           weight_decay=1e-3)
+    pipeline = SemanticSegmentation(net, **pipeline_kwargs)
+    pipeline.optimizer, pipeline.scheduler = net.get_optimizer(pipeline.cfg)
+    pipeline.save_ckpt(1)
+
+    net = get_model()
+    pipeline = SemanticSegmentation(net, **pipeline_kwargs)
+    pipeline.load_ckpt()
+    assert net.neighborhood_limits == limits
+    assert net.cfg.get('neighborhood_limits') == limits
+    for neighb_mat, limit in zip(get_batch(net, 2)['data'].neighbors, limits):
+        assert neighb_mat.shape[1] <= limit
+
+
+def test_kpconv_batch_limit(tmp_path):
+    pytest.importorskip('torch')
+    pytest.importorskip('open3d')
+    from ml3d.torch.models import KPFCNN
+    from ml3d.torch.pipelines import SemanticSegmentation
+
+    def get_model():
+        net = KPFCNN(lbl_values=[0, 1, 2, 3, 4, 5],
+                     num_classes=4,
+                     ignored_label_inds=[0],
+                     in_features_dim=5)
+        net.device = 'cpu'
+        return net
+
+    net = get_model()
+    samples = [{'p_list': [np.zeros((n, 3))]} for n in [100, 200, 600]]
+    assert net.calibrate_batch_limit(samples, batch_num=3) == [100, 200, 600]
+    assert net.cfg.get('batch_limit') == 900
+    assert net.cfg['batch_limit'] == 900
+
+    # The limit is restored with the checkpoint.
+    pipeline_kwargs = dict(device='cpu',
+                           main_log_dir=str(tmp_path),
+                           deform_lr_factor=0.1,
+                           weight_decay=1e-3)
+    pipeline = SemanticSegmentation(net, **pipeline_kwargs)
+    pipeline.optimizer, pipeline.scheduler = net.get_optimizer(pipeline.cfg)
+    pipeline.save_ckpt(1)
+
+    net = get_model()
+    assert net.cfg.get('batch_limit') != 900
+    SemanticSegmentation(net, **pipeline_kwargs).load_ckpt()
+    assert net.cfg.get('batch_limit') == 900
+
+
+def test_kpconv_batch_headroom():
+    pytest.importorskip('torch')
+    pytest.importorskip('open3d')
+    from ml3d.torch.models import KPFCNN
+    from ml3d.torch.dataloaders import ConcatBatcher
+
+    net = KPFCNN(lbl_values=[0, 1, 2, 3, 4, 5],
+                 num_classes=4,
+                 ignored_label_inds=[0],
+                 in_features_dim=5,
+                 batch_limit=500,
+                 min_in_points=2000,
+                 point_budget_sampler=True,
+                 batch_limit_headroom=1.5)
+    net.device = 'cpu'
+
+    rng = np.random.RandomState(0)
+    attr = {'split': 'train'}
+    inputs = []
+    for _ in range(4):
+        data = {
+            'point': rng.rand(1000, 3).astype(np.float32),
+            'feat': rng.rand(1000, 3).astype(np.float32),
+            'label': rng.randint(5, size=1000).astype(np.int32)
+        }
+        data = net.transform(net.preprocess(data, attr), attr)
+        # The sampler fills the batches, a sample is a single sphere.
+        assert len(data['p_list']) == 1
+        inputs.append({'data': data, 'attr': attr})
+    sample_lengths = [len(data['data']['p_list'][0]) for data in inputs]
+
+    # Samples beyond the headroom of the budget are dropped.
+    batch = ConcatBatcher('cpu').collate_fn(inputs)['data']
+    num_kept = np.searchsorted(np.cumsum(sample_lengths), 750, side='right')
+    assert batch.sample_lengths == sample_lengths[:max(num_kept, 1)]
+    assert batch.lengths[0].tolist() == batch.sample_lengths
+    assert len(batch.sample_lengths) < len(inputs)
+
+
+def test_kpconv_inference_end():
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('open3d')
+    from types import SimpleNamespace
+    from tqdm import tqdm
+    from ml3d.torch.models import KPFCNN
+
+    net = KPFCNN(lbl_values=[0, 1, 2, 3, 4, 5],
+                 num_classes=4,
+                 ignored_label_inds=[0],
+                 in_features_dim=5)
+    net.device = 'cpu'
+
+    rng = np.random.RandomState(0)
+    num_points, num_classes = 50, 4
+    net.test_smooth = 0.98
+    net.test_probs = torch.zeros((num_points, num_classes), dtype=torch.float16)
+    net.possibility = np.zeros(num_points)
+    net.num_converged = 0
+    net.pbar = tqdm(total=num_points, disable=True)
+    net.pbar_update = 0
+    net.inference_proj_inds = rng.randint(0, num_points, 80)
+    net.inference_ori_data = {'label': rng.randint(1, 5, 80)}
+
+    # Previous implementation, one smoothing step per sphere.
+    ref_probs = np.zeros((num_points, num_classes), dtype=np.float16)
+
+    def ref_inference_end(masks, results):
+        stk_probs = torch.nn.functional.softmax(results, dim=-1).numpy()
+        i0 = 0
+        for proj_mask in masks:
+            probs = stk_probs[i0:i0 + len(proj_mask)]
+            ref_probs[proj_mask] = net.test_smooth * ref_probs[proj_mask] + (
+                1 - net.test_smooth) * probs
+            i0 += len(proj_mask)
+
+    # Spheres overlap between batches but not within a batch.
+    for _ in range(4):
+        inds = rng.permutation(num_points)[:30]
+        masks = [inds[:10], inds[10:18], inds[18:]]
+        results = torch.from_numpy(
+            rng.randn(30, num_classes).astype(np.float32))
+        inputs = {'data': SimpleNamespace(reproj_masks=masks)}
+        assert not net.inference_end(inputs, results)
+        ref_inference_end(masks, results)
+        np.testing.assert_allclose(net.test_probs.numpy().astype(np.float32),
+                                   ref_probs.astype(np.float32),
+                                   atol=1e-3)
+
+    # A point predicted twice in a batch gets the mean of its predictions
+    # with two smoothing steps.
+    old = net.test_probs[7].float().clone()
+    results = torch.from_numpy(rng.randn(2, num_classes).astype(np.float32))
+    inputs = {'data': SimpleNamespace(reproj_masks=[[7], [7]])}
+    net.num_converged = num_points
+    assert net.inference_end(inputs, results)
+    probs = torch.nn.functional.softmax(results, dim=-1).mean(0)
+    expected = 0.98**2 * old + (1 - 0.98**2) * probs
+    np.testing.assert_allclose(net.test_probs[7].float().numpy(),
+                               expected.numpy(),
+                               atol=1e-3)
+
+    test_probs = net.test_probs.numpy()
+    result = net.inference_result
+    np.testing.assert_array_equal(result['predict_scores'],
+                                  test_probs[net.inference_proj_inds])
+    np.testing.assert_array_equal(
+        result['predict_labels'],
+        np.argmax(test_probs, 1)[net.inference_proj_inds])
+
+
+@pytest.mark.parametrize('deformable', [False, True])
+@pytest.mark.parametrize('reentrant', [False, True])
+def test_kpconv_chunks(monkeypatch, deformable, reentrant):
+    torch = pytest.importorskip('torch')
+    from ml3d.torch.models import kpconv
+    from ml3d.torch.models.kpconv import KPConv
+
+    # Older torch versions only have the reentrant checkpoint.
+    if reentrant:
+        monkeypatch.setattr(kpconv, 'torch_version', lambda: (1, 6))
+
+    rng = np.random.RandomState(0)
+    n_points, n_neighbors = 100, 12
+    q_pts = torch.from_numpy(rng.rand(n_points, 3).astype(np.float32))
+    s_pts = torch.from_numpy(rng.rand(2 * n_points, 3).astype(np.float32))
+    neighb_inds = torch.from_numpy(
+        rng.randint(0, 2 * n_points + 1, (n_points, n_neighbors)))
+    feat = rng.rand(2 * n_points, 4).astype(np.float32)
+
+    torch.manual_seed(0)
+    conv = KPConv(15, 3, 4, 8, 0.3, 0.3, deformable=deformable)
+
+    def run(chunk_size, checkpoint):
+        conv.chunk_size = chunk_size
+        conv.checkpoint = checkpoint
+        if conv.offset_conv is not None:
+            conv.offset_conv.chunk_size = chunk_size
+            conv.offset_conv.checkpoint = checkpoint
+        conv.zero_grad()
+        x = torch.from_numpy(feat).requires_grad_()
+        out = conv(q_pts, s_pts, neighb_inds, x)
+        out.pow(2).sum().backward()
+        grads = [x.grad] + [p.grad for p in conv.parameters()]
+        return out.detach(), [g.clone() for g in grads if g is not None]
+
+    ref_out, ref_grads = run(0, False)
+    for checkpoint in [False, True]:
+        out, grads = run(32, checkpoint)
+        np.testing.assert_allclose(out.numpy(),
+                                   ref_out.numpy(),
+                                   rtol=1e-5,
+                                   atol=1e-5)
+        assert len(grads) == len(ref_grads)
+        for g, ref_g in zip(grads, ref_grads):
+            np.testing.assert_allclose(g.numpy(),
+                                       ref_g.numpy(),
+                                       rtol=1e-4,
+                                       atol=1e-4)
+
+    # Frozen inputs still get the parameter gradients through the
+    # checkpointed chunks.
+    conv.zero_grad()
+    conv(q_pts, s_pts, neighb_inds, torch.from_numpy(feat)).sum().backward()
+    assert conv.weights.grad is not None
+
+
+@pytest.mark.parametrize('fixed', ['center', 'verticals', 'none'])
+def test_kernel_dispositions_bundled(tmp_path, monkeypatch, fixed):
+    from ml3d.utils import kernel_dispositions
+
+    monkeypatch.setattr(kernel_dispositions, '_kernel_memo', {})
+    monkeypatch.setattr(kernel_dispositions, '_kernel_store', None)
+
+    def create_fn():
+        raise AssertionError('the bundled disposition was not used')
+
+    kernel_dir = str(tmp_path / 'dispositions')
+    kernel_points = kernel_dispositions.get_kernel_disposition(
+        15, fixed, 3, create_fn, kernel_dir=kernel_dir)
+
+    assert kernel_points.shape == (15, 3)
+    assert not kernel_points.flags.writeable
+    assert not os.path.exists(kernel_dir)
+    np.testing.assert_array_less(np.linalg.norm(kernel_points, axis=1),
+                                 1 + 1e-6)
+    if fixed == 'center':
+        np.testing.assert_array_equal(kernel_points[0], 0)
+
+    # Later lookups are served by the memo.
+    assert kernel_dispositions.get_kernel_disposition(
+        15, fixed, 3, create_fn, kernel_dir=kernel_dir) is kernel_points
+
+
 def test_kpconv_tf():
     import tensorflow as tf
     import open3d.ml.tf as ml3d
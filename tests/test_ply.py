@@ -0,0 +1,65 @@
+import pytest
+import sys
+import numpy as np
+
+
+def write_ply_with_elements(filename, elements, vertices):
+    """Write a binary ply file with extra elements before the vertices."""
+    header = ['ply', 'format binary_' + sys.byteorder + '_endian 1.0']
+    for name, data in elements:
+        header.append('element {} {:d}'.format(name, data.shape[0]))
+        if data.dtype.names is None:
+            header.append('property list uchar int vertex_indices')
+        else:
+            for field in data.dtype.names:
+                header.append('property float {}'.format(field))
+    header.append('element vertex {:d}'.format(vertices.shape[0]))
+    for field in vertices.dtype.names:
+        header.append('property float {}'.format(field))
+    header.append('end_header')
+
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode())
+        for _, data in elements:
+            data.tofile(f)
+        vertices.tofile(f)
+
+
+def test_read_ply_memmap(tmp_path):
+    from ml3d.utils.ply import write_ply, read_ply, read_ply_memmap
+
+    filename = str(tmp_path / 'points.ply')
+    points = np.random.rand(100, 3).astype(np.float32)
+    colors = np.random.randint(255, size=(100, 3), dtype=np.uint8)
+    labels = np.random.randint(10, size=100).astype(np.int32)
+    faces = np.random.randint(100, size=(20, 3))
+    write_ply(filename, [points, colors, labels],
+              ['x', 'y', 'z', 'red', 'green', 'blue', 'class'],
+              triangular_faces=faces)
+
+    data = read_ply_memmap(filename)
+    ref = read_ply(filename, triangular_mesh=True)[0]
+    assert isinstance(data, np.memmap)
+    assert data.dtype == ref.dtype
+    np.testing.assert_array_equal(data, ref)
+
+
+def test_read_ply_memmap_element_order(tmp_path):
+    from ml3d.utils.ply import read_ply_memmap
+
+    vertices = np.zeros(50, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
+    for field in vertices.dtype.names:
+        vertices[field] = np.random.rand(50)
+
+    # Fixed size elements before the vertices are skipped.
+    filename = str(tmp_path / 'camera.ply')
+    camera = np.ones(2, dtype=[('u', 'f4'), ('v', 'f4')])
+    write_ply_with_elements(filename, [('camera', camera)], vertices)
+    np.testing.assert_array_equal(read_ply_memmap(filename), vertices)
+
+    # Elements with list properties have no known size.
+    filename = str(tmp_path / 'faces.ply')
+    faces = np.zeros((5, 4), dtype=np.uint8)
+    write_ply_with_elements(filename, [('face', faces)], vertices)
+    with pytest.raises(ValueError):
+        read_ply_memmap(filename)